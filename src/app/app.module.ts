@@ -12,7 +12,12 @@ import { LayoutComponent } from './layout/layout.component';
 
 const socketConfig: SocketIoConfig = {
   url: 'http://localhost:5000',
-  options: { transports: ['websocket', 'polling'], reconnection: true }
+  options: {
+    transports: ['websocket', 'polling'],
+    reconnection: true,
+    // Read on every (re)connection, so the socket follows the current login
+    auth: (cb: (data: object) => void) => cb({ token: sessionStorage.getItem('token') })
+  }
 };
 
 @NgModule({
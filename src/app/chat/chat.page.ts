@@ -3,7 +3,11 @@ import { ActivatedRoute, Router } from '@angular/router';
 import { AuthService } from '../services/auth.service';
 import { IonContent, AlertController, ToastController } from '@ionic/angular';
 import { Socket } from 'ngx-socket-io';
-import { Subscription } from 'rxjs';
+import { Subscription, interval } from 'rxjs';
+
+// Matches the server's PRESENCE_HEARTBEAT_SECONDS: sockets silent for
+// PRESENCE_TTL_SECONDS (60 s) are shown offline
+const HEARTBEAT_INTERVAL_MS = 20000;
 
 @Component({
   selector: 'app-chat',
@@ -53,9 +57,17 @@ export class ChatPage implements OnInit, OnDestroy {
 
     this.socket.fromEvent('connect').subscribe(() => {
       console.log('Socket connected');
+      this.socketConnected = true;
       this.socket.emit('join_conversation', { conversationId: this.conversationId });
     });
 
+    // Keep the user shown online while the page is open, even when idle
+    this.subscriptions.push(interval(HEARTBEAT_INTERVAL_MS).subscribe(() => {
+      if (this.socketConnected) {
+        this.socket.emit('heartbeat');
+      }
+    }));
+
     this.socket.fromEvent('new_message').subscribe((message: any) => {
       if (message.conversationId === this.conversationId) {
         this.messages.push(message);
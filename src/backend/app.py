@@ -1,94 +1,699 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, request, jsonify, send_file, g, has_request_context, json, stream_with_context
 from flask_pymongo import PyMongo
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt, decode_token
 from flask_socketio import SocketIO, emit, join_room
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import RequestedRangeNotSatisfiable, RequestEntityTooLarge
 from bson.objectid import ObjectId
 from flask_cors import CORS
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from collections import Counter
 from gridfs import GridFS
+from gridfs.errors import NoFile
+from pymongo import monitoring, ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import mimetypes
-from io import BytesIO
 from apscheduler.schedulers.background import BackgroundScheduler
 import logging
+import hashlib
+import atexit
+import click
+import signal
+import threading
+
+from config import Config
+from cache import TTLCache, VersionedSnapshot
+from indexes import ensure_indexes, verify_indexes
+from availability import AvailabilityEngine
+from search import DoctorSearchIndex, tokenize
+from reminders import acquire_lease, send_appointment_reminders
+from notifications import NotificationDispatcher, archive_notifications, backfill_read_at
+from storage import ContentStore, FileTooLarge, LimitedUploadFile
+from thumbnails import ThumbnailWorker
+from pubsub import message_queue_options
+from messaging import ConversationActivity
+from presence import Broadcaster, PresenceRegistry, RateLimiter, TypingTracker
+from serialization import (
+    FastJSONProvider, SocketJSON, appointment_row, consultation_row, conversation_row,
+    document_row, message_row, notification_row
+)
+
+# Uploaded files over MAX_UPLOAD_FILE_SIZE fail while the body is parsed
+class UploadLimitedRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return LimitedUploadFile(app.config["MAX_UPLOAD_FILE_SIZE"], filename)
 
 app = Flask(__name__)
-CORS(app)
+app.request_class = UploadLimitedRequest
+CORS(app, expose_headers=["X-Page-Before", "X-Page-After", "X-Total-Count"])
 
-app.config["MONGO_URI"] = "mongodb://localhost:27017/mobile"
+app.config.from_object(Config)
 app.config["JWT_SECRET_KEY"] = "super-secret"
 app.config["SECRET_KEY"] = "socketio-secret"
 
-mongo = PyMongo(app)
+# Count the Mongo commands issued while serving each request
+class QueryCounter(monitoring.CommandListener):
+    def started(self, event):
+        if has_request_context():
+            g.query_count = g.get("query_count", 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+mongo = PyMongo(app, event_listeners=[QueryCounter()])
+# orjson-backed responses, replacing flask_pymongo's extended JSON provider:
+# ObjectIds and datetimes are encoded as plain strings
+app.json = FastJSONProvider(app)
 jwt = JWTManager(app)
 fs = GridFS(mongo.db)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Uploaded files are deduplicated by content hash and reference counted
+content_store = ContentStore(lambda: mongo.db, max_file_size=app.config["MAX_UPLOAD_FILE_SIZE"])
+# Document previews are built in the background after upload
+thumbnail_worker = ThumbnailWorker(
+    lambda: mongo.db,
+    size=app.config["THUMBNAIL_SIZE"],
+    workers=app.config["THUMBNAIL_WORKERS"],
+    max_pending=app.config["THUMBNAIL_QUEUE_SIZE"]
+)
+# Events reach clients of every worker through the configured message queue
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    async_mode=app.config["SOCKETIO_ASYNC_MODE"],
+    json=SocketJSON,
+    **message_queue_options(app.config["SOCKETIO_MESSAGE_QUEUE"], app.config["SOCKETIO_CHANNEL"])
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize scheduler for appointment reminders
+# Principal resolution: user id, role and display name travel in the JWT claims.
+# The in-process cache is keyed by user id and holds principals refreshed by
+# profile updates (newer than the claims of older tokens); tokens issued without
+# a uid claim are looked up by email, cached under "email:<address>".
+principal_cache = TTLCache(
+    maxsize=app.config["PRINCIPAL_CACHE_SIZE"],
+    ttl=app.config["PRINCIPAL_CACHE_TTL"]
+)
+
+def build_principal(account, is_doctor):
+    if is_doctor:
+        return {
+            "id": str(account["_id"]),
+            "role": "medecin",
+            "name": account["nom"],
+            "email": account["email"]
+        }
+    return {
+        "id": str(account["_id"]),
+        "role": account.get("role", ""),
+        "name": account["name"],
+        "email": account["email"]
+    }
+
+def issue_token(principal):
+    return create_access_token(
+        identity=principal["email"],
+        additional_claims={
+            "uid": principal["id"],
+            "role": principal["role"],
+            "name": principal["name"]
+        }
+    )
+
+def find_principal(email):
+    user = mongo.db.users.find_one({"email": email}, {"name": 1, "email": 1, "role": 1})
+    if user:
+        return build_principal(user, is_doctor=False)
+    doctor = mongo.db.medecins.find_one({"email": email}, {"nom": 1, "email": 1})
+    if doctor:
+        return build_principal(doctor, is_doctor=True)
+    return None
+
+def resolve_principal(identity, claims):
+    if claims.get("uid"):
+        return principal_cache.get(claims["uid"]) or {
+            "id": claims["uid"],
+            "role": claims["role"],
+            "name": claims["name"],
+            "email": identity
+        }
+    # Legacy token: its email identity may have changed hands since it was issued
+    principal = principal_cache.get(f"email:{identity}")
+    if principal is None:
+        principal = find_principal(identity)
+        if principal:
+            principal_cache.set(f"email:{identity}", principal)
+    return principal
+
+def current_principal():
+    return resolve_principal(get_jwt_identity(), get_jwt())
+
+def is_doctor(principal):
+    return principal is not None and principal["role"] == "medecin"
+
+def refresh_principal(old_email, principal):
+    # Old tokens keep their stale claims: serve them the fresh principal by id.
+    # The old email may now be registered by someone else, so its entry goes.
+    principal_cache.set(principal["id"], principal)
+    principal_cache.pop(f"email:{old_email}")
+    principal_cache.pop(f"email:{principal['email']}")
+
+@app.after_request
+def report_query_count(response):
+    query_count = g.get("query_count", 0)
+    logger.debug(f"{request.method} {request.path}: {query_count} Mongo queries")
+    if app.config["QUERY_COUNT_HEADER"]:
+        response.headers["X-Query-Count"] = str(query_count)
+    return response
+
+# Fetch the documents referenced by a set of string ids with a single $in query
+def fetch_by_ids(collection, ids, projection=None):
+    object_ids = list({ObjectId(i) for i in ids if i and ObjectId.is_valid(i)})
+    if not object_ids:
+        return {}
+    return {
+        str(doc["_id"]): doc
+        for doc in collection.find({"_id": {"$in": object_ids}}, projection)
+    }
+
+# Keyset pagination on _id: pages are newest first, `before` walks back to
+# older rows and `after` returns the rows created after a given id.
+def read_page_args():
+    try:
+        limit = int(request.args.get("limit", app.config["PAGE_SIZE"]))
+    except ValueError:
+        return None
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if limit < 1 or (after and before):
+        return None
+    if (after and not ObjectId.is_valid(after)) or (before and not ObjectId.is_valid(before)):
+        return None
+    return {
+        "limit": min(limit, app.config["MAX_PAGE_SIZE"]),
+        "after": ObjectId(after) if after else None,
+        "before": ObjectId(before) if before else None
+    }
+
+def find_page(collection, query, projection, page):
+    query = dict(query)
+    if page["after"]:
+        query["_id"] = {"$gt": page["after"]}
+        direction = ASCENDING
+    else:
+        if page["before"]:
+            query["_id"] = {"$lt": page["before"]}
+        direction = DESCENDING
+
+    rows = list(collection.find(query, projection).sort("_id", direction).limit(page["limit"] + 1))
+    has_more = len(rows) > page["limit"]
+    rows = rows[:page["limit"]]
+    if direction == ASCENDING:
+        rows.reverse()
+
+    headers = {}
+    if rows:
+        headers["X-Page-After"] = str(rows[0]["_id"])
+        if has_more or page["after"]:
+            headers["X-Page-Before"] = str(rows[-1]["_id"])
+    return rows, headers
+
+def invalid_page_response():
+    return jsonify({"message": "Paramètres de pagination invalides (limit, after, before)"}), 400
+
+# Opt-in streaming of large lists: `Accept: application/x-ndjson` streams one row
+# per line, `?stream=1` a chunked JSON array. The whole result is sent, newest
+# first, unless `limit` is given; `after`/`before` bound it as with pages.
+def stream_format():
+    if request.accept_mimetypes.best == "application/x-ndjson":
+        return "ndjson"
+    if request.args.get("stream") in ("1", "true"):
+        return "array"
+    return None
+
+# Rows are read STREAM_BATCH_SIZE at a time; `serialize(docs)` turns each batch
+# into response rows (with any lookups it needs), which are written before the
+# next batch is fetched, so worker memory stays flat whatever the result size.
+def stream_rows(fmt, collection, query, projection, page, serialize):
+    query = dict(query)
+    bounds = {}
+    if page["after"]:
+        bounds["$gt"] = page["after"]
+    if page["before"]:
+        bounds["$lt"] = page["before"]
+    if bounds:
+        query["_id"] = bounds
+    limit = int(request.args["limit"]) if "limit" in request.args else None
+    if page["after"] and limit:
+        # As with pages, `after` returns the `limit` rows right after it: find
+        # the newest of them, then stream down to `after` newest first
+        last = list(collection.find(query, {"_id": 1}).sort("_id", ASCENDING).skip(limit - 1).limit(1))
+        if last:
+            query["_id"] = {**bounds, "$lte": last[0]["_id"]}
+    batch_size = app.config["STREAM_BATCH_SIZE"]
+    cursor = collection.find(query, projection).sort("_id", DESCENDING).batch_size(batch_size)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    def encode(docs, first):
+        rows = serialize(docs)
+        if fmt == "ndjson":
+            return "".join(f"{app.json.dumps(row)}\n" for row in rows)
+        return ("" if first else ",") + ",".join(app.json.dumps(row) for row in rows)
+
+    def generate():
+        if fmt == "array":
+            yield "["
+        batch, first = [], True
+        try:
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) == batch_size:
+                    yield encode(batch, first)
+                    batch, first = [], False
+            if batch:
+                yield encode(batch, first)
+        except Exception as e:
+            # Headers are gone: the client sees a truncated body
+            logger.error(f"Error streaming {request.path}: {str(e)}")
+            return
+        finally:
+            cursor.close()
+        if fmt == "array":
+            yield "]\n"
+
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+    return app.response_class(stream_with_context(generate()), mimetype=mimetype)
+
+# Notifications are written behind the request by a background batcher
+notification_dispatcher = NotificationDispatcher(
+    lambda: mongo.db.notifications,
+    batch_size=app.config["NOTIFICATION_BATCH_SIZE"],
+    flush_interval=app.config["NOTIFICATION_FLUSH_INTERVAL"],
+    max_queue=app.config["NOTIFICATION_QUEUE_SIZE"],
+    enqueue_timeout=app.config["NOTIFICATION_ENQUEUE_TIMEOUT"],
+    retries=app.config["NOTIFICATION_WRITE_RETRIES"],
+    retry_backoff=app.config["NOTIFICATION_RETRY_BACKOFF"],
+    enabled=app.config["NOTIFICATIONS_ASYNC"]
+)
+atexit.register(notification_dispatcher.stop)
+
+# Weekly slot templates compiled from each doctor's disponibilites
+availability_engine = AvailabilityEngine(
+    cache_size=app.config["AVAILABILITY_CACHE_SIZE"],
+    cache_ttl=app.config["AVAILABILITY_CACHE_TTL"]
+)
+
+# Shared version counters, bumped by writers to invalidate per-process caches
+def read_version(name):
+    counter = mongo.db.counters.find_one({"_id": name}, {"version": 1})
+    return counter["version"] if counter else 0
+
+def bump_version(name):
+    mongo.db.counters.update_one({"_id": name}, {"$inc": {"version": 1}}, upsert=True)
+
+# Serialized /doctors payload and its strong ETag
+def build_doctor_directory():
+    doctors = mongo.db.medecins.find({}, {"nom": 1, "specialite": 1, "description": 1, "image": 1})
+    body = json.dumps([
+        {
+            "id": str(doc["_id"]),
+            "nom": doc.get("nom"),
+            "specialite": doc.get("specialite"),
+            "description": doc.get("description"),
+            "image": doc.get("image")
+        }
+        for doc in doctors
+    ])
+    return body, hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+doctor_directory = VersionedSnapshot(
+    lambda: read_version("doctors"),
+    build_doctor_directory,
+    recheck_seconds=app.config["DOCTORS_CACHE_RECHECK_SECONDS"]
+)
+
+# In-memory search index over doctor names and specialties
+doctor_search_index = VersionedSnapshot(
+    lambda: read_version("doctors"),
+    lambda: DoctorSearchIndex(mongo.db.medecins.find({}, {"nom": 1, "specialite": 1})),
+    recheck_seconds=app.config["DOCTORS_CACHE_RECHECK_SECONDS"]
+)
+
+def invalidate_doctor_caches():
+    bump_version("doctors")
+    doctor_directory.invalidate()
+    doctor_search_index.invalidate()
+
+# Periodic jobs. The scheduler is only started by the scheduler role
+# (`flask run-scheduler`) and the development server, never on import.
 scheduler = BackgroundScheduler()
-scheduler.start()
 
-# Function to send appointment reminders
-def send_appointment_reminders():
+# Appointment reminders: only the process holding the lease sends them
+def run_appointment_reminders():
     try:
-        now = datetime.utcnow()
-        reminder_window_start = now + timedelta(hours=24)
-        reminder_window_end = now + timedelta(hours=25)
-        
-        appointments = mongo.db.rendezvous.find({
-            "status": "confirmed",
-            "date": {
-                "$gte": reminder_window_start.strftime("%Y-%m-%d"),
-                "$lte": reminder_window_end.strftime("%Y-%m-%d")
-            }
-        })
-        
-        for rdv in appointments:
-            rdv_datetime = datetime.strptime(f"{rdv['date']} {rdv['heure']}", "%Y-%m-%d %H:%M")
-            if reminder_window_start <= rdv_datetime <= reminder_window_end:
-                existing_notification = mongo.db.notifications.find_one({
-                    "userId": rdv["patientId"],
-                    "titre": "Rappel de rendez-vous",
-                    "message": {
-                        "$regex": f"Rappel : votre rendez-vous avec {rdv['doctorName']} le {rdv['date']} à {rdv['heure']}"
-                    }
-                })
-                if not existing_notification:
-                    notification = {
-                        "userId": rdv["patientId"],
-                        "titre": "Rappel de rendez-vous",
-                        "message": f"Rappel : votre rendez-vous avec {rdv['doctorName']} le {rdv['date']} à {rdv['heure']} est demain.",
-                        "date": datetime.utcnow(),
-                        "read": False
-                    }
-                    mongo.db.notifications.insert_one(notification)
-                    logger.info(f"Reminder sent for appointment {rdv['_id']} to user {rdv['patientId']}")
+        lease_seconds = 2 * 60 * app.config["REMINDER_INTERVAL_MINUTES"]
+        if not acquire_lease(mongo.db, "appointment_reminders", lease_seconds):
+            return
+        notification_dispatcher.publish(send_appointment_reminders(mongo.db))
     except Exception as e:
         logger.error(f"Error in send_appointment_reminders: {str(e)}")
 
-scheduler.add_job(send_appointment_reminders, 'interval', hours=1)
+scheduler.add_job(
+    run_appointment_reminders,
+    'interval',
+    minutes=app.config["REMINDER_INTERVAL_MINUTES"]
+)
+
+# Per-doctor/per-day appointment counters backing /doctor_calendar
+def bump_occupancy(doctor_id, date, booked=0, confirmed=0):
+    mongo.db.occupancy.update_one(
+        {"doctorId": doctor_id, "date": date},
+        {"$inc": {"booked": booked, "confirmed": confirmed}},
+        upsert=True
+    )
+
+# Rebuild the occupancy counters from rendezvous to repair any drift
+def rebuild_occupancy():
+    try:
+        if not acquire_lease(mongo.db, "rebuild_occupancy", 3600):
+            return
+        mongo.db.rendezvous.aggregate([
+            {"$group": {
+                "_id": {"doctorId": "$doctorId", "date": "$date"},
+                "booked": {"$sum": 1},
+                "confirmed": {"$sum": {"$cond": [{"$eq": ["$status", "confirmed"]}, 1, 0]}}
+            }},
+            {"$project": {"_id": 0, "doctorId": "$_id.doctorId", "date": "$_id.date", "booked": 1, "confirmed": 1}},
+            {"$out": "occupancy"}
+        ])
+        logger.info("Occupancy counters rebuilt")
+    except Exception as e:
+        logger.error(f"Error in rebuild_occupancy: {str(e)}")
+
+scheduler.add_job(rebuild_occupancy, 'cron', hour=3)
 
 # WebSocket events
+def user_room(user_id):
+    return f"user:{user_id}"
+
+# Principal of each authenticated socket, resolved once at connect time
+socket_principals = {}
+
+# Presence and typing broadcasts, coalesced per room
+def emit_to_room(event, payload, room, skip_sid):
+    socketio.emit(event, payload, to=room, skip_sid=skip_sid)
+
+broadcaster = Broadcaster(
+    emit_to_room,
+    interval=app.config["SOCKET_BROADCAST_INTERVAL"],
+    enabled=app.config["SOCKET_BROADCASTS_ASYNC"]
+)
+socket_event_limiter = RateLimiter(app.config["SOCKET_EVENT_RATE"], app.config["SOCKET_EVENT_BURST"])
+typing_tracker = TypingTracker(timeout=app.config["TYPING_TIMEOUT_SECONDS"])
+
+def presence_room(user_id):
+    return f"presence:{user_id}"
+
+def publish_presence(user_id, online):
+    broadcaster.publish("presence", presence_room(user_id), user_id, {"userId": user_id, "online": online})
+
+def publish_typing(conversation_id, user_id, typing, skip_sid=None):
+    broadcaster.publish(
+        "typing", conversation_id, user_id,
+        {"conversationId": conversation_id, "userId": user_id, "typing": typing},
+        skip_sid=skip_sid
+    )
+
+@broadcaster.every_tick
+def expire_typing():
+    for conversation_id, user_id in typing_tracker.expire():
+        publish_typing(conversation_id, user_id, False)
+
+presence = PresenceRegistry(
+    lambda: mongo.db.presence,
+    publish_presence,
+    ttl=app.config["PRESENCE_TTL_SECONDS"],
+    heartbeat=app.config["PRESENCE_HEARTBEAT_SECONDS"]
+)
+
+# Doctors' presence is public; other users only to those they share a conversation with
+def watchable_users(principal, user_ids):
+    doctor_ids = [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]
+    doctors = {str(doc["_id"]) for doc in mongo.db.medecins.find({"_id": {"$in": doctor_ids}}, {"_id": 1})}
+    if principal["role"] == "medecin":
+        own_field, other_field = "doctorId", "patientId"
+    else:
+        own_field, other_field = "patientId", "doctorId"
+    contacts = set(mongo.db.conversations.distinct(
+        other_field, {own_field: principal["id"], other_field: {"$in": user_ids}}
+    ))
+    return [user_id for user_id in user_ids if user_id in doctors or user_id in contacts]
+
+# Authenticate a socket from the access token passed as connect auth or ?token=
+def socket_principal(auth):
+    token = (auth or {}).get("token") or request.args.get("token")
+    if not token:
+        return None
+    try:
+        claims = decode_token(token)
+    except Exception:
+        return None
+    return resolve_principal(claims[app.config["JWT_IDENTITY_CLAIM"]], claims)
+
 @socketio.on('connect')
-def handle_connect():
-    logger.info('Client connected')
+def handle_connect(auth=None):
+    principal = socket_principal(auth)
+    if principal:
+        # Authenticated sockets receive their notifications in a per-user room
+        join_room(user_room(principal["id"]))
+        socket_principals[request.sid] = principal
+        try:
+            presence.connect(request.sid, principal["id"])
+        except Exception as e:
+            logger.error(f"Error registering presence: {str(e)}")
+        logger.info(f'Client connected as user {principal["id"]}')
+    else:
+        logger.info('Client connected')
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    principal = socket_principals.pop(request.sid, None)
+    if principal:
+        socket_event_limiter.forget(request.sid)
+        try:
+            # The user's last socket here: whatever they were typing is abandoned
+            if presence.disconnect(request.sid):
+                for conversation_id in typing_tracker.clear_user(principal["id"]):
+                    publish_typing(conversation_id, principal["id"], False)
+        except Exception as e:
+            logger.error(f"Error unregistering presence: {str(e)}")
     logger.info('Client disconnected')
 
+# Keep an authenticated socket marked online; clients send it every
+# PRESENCE_HEARTBEAT_SECONDS
+@socketio.on('heartbeat')
+def handle_heartbeat(data=None):
+    principal = socket_principals.get(request.sid)
+    if not principal:
+        return {"error": "Authentification requise"}
+    if not socket_event_limiter.allow(request.sid):
+        return {"error": "Trop de requêtes"}
+    try:
+        if not presence.touch(request.sid):
+            # Expired after a long silence: register it again
+            presence.connect(request.sid, principal["id"])
+        return {"ok": True}
+    except Exception as e:
+        logger.error(f"Error in handle_heartbeat: {str(e)}")
+        return {"error": f"Erreur serveur : {str(e)}"}
+
+# Subscribe to presence changes of some users; the ack lists those online now
+@socketio.on('watch_presence')
+def handle_watch_presence(data):
+    principal = socket_principals.get(request.sid)
+    if not principal:
+        return {"error": "Authentification requise"}
+    if not socket_event_limiter.allow(request.sid):
+        return {"error": "Trop de requêtes"}
+    user_ids = (data or {}).get("userIds")
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+        return {"error": "userIds invalide"}
+    if len(user_ids) > app.config["PRESENCE_WATCH_LIMIT"]:
+        return {"error": f"Au plus {app.config['PRESENCE_WATCH_LIMIT']} utilisateurs"}
+
+    try:
+        user_ids = watchable_users(principal, list(dict.fromkeys(user_ids)))
+        for user_id in user_ids:
+            join_room(presence_room(user_id))
+        online = presence.online(user_ids)
+        return {"online": [user_id for user_id in user_ids if user_id in online], "watching": user_ids}
+    except Exception as e:
+        logger.error(f"Error in handle_watch_presence: {str(e)}")
+        return {"error": f"Erreur serveur : {str(e)}"}
+
+# Typing indicator: clients send typing true while the user types (a few times
+# per timeout at most) and false when they stop. Only changes are broadcast.
+@socketio.on('typing')
+def handle_typing(data):
+    principal = socket_principals.get(request.sid)
+    if not principal or not socket_event_limiter.allow(request.sid):
+        return
+    data = data or {}
+    conversation_id = str(data.get("conversationId") or "")
+    try:
+        conversation = find_conversation(conversation_id)
+        if not conversation or principal["id"] not in (conversation["patientId"], conversation["doctorId"]):
+            return
+        presence.touch(request.sid)
+        typing = bool(data.get("typing", True))
+        if typing_tracker.update(conversation_id, principal["id"], typing):
+            publish_typing(conversation_id, principal["id"], typing, skip_sid=request.sid)
+    except Exception as e:
+        logger.error(f"Error in handle_typing: {str(e)}")
+
+# Receive a conversation's messages; only its patient and doctor may join
 @socketio.on('join_conversation')
 def handle_join_conversation(data):
-    conversation_id = data.get('conversationId')
+    principal = socket_principals.get(request.sid)
+    if not principal:
+        return {"error": "Authentification requise"}
+    conversation_id = str((data or {}).get('conversationId') or "")
     if not conversation_id:
         logger.error('No conversationId provided for join_conversation')
-        return
-    join_room(conversation_id)
-    logger.info(f'Client joined conversation room {conversation_id}')
+        return {"error": "conversationId requis"}
+    try:
+        conversation = find_conversation(conversation_id)
+        if not conversation:
+            return {"error": "Conversation non trouvée"}
+        if principal["id"] not in (conversation["patientId"], conversation["doctorId"]):
+            return {"error": "Accès refusé"}
+        join_room(conversation_id)
+        logger.info(f'Client joined conversation room {conversation_id}')
+        return {"ok": True}
+    except Exception as e:
+        logger.error(f"Error in handle_join_conversation: {str(e)}")
+        return {"error": f"Erreur serveur : {str(e)}"}
+
+# Send a chat message over the socket. The ack carries the stored id; clients
+# may pass a clientId so that a retried send is not stored twice.
+@socketio.on('send_message')
+def handle_send_message(data):
+    principal = socket_principals.get(request.sid)
+    if not principal:
+        return {"error": "Authentification requise"}
+    data = data or {}
+    conversation_id = str(data.get("conversationId") or "")
+    content = data.get("content")
+    client_id = data.get("clientId")
+    msg_type = data.get("type", "text")
+    content_error = message_content_error(content, msg_type)
+    if content_error:
+        return {"error": content_error}
+    if client_id is not None and not isinstance(client_id, str):
+        return {"error": "clientId invalide"}
+
+    try:
+        conversation = find_conversation(conversation_id)
+        if not conversation:
+            return {"error": "Conversation non trouvée"}
+        if principal["id"] not in (conversation["patientId"], conversation["doctorId"]):
+            return {"error": "Accès refusé"}
+
+        message, created = store_message(conversation, principal, content, msg_type, client_id)
+        if created:
+            # The sender's other devices get it too; this socket has the ack
+            emit('new_message', message_event(message), room=conversation_id, include_self=False)
+        presence.touch(request.sid)
+        if typing_tracker.update(conversation_id, principal["id"], False):
+            publish_typing(conversation_id, principal["id"], False, skip_sid=request.sid)
+        return {
+            "id": message["_id"],
+            "conversationId": conversation_id,
+            "timestamp": message["timestamp"],
+            "clientId": client_id
+        }
+    except Exception as e:
+        logger.error(f"Error in handle_send_message: {str(e)}")
+        return {"error": f"Erreur serveur : {str(e)}"}
+
+# Materialized unread notification counters, one document per user
+def bump_unread(deltas):
+    operations = [
+        UpdateOne({"_id": user_id}, {"$inc": {"unread": delta}}, upsert=True)
+        for user_id, delta in deltas.items()
+        if delta
+    ]
+    if operations:
+        mongo.db.unread_counters.bulk_write(operations, ordered=False)
+
+def get_unread_counts(user_ids):
+    counts = {user_id: 0 for user_id in user_ids}
+    for counter in mongo.db.unread_counters.find({"_id": {"$in": list(counts)}}):
+        counts[counter["_id"]] = max(counter.get("unread", 0), 0)
+    return counts
+
+# Rebuild the unread counters from notifications to repair any drift
+def rebuild_unread_counters():
+    try:
+        if not acquire_lease(mongo.db, "rebuild_unread_counters", 3600):
+            return
+        mongo.db.notifications.aggregate([
+            {"$match": {"read": False}},
+            {"$group": {"_id": "$userId", "unread": {"$sum": 1}}},
+            {"$out": "unread_counters"}
+        ])
+        logger.info("Unread notification counters rebuilt")
+    except Exception as e:
+        logger.error(f"Error in rebuild_unread_counters: {str(e)}")
+
+scheduler.add_job(rebuild_unread_counters, 'cron', hour=3, minute=30)
+
+# Notification retention: move old and excess notifications to the archive
+def run_notification_archive():
+    try:
+        if not acquire_lease(mongo.db, "notification_archive", 3600):
+            return
+        read_before = datetime.utcnow() - timedelta(days=app.config["NOTIFICATION_ARCHIVE_DAYS"])
+        archived, unread = archive_notifications(mongo.db, read_before, app.config["NOTIFICATION_MAX_PER_USER"])
+        bump_unread({user_id: -count for user_id, count in unread.items()})
+        return archived
+    except Exception as e:
+        logger.error(f"Error in run_notification_archive: {str(e)}")
+
+scheduler.add_job(run_notification_archive, 'cron', hour=4)
+
+# Delete stored files no document or consultation refers to any more
+def run_storage_gc():
+    try:
+        if not acquire_lease(mongo.db, "storage_gc", 3600):
+            return
+        grace = timedelta(minutes=app.config["STORAGE_GC_GRACE_MINUTES"])
+        return content_store.collect_garbage(grace)
+    except Exception as e:
+        logger.error(f"Error in run_storage_gc: {str(e)}")
+
+scheduler.add_job(run_storage_gc, 'cron', hour=4, minute=30)
+
+@notification_dispatcher.on_insert
+def count_unread_notifications(notifications):
+    bump_unread(Counter(n["userId"] for n in notifications if not n.get("read")))
+
+# Push every stored notification to its recipient's sockets
+@notification_dispatcher.on_insert
+def push_notifications(notifications):
+    unread_counts = get_unread_counts({n["userId"] for n in notifications})
+    for n in notifications:
+        socketio.emit(
+            'notification',
+            {**notification_row(n), "unreadCount": unread_counts[n["userId"]]},
+            room=user_room(n["userId"])
+        )
 
 # Enregistrement d'un utilisateur
 @app.route("/register", methods=["POST"])
@@ -118,6 +723,9 @@ def register():
                 "disponibilites": {}
             }
             result = mongo.db.medecins.insert_one(new_user)
+            new_user["_id"] = result.inserted_id
+            principal = build_principal(new_user, is_doctor=True)
+            invalidate_doctor_caches()
         else:
             new_user = {
                 "name": name,
@@ -126,9 +734,11 @@ def register():
                 "role": role
             }
             result = mongo.db.users.insert_one(new_user)
+            new_user["_id"] = result.inserted_id
+            principal = build_principal(new_user, is_doctor=False)
 
         user_id = str(result.inserted_id)
-        token = create_access_token(identity=email)
+        token = issue_token(principal)
 
         return jsonify({
             "message": "Utilisateur créé avec succès",
@@ -152,7 +762,7 @@ def login():
         if user:
             if not check_password_hash(user["password"], password):
                 return jsonify({"message": "Mot de passe incorrect"}), 401
-            token = create_access_token(identity=email)
+            token = issue_token(build_principal(user, is_doctor=False))
             return jsonify({
                 "token": token,
                 "user_id": str(user["_id"]),
@@ -164,7 +774,7 @@ def login():
         if medecin:
             if not check_password_hash(medecin["password"], password):
                 return jsonify({"message": "Mot de passe incorrect"}), 401
-            token = create_access_token(identity=email)
+            token = issue_token(build_principal(medecin, is_doctor=True))
             return jsonify({
                 "token": token,
                 "user_id": str(medecin["_id"]),
@@ -186,10 +796,15 @@ def login():
 @jwt_required()
 def get_profile():
     try:
-        email = get_jwt_identity()
-        # Check users collection (patients)
-        user = mongo.db.users.find_one({"email": email})
-        if user:
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+
+        # Patients live in users, doctors in medecins
+        if not is_doctor(principal):
+            user = mongo.db.users.find_one({"_id": ObjectId(principal["id"])})
+            if not user:
+                return jsonify({"message": "Utilisateur non trouvé"}), 404
             return jsonify({
                 "_id": str(user["_id"]),
                 "name": user["name"],
@@ -197,8 +812,7 @@ def get_profile():
                 "role": user["role"]
             }), 200
 
-        # Check medecins collection (doctors)
-        doctor = mongo.db.medecins.find_one({"email": email})
+        doctor = mongo.db.medecins.find_one({"_id": ObjectId(principal["id"])})
         if doctor:
             return jsonify({
                 "_id": str(doctor["_id"]),
@@ -221,8 +835,11 @@ def get_profile():
 @jwt_required()
 def get_doctor_profile():
     try:
-        email = get_jwt_identity()
-        medecin = mongo.db.medecins.find_one({"email": email})
+        principal = current_principal()
+        if not is_doctor(principal):
+            return jsonify({"message": "Médecin non trouvé"}), 404
+
+        medecin = mongo.db.medecins.find_one({"_id": ObjectId(principal["id"])})
         if not medecin:
             return jsonify({"message": "Médecin non trouvé"}), 404
 
@@ -245,6 +862,10 @@ def get_doctor_profile():
 def update_doctor_profile():
     try:
         email = get_jwt_identity()
+        principal = current_principal()
+        if not is_doctor(principal):
+            return jsonify({"message": "Médecin non trouvé"}), 404
+
         data = request.get_json()
         nom = data.get("nom")
         email_new = data.get("email")
@@ -264,10 +885,17 @@ def update_doctor_profile():
         }
 
         mongo.db.medecins.update_one(
-            {"email": email},
+            {"_id": ObjectId(principal["id"])},
             {"$set": update_data}
         )
-        return jsonify({"message": "Profil mis à jour"}), 200
+        # Conversations carry both parties' names for the inbox
+        mongo.db.conversations.update_many({"doctorId": principal["id"]}, {"$set": {"doctorName": nom}})
+
+        invalidate_doctor_caches()
+
+        principal = {**principal, "name": nom, "email": email_new}
+        refresh_principal(email, principal)
+        return jsonify({"message": "Profil mis à jour", "token": issue_token(principal)}), 200
 
     except Exception as e:
         logger.error(f"Error in update_doctor_profile: {str(e)}")
@@ -277,48 +905,60 @@ def update_doctor_profile():
 @app.route("/doctors", methods=["GET"])
 def get_doctors():
     try:
-        doctors = mongo.db.medecins.find()
-        doctors_list = [
-            {
-                "id": str(doc["_id"]),
-                "nom": doc.get("nom"),
-                "specialite": doc.get("specialite"),
-                "description": doc.get("description"),
-                "image": doc.get("image")
-            }
-            for doc in doctors
-        ]
-        return jsonify(doctors_list), 200
+        body, etag = doctor_directory.get()
+        response = app.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
 
     except Exception as e:
         logger.error(f"Error in get_doctors: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
 
-# Rechercher un médecin par nom
+# Rechercher un médecin par nom ou spécialité (?name= ou ?q=, résultats classés)
 @app.route("/search_doctors", methods=["GET"])
 def search_doctors():
     try:
-        search_term = request.args.get("name", "").lower()
+        search_term = request.args.get("q") or request.args.get("name", "")
 
-        if not search_term:
+        if not search_term.strip():
             return jsonify({"message": "Le terme de recherche est requis"}), 400
+        if len("".join(tokenize(search_term))) < app.config["SEARCH_MIN_QUERY_LENGTH"]:
+            return jsonify({
+                "message": f"Le terme de recherche doit contenir au moins {app.config['SEARCH_MIN_QUERY_LENGTH']} caractères"
+            }), 400
 
-        doctors = mongo.db.medecins.find({
-            "nom": {"$regex": search_term, "$options": "i"}
-        })
+        try:
+            limit = min(int(request.args.get("limit", app.config["PAGE_SIZE"])), app.config["MAX_PAGE_SIZE"])
+            offset = int(request.args.get("offset", 0))
+        except ValueError:
+            return invalid_page_response()
+        if limit < 1 or offset < 0:
+            return invalid_page_response()
+
+        ranked, total = doctor_search_index.get().search(search_term, limit=offset + limit)
+        page = ranked[offset:]
+        doctors = fetch_by_ids(
+            mongo.db.medecins,
+            [doctor_id for doctor_id, _ in page],
+            {"nom": 1, "specialite": 1, "description": 1, "image": 1}
+        )
 
         doctors_list = [
             {
-                "id": str(doc["_id"]),
+                "id": doctor_id,
                 "nom": doc.get("nom"),
                 "specialite": doc.get("specialite"),
                 "description": doc.get("description"),
-                "image": doc.get("image")
+                "image": doc.get("image"),
+                "score": round(score, 3)
             }
-            for doc in doctors
+            for doctor_id, score in page
+            for doc in [doctors.get(doctor_id)]
+            if doc
         ]
 
-        return jsonify(doctors_list), 200
+        return jsonify(doctors_list), 200, {"X-Total-Count": str(total)}
 
     except Exception as e:
         logger.error(f"Error in search_doctors: {str(e)}")
@@ -345,6 +985,7 @@ def add_doctor():
             "image": image,
             "disponibilites": {}
         })
+        invalidate_doctor_caches()
 
         return jsonify({"message": "Docteur ajouté avec succès"}), 201
 
@@ -371,147 +1012,105 @@ def get_doctor(doctor_id):
         logger.error(f"Error in get_doctor: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
 
-# Get available slots for a specific doctor on a specific date
+# Get available slots for a specific doctor on a date (?date=) or a range of dates (?from=&to=)
 @app.route("/doctor_availability/<doctor_id>", methods=["GET"])
 def get_doctor_availability(doctor_id):
     try:
         date = request.args.get("date")
-        
-        if not date:
+        date_from = request.args.get("from", date)
+        date_to = request.args.get("to", date_from)
+
+        if not date_from:
             return jsonify({"message": "Date parameter is required"}), 400
-            
+
         try:
-            selected_date = datetime.strptime(date, "%Y-%m-%d")
+            start_date = datetime.strptime(date_from, "%Y-%m-%d").date()
+            end_date = datetime.strptime(date_to, "%Y-%m-%d").date()
         except ValueError:
             return jsonify({"message": "Invalid date format. Use YYYY-MM-DD"}), 400
-            
-        doctor = mongo.db.medecins.find_one({"_id": ObjectId(doctor_id)})
+
+        if end_date < start_date or (end_date - start_date).days >= app.config["AVAILABILITY_MAX_DAYS"]:
+            return jsonify({"message": f"Invalid range. At most {app.config['AVAILABILITY_MAX_DAYS']} days"}), 400
+
+        doctor = mongo.db.medecins.find_one({"_id": ObjectId(doctor_id)}, {"nom": 1, "disponibilites": 1})
         if not doctor:
             return jsonify({"message": "Médecin non trouvé"}), 404
-            
-        booked_slots = mongo.db.rendezvous.find({
-            "doctorId": doctor_id,
-            "date": date
-        })
-        
-        booked_times = [slot["heure"] for slot in booked_slots]
-        
-        all_slots = []
-        
-        current_time = datetime.strptime("08:00", "%H:%M")
-        end_morning = datetime.strptime("12:00", "%H:%M")
-        
-        while current_time < end_morning:
-            slot_end = current_time + timedelta(minutes=30)
-            slot_str = current_time.strftime("%H:%M")
-            
-            if slot_str not in booked_times:
-                all_slots.append({
-                    "start": slot_str,
-                    "end": slot_end.strftime("%H:%M"),
-                    "available": True
-                })
-            else:
-                all_slots.append({
-                    "start": slot_str,
-                    "end": slot_end.strftime("%H:%M"),
-                    "available": False
-                })
-                
-            current_time = slot_end + timedelta(minutes=5)
-        
-        current_time = datetime.strptime("13:00", "%H:%M")
-        end_afternoon = datetime.strptime("18:00", "%H:%M")
-        
-        while current_time < end_afternoon:
-            slot_end = current_time + timedelta(minutes=30)
-            slot_str = current_time.strftime("%H:%M")
-            
-            if slot_str not in booked_times:
-                all_slots.append({
-                    "start": slot_str,
-                    "end": slot_end.strftime("%H:%M"),
-                    "available": True
-                })
-            else:
-                all_slots.append({
-                    "start": slot_str,
-                    "end": slot_end.strftime("%H:%M"),
-                    "available": False
-                })
-                
-            current_time = slot_end + timedelta(minutes=5)
-            
+
+        booked = mongo.db.rendezvous.find(
+            {"doctorId": doctor_id, "date": {"$gte": date_from, "$lte": date_to}},
+            {"_id": 0, "date": 1, "heure": 1}
+        )
+        days = availability_engine.days(doctor_id, doctor.get("disponibilites"), booked, start_date, end_date)
+
+        if date and "from" not in request.args:
+            return jsonify({
+                "date": date,
+                "doctorId": doctor_id,
+                "doctorName": doctor.get("nom", ""),
+                "slots": days[0]["slots"]
+            }), 200
+
         return jsonify({
-            "date": date,
+            "from": date_from,
+            "to": date_to,
             "doctorId": doctor_id,
             "doctorName": doctor.get("nom", ""),
-            "slots": all_slots
+            "days": days
         }), 200
-        
+
     except Exception as e:
         logger.error(f"Error in get_doctor_availability: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
 
 # Get calendar view of doctor availability for a month
-@app.route("/doctor_calendar/<doctor_id>", methods=["GET", "POST"])
+@app.route("/doctor_calendar/<doctor_id>", methods=["GET"])
 def get_doctor_calendar(doctor_id):
     try:
         year = int(request.args.get("year", datetime.now().year))
         month = int(request.args.get("month", datetime.now().month))
-        
-        doctor = mongo.db.medecins.find_one({"_id": ObjectId(doctor_id)})
+
+        doctor = mongo.db.medecins.find_one({"_id": ObjectId(doctor_id)}, {"nom": 1, "disponibilites": 1})
         if not doctor:
             return jsonify({"message": "Médecin non trouvé"}), 404
-            
+
         first_day = datetime(year, month, 1)
-        
+
         if month == 12:
             last_day = datetime(year + 1, 1, 1) - timedelta(days=1)
         else:
             last_day = datetime(year, month + 1, 1) - timedelta(days=1)
-            
-        start_date = first_day.strftime("%Y-%m-%d")
-        end_date = last_day.strftime("%Y-%m-%d")
-        
-        appointments = mongo.db.rendezvous.find({
-            "doctorId": doctor_id,
-            "date": {"$gte": start_date, "$lte": end_date}
-        })
-        
-        appointments_per_day = {}
-        for appt in appointments:
-            date = appt["date"]
-            if date in appointments_per_day:
-                appointments_per_day[date] += 1
-            else:
-                appointments_per_day[date] = 1
-                
+
+        occupancy = {
+            day["date"]: day
+            for day in mongo.db.occupancy.find(
+                {"doctorId": doctor_id, "date": {"$gte": f"{year:04d}-{month:02d}-01", "$lte": f"{year:04d}-{month:02d}-31"}},
+                {"_id": 0, "date": 1, "booked": 1, "confirmed": 1}
+            )
+        }
+        week = availability_engine.weekly_template(doctor_id, doctor.get("disponibilites"))
+
         calendar_data = []
-        current_date = first_day
-        
-        max_slots = 18
-        
-        while current_date <= last_day:
-            date_str = current_date.strftime("%Y-%m-%d")
-            booked_count = appointments_per_day.get(date_str, 0)
-            
+        for day in range(1, last_day.day + 1):
+            date_str = f"{year:04d}-{month:02d}-{day:02d}"
+            counts = occupancy.get(date_str, {})
+            booked_count = max(counts.get("booked", 0), 0)
+            max_slots = len(week[first_day.replace(day=day).weekday()].slots)
+
             status = "available"
             if booked_count >= max_slots:
                 status = "unavailable"
             elif booked_count > 0:
                 status = "partial"
-                
+
             calendar_data.append({
                 "date": date_str,
-                "day": current_date.day,
+                "day": day,
                 "status": status,
                 "booked": booked_count,
+                "confirmed": max(counts.get("confirmed", 0), 0),
                 "total": max_slots
             })
-            
-            current_date += timedelta(days=1)
-            
+
         return jsonify({
             "doctorId": doctor_id,
             "doctorName": doctor.get("nom", ""),
@@ -519,20 +1118,62 @@ def get_doctor_calendar(doctor_id):
             "month": month,
             "calendar": calendar_data
         }), 200
-        
+
     except Exception as e:
         logger.error(f"Error in get_doctor_calendar: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
 
+# A booking starts exactly on one of the slots of the doctor's weekly template.
+# Returns ((date, slot start), None) in canonical form, or (None, error message).
+def booking_slot(doctor, date, heure):
+    try:
+        moment = datetime.strptime(f"{date} {heure}", "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return None, "Format de date/heure invalide"
+    if moment < datetime.now():
+        return None, "La date/heure doit être dans le futur"
+    slot = moment.strftime("%H:%M")
+    week = availability_engine.weekly_template(str(doctor["_id"]), doctor.get("disponibilites"))
+    if not week[moment.weekday()].bit(slot):
+        return None, "Ce créneau n'est pas proposé par le médecin"
+    return (moment.strftime("%Y-%m-%d"), slot), None
+
+# Give appointments booked before `slot` was stored their slot. Where the old
+# code let two appointments take the same slot, the confirmed (else the oldest)
+# one keeps it and the others are flagged `slotConflict` for manual resolution.
+def backfill_booking_slots():
+    filled, conflicts = 0, []
+    for status in ({"status": "confirmed"}, {"status": {"$ne": "confirmed"}}):
+        legacy = mongo.db.rendezvous.find(
+            {"slot": {"$exists": False}, "slotConflict": {"$exists": False}, **status},
+            {"heure": 1}
+        ).sort("_id", ASCENDING)
+        for rdv in legacy:
+            try:
+                slot = datetime.strptime(rdv.get("heure", ""), "%H:%M").strftime("%H:%M")
+            except (TypeError, ValueError):
+                slot = rdv.get("heure")
+            try:
+                mongo.db.rendezvous.update_one({"_id": rdv["_id"]}, {"$set": {"slot": slot}})
+                filled += 1
+            except DuplicateKeyError:
+                mongo.db.rendezvous.update_one({"_id": rdv["_id"]}, {"$set": {"slotConflict": True}})
+                conflicts.append(rdv["_id"])
+    return filled, conflicts
+
+def warn_unslotted_bookings():
+    if mongo.db.rendezvous.find_one({"slot": {"$exists": False}, "slotConflict": {"$exists": False}}, {"_id": 1}):
+        logger.warning("Appointments without a slot are not protected against double booking: "
+                       "run `flask backfill-booking-slots`")
+
 # Créer un rendez-vous
 @app.route("/rendezvous", methods=["POST"])
 @jwt_required()
 def create_rdv():
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
+        user = current_principal()
 
-        if not user:
+        if not user or is_doctor(user):
             return jsonify({"message": "Utilisateur non trouvé"}), 404
 
         data = request.get_json()
@@ -544,63 +1185,50 @@ def create_rdv():
         if not doctor:
             return jsonify({"message": "Médecin non trouvé"}), 404
 
-        try:
-            rdv_datetime = datetime.strptime(f"{data['date']} {data['heure']}", "%Y-%m-%d %H:%M")
-            if rdv_datetime < datetime.now():
-                return jsonify({"message": "La date/heure doit être dans le futur"}), 400
-                
-            hour, minute = map(int, data['heure'].split(':'))
-            if (hour < 8 or (hour == 12) or (hour >= 18) or 
-                (hour > 11 and hour < 13)):
-                return jsonify({"message": "Horaire invalide. Les consultations sont disponibles de 8h à 12h et de 13h à 18h"}), 400
-                
-            if minute % 5 != 0:
-                return jsonify({"message": "Les horaires doivent être en tranches de 5 minutes"}), 400
-                
-            existing_rdv = mongo.db.rendezvous.find_one({
-                "doctorId": data["doctorId"],
-                "date": data["date"],
-                "heure": data["heure"]
-            })
-            
-            if existing_rdv:
-                return jsonify({"message": "Ce créneau horaire est déjà réservé"}), 409
-                
-        except ValueError:
-            return jsonify({"message": "Format de date/heure invalide"}), 400
+        slot, error = booking_slot(doctor, data["date"], data["heure"])
+        if error:
+            return jsonify({"message": error}), 400
+        date, heure = slot
 
         rendezvous = {
-            "patientId": str(user["_id"]),
+            "patientId": user["id"],
             "patientName": user["name"],
             "doctorId": data["doctorId"],
             "doctorName": doctor["nom"],
-            "date": data["date"],
-            "heure": data["heure"],
+            "date": date,
+            "heure": heure,
+            "slot": heure,
             "createdAt": datetime.utcnow(),
             "status": "pending"
         }
 
-        result = mongo.db.rendezvous.insert_one(rendezvous)
+        # The unique (doctorId, date, slot) index arbitrates concurrent bookings
+        try:
+            result = mongo.db.rendezvous.insert_one(rendezvous)
+        except DuplicateKeyError:
+            return jsonify({"message": "Ce créneau horaire est déjà réservé"}), 409
+
+        bump_occupancy(data["doctorId"], date, booked=1)
 
         # Create notification for the doctor
         doctor_notification = {
             "userId": str(doctor["_id"]),
             "titre": "Nouveau rendez-vous",
-            "message": f"Un rendez-vous a été pris par {user['name']} pour le {data['date']} à {data['heure']}.",
+            "message": f"Un rendez-vous a été pris par {user['name']} pour le {date} à {heure}.",
             "date": datetime.utcnow(),
             "read": False
         }
-        mongo.db.notifications.insert_one(doctor_notification)
+        notification_dispatcher.enqueue(doctor_notification)
 
         # Create notification for the patient
         patient_notification = {
-            "userId": str(user["_id"]),
+            "userId": user["id"],
             "titre": "Rendez-vous en attente",
-            "message": f"Votre rendez-vous avec {doctor['nom']} le {data['date']} à {data['heure']} est en attente de confirmation.",
+            "message": f"Votre rendez-vous avec {doctor['nom']} le {date} à {heure} est en attente de confirmation.",
             "date": datetime.utcnow(),
             "read": False
         }
-        mongo.db.notifications.insert_one(patient_notification)
+        notification_dispatcher.enqueue(patient_notification)
 
         return jsonify({
             "message": "Rendez-vous créé avec succès",
@@ -619,29 +1247,38 @@ def create_rdv():
 @jwt_required()
 def get_user_rdvs():
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
+        user = current_principal()
 
-        if not user:
+        if not user or is_doctor(user):
             return jsonify({"message": "Utilisateur non trouvé"}), 404
 
-        rdvs = mongo.db.rendezvous.find({"patientId": str(user["_id"])})
-        
+        page = read_page_args()
+        if page is None:
+            return invalid_page_response()
+
+        rdvs, page_headers = find_page(
+            mongo.db.rendezvous,
+            {"patientId": user["id"]},
+            {"doctorId": 1, "date": 1, "heure": 1, "status": 1, "createdAt": 1},
+            page
+        )
+        doctors = fetch_by_ids(
+            mongo.db.medecins,
+            {rdv["doctorId"] for rdv in rdvs},
+            {"nom": 1, "specialite": 1}
+        )
+
         rdv_list = []
         for rdv in rdvs:
-            doctor = mongo.db.medecins.find_one({"_id": ObjectId(rdv["doctorId"])})
-            rdv_list.append({
-                "_id": str(rdv["_id"]),
-                "doctorId": rdv["doctorId"],
-                "doctorName": doctor["nom"] if doctor else "Médecin inconnu",
-                "specialite": doctor["specialite"] if doctor else "",
-                "date": rdv["date"],
-                "heure": rdv["heure"],
-                "status": rdv["status"],
-                "createdAt": rdv.get("createdAt", "").strftime("%Y-%m-%d %H:%M") if rdv.get("createdAt") else ""
-            })
+            doctor = doctors.get(rdv["doctorId"])
+            rdv_list.append(appointment_row(
+                rdv,
+                doctorId=rdv["doctorId"],
+                doctorName=doctor["nom"] if doctor else "Médecin inconnu",
+                specialite=doctor.get("specialite", "") if doctor else ""
+            ))
 
-        return jsonify(rdv_list), 200
+        return jsonify(rdv_list), 200, page_headers
 
     except Exception as e:
         logger.error(f"Error in get_user_rdvs: {str(e)}")
@@ -652,28 +1289,36 @@ def get_user_rdvs():
 @jwt_required()
 def get_doctor_rdvs():
     try:
-        current_user_email = get_jwt_identity()
-        doctor = mongo.db.medecins.find_one({"email": current_user_email})
+        doctor = current_principal()
 
-        if not doctor:
+        if not is_doctor(doctor):
             return jsonify({"message": "Médecin non trouvé"}), 404
 
-        rdvs = mongo.db.rendezvous.find({"doctorId": str(doctor["_id"])})
-        
-        rdv_list = []
-        for rdv in rdvs:
-            patient = mongo.db.users.find_one({"_id": ObjectId(rdv["patientId"])})
-            rdv_list.append({
-                "_id": str(rdv["_id"]),
-                "patientId": rdv["patientId"],
-                "patientName": patient["name"] if patient else "Patient inconnu",
-                "date": rdv["date"],
-                "heure": rdv["heure"],
-                "status": rdv["status"],
-                "createdAt": rdv.get("createdAt", "").strftime("%Y-%m-%d %H:%M") if rdv.get("createdAt") else ""
-            })
+        page = read_page_args()
+        if page is None:
+            return invalid_page_response()
 
-        return jsonify(rdv_list), 200
+        query = {"doctorId": doctor["id"]}
+        projection = {"patientId": 1, "date": 1, "heure": 1, "status": 1, "createdAt": 1}
+
+        def serialize(rdvs):
+            patients = fetch_by_ids(mongo.db.users, {rdv["patientId"] for rdv in rdvs}, {"name": 1})
+            rdv_list = []
+            for rdv in rdvs:
+                patient = patients.get(rdv["patientId"])
+                rdv_list.append(appointment_row(
+                    rdv,
+                    patientId=rdv["patientId"],
+                    patientName=patient["name"] if patient else "Patient inconnu"
+                ))
+            return rdv_list
+
+        fmt = stream_format()
+        if fmt:
+            return stream_rows(fmt, mongo.db.rendezvous, query, projection, page, serialize)
+
+        rdvs, page_headers = find_page(mongo.db.rendezvous, query, projection, page)
+        return jsonify(serialize(rdvs)), 200, page_headers
 
     except Exception as e:
         logger.error(f"Error in get_doctor_rdvs: {str(e)}")
@@ -684,17 +1329,16 @@ def get_doctor_rdvs():
 @jwt_required()
 def update_rdv_status(rdv_id):
     try:
-        current_user_email = get_jwt_identity()
-        doctor = mongo.db.medecins.find_one({"email": current_user_email})
+        doctor = current_principal()
 
-        if not doctor:
+        if not is_doctor(doctor):
             return jsonify({"message": "Médecin non trouvé"}), 404
 
         rdv = mongo.db.rendezvous.find_one({"_id": ObjectId(rdv_id)})
         if not rdv:
             return jsonify({"message": "Rendez-vous non trouvé"}), 404
 
-        if rdv["doctorId"] != str(doctor["_id"]):
+        if rdv["doctorId"] != doctor["id"]:
             return jsonify({"message": "Accès refusé"}), 403
 
         data = request.get_json()
@@ -702,21 +1346,27 @@ def update_rdv_status(rdv_id):
         if not status or status not in ["pending", "confirmed", "cancelled"]:
             return jsonify({"message": "Statut invalide"}), 400
 
-        mongo.db.rendezvous.update_one(
+        # Read the previous status atomically so concurrent updates count once
+        previous = mongo.db.rendezvous.find_one_and_update(
             {"_id": ObjectId(rdv_id)},
-            {"$set": {"status": status}}
+            {"$set": {"status": status}},
+            projection={"status": 1}
         )
+        if previous:
+            confirmed_delta = (status == "confirmed") - (previous.get("status") == "confirmed")
+            if confirmed_delta:
+                bump_occupancy(rdv["doctorId"], rdv["date"], confirmed=confirmed_delta)
 
         patient = mongo.db.users.find_one({"_id": ObjectId(rdv["patientId"])})
         if patient:
             notification = {
                 "userId": str(rdv["patientId"]),
                 "titre": f"Rendez-vous {status}",
-                "message": f"Votre rendez-vous avec {doctor['nom']} le {rdv['date']} à {rdv['heure']} a été {status}.",
+                "message": f"Votre rendez-vous avec {doctor['name']} le {rdv['date']} à {rdv['heure']} a été {status}.",
                 "date": datetime.utcnow(),
                 "read": False
             }
-            mongo.db.notifications.insert_one(notification)
+            notification_dispatcher.enqueue(notification)
 
         return jsonify({"message": "Statut du rendez-vous mis à jour"}), 200
 
@@ -729,30 +1379,40 @@ def update_rdv_status(rdv_id):
 @jwt_required()
 def delete_rdv(rdv_id):
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
-        doctor = mongo.db.medecins.find_one({"email": current_user_email})
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
 
         rdv = mongo.db.rendezvous.find_one({"_id": ObjectId(rdv_id)})
         if not rdv:
             return jsonify({"message": "Rendez-vous non trouvé"}), 404
 
-        if (user and str(rdv["patientId"]) != str(user["_id"])) and (doctor and rdv["doctorId"] != str(doctor["_id"])):
+        if str(rdv["patientId"]) != principal["id"] and rdv["doctorId"] != principal["id"]:
             return jsonify({"message": "Accès refusé"}), 403
 
-        if doctor and rdv["doctorId"] == str(doctor["_id"]):
-            patient = mongo.db.users.find_one({"_id": ObjectId(rdv["patientId"])})
+        if is_doctor(principal) and rdv["doctorId"] == principal["id"]:
+            patient = mongo.db.users.find_one({"_id": ObjectId(rdv["patientId"])}, {"_id": 1})
             if patient:
                 notification = {
                     "userId": str(rdv["patientId"]),
                     "titre": "Rendez-vous annulé",
-                    "message": f"Votre rendez-vous avec {doctor['nom']} le {rdv['date']} à {rdv['heure']} a été annulé.",
+                    "message": f"Votre rendez-vous avec {principal['name']} le {rdv['date']} à {rdv['heure']} a été annulé.",
                     "date": datetime.utcnow(),
                     "read": False
                 }
-                mongo.db.notifications.insert_one(notification)
+                notification_dispatcher.enqueue(notification)
 
-        mongo.db.rendezvous.delete_one({"_id": ObjectId(rdv_id)})
+        deleted = mongo.db.rendezvous.find_one_and_delete(
+            {"_id": ObjectId(rdv_id)},
+            projection={"doctorId": 1, "date": 1, "status": 1}
+        )
+        if deleted:
+            bump_occupancy(
+                deleted["doctorId"],
+                deleted["date"],
+                booked=-1,
+                confirmed=-1 if deleted.get("status") == "confirmed" else 0
+            )
         return jsonify({"message": "Rendez-vous supprimé"}), 200
 
     except Exception as e:
@@ -764,8 +1424,9 @@ def delete_rdv(rdv_id):
 @jwt_required()
 def update_rendezvous(rdv_id):
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
+        user = current_principal()
+        if not user:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
 
         data = request.get_json()
         date = data.get('date')
@@ -778,24 +1439,40 @@ def update_rendezvous(rdv_id):
         if not rdv:
             return jsonify({"message": "Rendez-vous non trouvé"}), 404
 
-        if str(rdv["patientId"]) != str(user["_id"]):
+        if str(rdv["patientId"]) != user["id"]:
             return jsonify({"message": "Accès refusé"}), 403
 
-        mongo.db.rendezvous.update_one(
-            {"_id": ObjectId(rdv_id)},
-            {"$set": {"date": date, "heure": heure}}
-        )
+        doctor = mongo.db.medecins.find_one({"_id": ObjectId(rdv["doctorId"])}, {"nom": 1, "disponibilites": 1})
+        if not doctor:
+            return jsonify({"message": "Médecin non trouvé"}), 404
+        slot, error = booking_slot(doctor, date, heure)
+        if error:
+            return jsonify({"message": error}), 400
+        date, heure = slot
 
-        doctor = mongo.db.medecins.find_one({"_id": ObjectId(rdv["doctorId"])})
-        if doctor:
-            notification = {
-                "userId": str(doctor["_id"]),
-                "titre": "Rendez-vous modifié",
-                "message": f"Le rendez-vous avec {user['name']} a été modifié pour le {date} à {heure}.",
-                "date": datetime.utcnow(),
-                "read": False
-            }
-            mongo.db.notifications.insert_one(notification)
+        try:
+            previous = mongo.db.rendezvous.find_one_and_update(
+                {"_id": ObjectId(rdv_id)},
+                {"$set": {"date": date, "heure": heure, "slot": heure}, "$unset": {"slotConflict": ""}},
+                projection={"doctorId": 1, "date": 1, "status": 1},
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            return jsonify({"message": "Ce créneau horaire est déjà réservé"}), 409
+
+        if previous and previous["date"] != date:
+            confirmed = 1 if previous.get("status") == "confirmed" else 0
+            bump_occupancy(previous["doctorId"], previous["date"], booked=-1, confirmed=-confirmed)
+            bump_occupancy(previous["doctorId"], date, booked=1, confirmed=confirmed)
+
+        notification = {
+            "userId": str(doctor["_id"]),
+            "titre": "Rendez-vous modifié",
+            "message": f"Le rendez-vous avec {user['name']} a été modifié pour le {date} à {heure}.",
+            "date": datetime.utcnow(),
+            "read": False
+        }
+        notification_dispatcher.enqueue(notification)
 
         return jsonify({"message": "Rendez-vous mis à jour"}), 200
 
@@ -809,6 +1486,10 @@ def update_rendezvous(rdv_id):
 def edit_profile():
     try:
         user_email = get_jwt_identity()
+        user = current_principal()
+        if not user or is_doctor(user):
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+
         data = request.get_json()
         name = data.get("name")
         email = data.get("email")
@@ -817,10 +1498,15 @@ def edit_profile():
             return jsonify({"message": "Nom et email requis"}), 400
 
         mongo.db.users.update_one(
-            {"email": user_email},
+            {"_id": ObjectId(user["id"])},
             {"$set": {"name": name, "email": email}}
         )
-        return jsonify({"message": "Profil mis à jour"}), 200
+        # Conversations carry both parties' names for the inbox
+        mongo.db.conversations.update_many({"patientId": user["id"]}, {"$set": {"patientName": name}})
+
+        user = {**user, "name": name, "email": email}
+        refresh_principal(user_email, user)
+        return jsonify({"message": "Profil mis à jour", "token": issue_token(user)}), 200
 
     except Exception as e:
         logger.error(f"Error in edit_profile: {str(e)}")
@@ -831,23 +1517,29 @@ def edit_profile():
 @jwt_required()
 def historique_medical():
     try:
-        user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": user_email})
-
-        consultations = mongo.db.consultations.find({"patientId": str(user["_id"])})
-
-        result = []
-        for c in consultations:
-            result.append({
-                "date": c.get("date"),
-                "diagnostic": c.get("diagnostic", ""),
-                "prescription": c.get("prescription", ""),
-                "consultationType": c.get("consultationType", ""),
-                "doctorName": c.get("doctorName", ""),
-                "documentIds": c.get("documentIds", [])
-            })
+        user = current_principal()
+        if not user:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+
+        page = read_page_args()
+        if page is None:
+            return invalid_page_response()
 
-        return jsonify(result), 200
+        query = {"patientId": user["id"]}
+        projection = {
+            "date": 1, "diagnostic": 1, "prescription": 1,
+            "consultationType": 1, "doctorName": 1, "documentIds": 1
+        }
+
+        def serialize(consultations):
+            return [consultation_row(c, doctorName=c.get("doctorName", "")) for c in consultations]
+
+        fmt = stream_format()
+        if fmt:
+            return stream_rows(fmt, mongo.db.consultations, query, projection, page, serialize)
+
+        consultations, page_headers = find_page(mongo.db.consultations, query, projection, page)
+        return jsonify(serialize(consultations)), 200, page_headers
 
     except Exception as e:
         logger.error(f"Error in historique_medical: {str(e)}")
@@ -858,26 +1550,22 @@ def historique_medical():
 @jwt_required()
 def get_notifications():
     try:
-        user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": user_email})
-        if not user:
-            doctor = mongo.db.medecins.find_one({"email": user_email})
-            if not doctor:
-                return jsonify({"message": "Utilisateur non trouvé"}), 404
-            user_id = str(doctor["_id"])
-        else:
-            user_id = str(user["_id"])
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+        user_id = principal["id"]
 
-        notifs = mongo.db.notifications.find({"userId": user_id})
-        return jsonify([
-            {
-                "_id": str(n["_id"]),
-                "titre": n["titre"],
-                "message": n["message"],
-                "date": n.get("date", "").strftime("%Y-%m-%d %H:%M") if n.get("date") else "",
-                "read": n.get("read", False)
-            } for n in notifs
-        ]), 200
+        page = read_page_args()
+        if page is None:
+            return invalid_page_response()
+
+        notifs, page_headers = find_page(
+            mongo.db.notifications,
+            {"userId": user_id},
+            {"titre": 1, "message": 1, "date": 1, "read": 1},
+            page
+        )
+        return jsonify([notification_row(n) for n in notifs]), 200, page_headers
 
     except Exception as e:
         logger.error(f"Error in get_notifications: {str(e)}")
@@ -888,56 +1576,137 @@ def get_notifications():
 @jwt_required()
 def update_notification_status(notification_id):
     try:
-        user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": user_email})
-        if not user:
-            doctor = mongo.db.medecins.find_one({"email": user_email})
-            if not doctor:
-                return jsonify({"message": "Utilisateur non trouvé"}), 404
-            user_id = str(doctor["_id"])
-        else:
-            user_id = str(user["_id"])
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+        user_id = principal["id"]
 
         data = request.get_json()
         read_status = data.get("read")
         if read_status is None:
             return jsonify({"message": "Le champ 'read' est requis"}), 400
 
-        notification = mongo.db.notifications.find_one({"_id": ObjectId(notification_id)})
-        if not notification:
+        if read_status:
+            update = {"$set": {"read": True, "readAt": datetime.utcnow()}}
+        else:
+            update = {"$set": {"read": False}, "$unset": {"readAt": ""}}
+        previous = mongo.db.notifications.find_one_and_update(
+            {"_id": ObjectId(notification_id), "userId": user_id},
+            update,
+            projection={"read": 1}
+        )
+        if not previous:
+            if mongo.db.notifications.find_one({"_id": ObjectId(notification_id)}, {"_id": 1}):
+                return jsonify({"message": "Accès refusé"}), 403
             return jsonify({"message": "Notification non trouvée"}), 404
 
-        if notification["userId"] != user_id:
-            return jsonify({"message": "Accès refusé"}), 403
-
-        mongo.db.notifications.update_one(
-            {"_id": ObjectId(notification_id)},
-            {"$set": {"read": read_status}}
-        )
+        if bool(previous.get("read", False)) != bool(read_status):
+            bump_unread({user_id: -1 if read_status else 1})
         return jsonify({"message": "Statut de la notification mis à jour"}), 200
 
     except Exception as e:
         logger.error(f"Error in update_notification_status: {str(e)}")
         return jsonify({"message": f"Erreur : {str(e)}"}), 500
 
+# Unread notification badge
+@app.route("/notifications/unread_count", methods=["GET"])
+@jwt_required()
+def get_unread_count():
+    try:
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+
+        return jsonify({"unreadCount": get_unread_counts([principal["id"]])[principal["id"]]}), 200
+
+    except Exception as e:
+        logger.error(f"Error in get_unread_count: {str(e)}")
+        return jsonify({"message": f"Erreur : {str(e)}"}), 500
+
+# Mark a list of notifications ({"ids": [...]}) or all of them ({"all": true}) as read
+@app.route("/notifications/mark_read", methods=["POST"])
+@jwt_required()
+def mark_notifications_read():
+    try:
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+        user_id = principal["id"]
+
+        data = request.get_json(silent=True) or {}
+        ids = data.get("ids")
+        query = {"userId": user_id, "read": False}
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, str) and ObjectId.is_valid(i) for i in ids):
+                return jsonify({"message": "Le champ 'ids' doit être une liste d'identifiants"}), 400
+            query["_id"] = {"$in": [ObjectId(i) for i in ids]}
+        elif data.get("all") is not True:
+            return jsonify({"message": "Le champ 'ids' ou 'all' est requis"}), 400
+
+        result = mongo.db.notifications.update_many(query, {"$set": {"read": True, "readAt": datetime.utcnow()}})
+        bump_unread({user_id: -result.modified_count})
+
+        return jsonify({
+            "message": "Notifications marquées comme lues",
+            "updated": result.modified_count,
+            "unreadCount": get_unread_counts([user_id])[user_id]
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Error in mark_notifications_read: {str(e)}")
+        return jsonify({"message": f"Erreur : {str(e)}"}), 500
+
+# Archived notifications: the archived months, or one month with ?month=YYYY-MM
+@app.route("/notifications/archive", methods=["GET"])
+@jwt_required()
+def get_archived_notifications():
+    try:
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+        user_id = principal["id"]
+
+        month = request.args.get("month")
+        if not month:
+            months = mongo.db.notification_archive.find(
+                {"userId": user_id},
+                {"_id": 0, "month": 1, "count": 1}
+            ).sort("month", DESCENDING)
+            return jsonify(list(months)), 200
+
+        try:
+            datetime.strptime(month, "%Y-%m")
+        except ValueError:
+            return jsonify({"message": "Format de mois invalide (YYYY-MM)"}), 400
+
+        bucket = mongo.db.notification_archive.find_one({"_id": f"{user_id}:{month}"}, {"items": 1})
+        items = sorted((bucket or {}).get("items", []), key=lambda n: n["_id"], reverse=True)
+        return jsonify({"month": month, "notifications": [notification_row(n) for n in items]}), 200
+
+    except Exception as e:
+        logger.error(f"Error in get_archived_notifications: {str(e)}")
+        return jsonify({"message": f"Erreur : {str(e)}"}), 500
+
 # Gestion des disponibilités
 @app.route("/disponibilites", methods=["GET", "POST", "DELETE"])
 @jwt_required()
 def disponibilites():
     try:
-        user_email = get_jwt_identity()
-        user = mongo.db.medecins.find_one({"email": user_email})
+        user = current_principal()
 
-        if not user:
+        if not is_doctor(user):
             return jsonify({"message": "Médecin non trouvé"}), 404
 
         if request.method == "GET":
-            dispo = user.get("disponibilites", {})
+            doctor = mongo.db.medecins.find_one({"_id": ObjectId(user["id"])}, {"disponibilites": 1})
+            if not doctor:
+                return jsonify({"message": "Médecin non trouvé"}), 404
+            dispo = doctor.get("disponibilites", {})
             dispo_list = [
                 {
                     "jour": jour,
                     "heure": f"{details['start']}-{details['end']}",
-                    "id": f"{user['_id']}_{jour}"
+                    "id": f"{user['id']}_{jour}"
                 }
                 for jour, details in dispo.items()
                 if jour != "created_at"
@@ -950,7 +1719,7 @@ def disponibilites():
             heure = data.get("heure")
             start, end = heure.split("-")
             mongo.db.medecins.update_one(
-                {"_id": ObjectId(user["_id"])},
+                {"_id": ObjectId(user["id"])},
                 {
                     "$set": {
                         f"disponibilites.{jour}": {"start": start, "end": end},
@@ -964,7 +1733,7 @@ def disponibilites():
             data = request.get_json()
             jour = data.get("jour")
             mongo.db.medecins.update_one(
-                {"_id": ObjectId(user["_id"])},
+                {"_id": ObjectId(user["id"])},
                 {"$unset": {f"disponibilites.{jour}": ""}}
             )
             return jsonify({"message": "Créneau supprimé"}), 200
@@ -978,26 +1747,38 @@ def disponibilites():
 @jwt_required()
 def gestion_consultations():
     try:
-        user_email = get_jwt_identity()
-        user = mongo.db.medecins.find_one({"email": user_email})
+        user = current_principal()
 
-        if not user:
+        if not is_doctor(user):
             return jsonify({"message": "Médecin non trouvé"}), 404
 
         if request.method == "GET":
-            consultations = mongo.db.consultations.find({"doctorId": str(user["_id"])})
-            return jsonify([
-                {
-                    "appointmentId": c.get("appointmentId"),
-                    "patientId": c["patientId"],
-                    "patientName": c["patientName"],
-                    "date": c["date"],
-                    "diagnostic": c.get("diagnostic", ""),
-                    "prescription": c.get("prescription", ""),
-                    "consultationType": c.get("consultationType", ""),
-                    "documentIds": c.get("documentIds", [])
-                } for c in consultations
-            ])
+            page = read_page_args()
+            if page is None:
+                return invalid_page_response()
+
+            query = {"doctorId": user["id"]}
+            projection = {
+                "appointmentId": 1, "patientId": 1, "patientName": 1, "date": 1,
+                "diagnostic": 1, "prescription": 1, "consultationType": 1, "documentIds": 1
+            }
+
+            def serialize(consultations):
+                return [
+                    consultation_row(
+                        c,
+                        appointmentId=c.get("appointmentId"),
+                        patientId=c["patientId"],
+                        patientName=c["patientName"]
+                    ) for c in consultations
+                ]
+
+            fmt = stream_format()
+            if fmt:
+                return stream_rows(fmt, mongo.db.consultations, query, projection, page, serialize)
+
+            consultations, page_headers = find_page(mongo.db.consultations, query, projection, page)
+            return jsonify(serialize(consultations)), 200, page_headers
 
         elif request.method == "POST":
             appointment_id = request.form.get("appointmentId")
@@ -1019,7 +1800,7 @@ def gestion_consultations():
             # Verify appointment exists and is confirmed
             appointment = mongo.db.rendezvous.find_one({
                 "_id": ObjectId(appointment_id),
-                "doctorId": str(user["_id"]),
+                "doctorId": user["id"],
                 "patientId": patient_id,
                 "date": date,
                 "status": "confirmed"
@@ -1034,19 +1815,15 @@ def gestion_consultations():
 
             # Handle document uploads
             document_ids = []
-            if 'documents' in request.files:
-                files = request.files.getlist('documents')
-                allowed_types = ['application/pdf', 'image/jpeg', 'image/png']
-                for file in files:
-                    if file.mimetype not in allowed_types:
-                        return jsonify({"message": "Type de fichier non autorisé. Utilisez PDF, JPG ou PNG"}), 400
-                    file_id = fs.put(file, filename=file.filename, content_type=file.mimetype)
-                    document_ids.append(str(file_id))
+            files = request.files.getlist('documents')
+            allowed_types = ['application/pdf', 'image/jpeg', 'image/png']
+            if any(file.mimetype not in allowed_types for file in files):
+                return jsonify({"message": "Type de fichier non autorisé. Utilisez PDF, JPG ou PNG"}), 400
 
             consultation = {
                 "appointmentId": appointment_id,
-                "doctorId": str(user["_id"]),
-                "doctorName": user["nom"],
+                "doctorId": user["id"],
+                "doctorName": user["name"],
                 "patientId": patient_id,
                 "patientName": patient_name,
                 "date": date,
@@ -1056,17 +1833,26 @@ def gestion_consultations():
                 "documentIds": document_ids,
                 "createdAt": datetime.utcnow()
             }
-            result = mongo.db.consultations.insert_one(consultation)
+            try:
+                for file in files:
+                    document_ids.append(str(content_store.put(file, file.filename, file.mimetype)))
+                result = mongo.db.consultations.insert_one(consultation)
+            except BaseException:
+                for file_id in document_ids:
+                    content_store.release(file_id)
+                raise
+            for file_id in set(document_ids):
+                thumbnail_worker.submit(file_id)
 
             # Notify patient with detailed message
             notification = {
                 "userId": patient_id,
                 "titre": "Nouvelle consultation",
-                "message": f"Votre consultation ({consultation_type}) avec {user['nom']} le {date} a été enregistrée. Diagnostic: {diagnostic}.",
+                "message": f"Votre consultation ({consultation_type}) avec {user['name']} le {date} a été enregistrée. Diagnostic: {diagnostic}.",
                 "date": datetime.utcnow(),
                 "read": False
             }
-            mongo.db.notifications.insert_one(notification)
+            notification_dispatcher.enqueue(notification)
 
             return jsonify({
                 "message": "Consultation enregistrée",
@@ -1076,28 +1862,30 @@ def gestion_consultations():
                 }
             }), 201
 
+    except (RequestEntityTooLarge, FileTooLarge) as e:
+        return upload_too_large_response(e)
     except Exception as e:
         logger.error(f"Error in gestion_consultations: {str(e)}")
         return jsonify({"message": f"Erreur : {str(e)}"}), 500
 
+def upload_too_large_response(error):
+    if isinstance(error, FileTooLarge):
+        limit_mb = app.config["MAX_UPLOAD_FILE_SIZE"] // (1024 * 1024)
+        return jsonify({"message": f"Fichier trop volumineux (maximum {limit_mb} Mo par fichier)"}), 413
+    limit_mb = app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)
+    return jsonify({"message": f"Envoi trop volumineux (maximum {limit_mb} Mo par requête)"}), 413
+
 # Upload a document
 @app.route("/documents", methods=["POST"])
 @jwt_required()
 def upload_document():
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
-        if not user:
-            doctor = mongo.db.medecins.find_one({"email": current_user_email})
-            if not doctor:
-                return jsonify({"message": "Utilisateur non trouvé"}), 404
-            user_id = str(doctor["_id"])
-            user_name = doctor["nom"]
-            is_doctor = True
-        else:
-            user_id = str(user["_id"])
-            user_name = user["name"]
-            is_doctor = False
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+        user_id = principal["id"]
+        user_name = principal["name"]
+        sender_is_doctor = is_doctor(principal)
 
         if 'document' not in request.files:
             return jsonify({"message": "Aucun fichier fourni"}), 400
@@ -1118,21 +1906,26 @@ def upload_document():
         if file.mimetype not in allowed_types:
             return jsonify({"message": "Type de fichier non autorisé. Utilisez PDF, JPG ou PNG"}), 400
 
-        file_id = fs.put(file, filename=file.filename, content_type=file.mimetype)
+        file_id = content_store.put(file, file.filename, file.mimetype)
 
         document = {
             "title": title,
-            "patientId": user_id if not is_doctor else conversation["patientId"] if conversation_id else None,
-            "patientName": user_name if not is_doctor else conversation["patientName"] if conversation_id else None,
-            "doctorId": conversation["doctorId"] if conversation_id else user_id if is_doctor else None,
-            "doctorName": conversation["doctorName"] if conversation_id else user_name if is_doctor else None,
+            "patientId": user_id if not sender_is_doctor else conversation["patientId"] if conversation_id else None,
+            "patientName": user_name if not sender_is_doctor else conversation["patientName"] if conversation_id else None,
+            "doctorId": conversation["doctorId"] if conversation_id else user_id if sender_is_doctor else None,
+            "doctorName": conversation["doctorName"] if conversation_id else user_name if sender_is_doctor else None,
             "fileId": str(file_id),
             "conversationId": conversation_id if conversation_id else None,
             "consulted": False,
             "annotations": [],
             "date": datetime.utcnow()
         }
-        result = mongo.db.documents.insert_one(document)
+        try:
+            result = mongo.db.documents.insert_one(document)
+        except BaseException:
+            content_store.release(file_id)
+            raise
+        thumbnail_worker.submit(file_id)
 
         if conversation_id:
             recipient_id = conversation["doctorId"] if user_id == conversation["patientId"] else conversation["patientId"]
@@ -1145,7 +1938,7 @@ def upload_document():
                     "date": datetime.utcnow(),
                     "read": False
                 }
-                mongo.db.notifications.insert_one(notification)
+                notification_dispatcher.enqueue(notification)
 
                 # Emit WebSocket event for document
                 socketio.emit('new_document', {
@@ -1162,6 +1955,8 @@ def upload_document():
             "documentId": str(result.inserted_id)
         }), 201
 
+    except (RequestEntityTooLarge, FileTooLarge) as e:
+        return upload_too_large_response(e)
     except Exception as e:
         logger.error(f"Error in upload_document: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
@@ -1171,28 +1966,26 @@ def upload_document():
 @jwt_required()
 def get_patient_documents():
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
-        if not user:
+        user = current_principal()
+        if not user or is_doctor(user):
             return jsonify({"message": "Utilisateur non trouvé"}), 404
 
-        documents = mongo.db.documents.find({"patientId": str(user["_id"])})
-        result = []
-        for doc in documents:
-            result.append({
-                "id": str(doc["_id"]),
-                "title": doc["title"],
-                "patientId": doc["patientId"],
-                "patientName": doc["patientName"],
-                "doctorId": doc.get("doctorId"),
-                "fileId": doc["fileId"],
-                "consulted": doc["consulted"],
-                "annotations": doc.get("annotations", []),
-                "conversationId": doc.get("conversationId"),
-                "date": doc.get("date", "").strftime("%Y-%m-%d %H:%M") if doc.get("date") else ""
-            })
+        page = read_page_args()
+        if page is None:
+            return invalid_page_response()
+
+        documents, page_headers = find_page(
+            mongo.db.documents,
+            {"patientId": user["id"]},
+            {
+                "title": 1, "patientId": 1, "patientName": 1, "doctorId": 1, "fileId": 1,
+                "thumbnailId": 1, "consulted": 1, "annotations": 1, "conversationId": 1, "date": 1
+            },
+            page
+        )
+        result = [document_row(doc, doc["patientName"], doctorId=doc.get("doctorId")) for doc in documents]
 
-        return jsonify(result), 200
+        return jsonify(result), 200, page_headers
 
     except Exception as e:
         logger.error(f"Error in get_patient_documents: {str(e)}")
@@ -1203,28 +1996,34 @@ def get_patient_documents():
 @jwt_required()
 def documents_patients():
     try:
-        current_user_email = get_jwt_identity()
-        doctor = mongo.db.medecins.find_one({"email": current_user_email})
-        if not doctor:
+        doctor = current_principal()
+        if not is_doctor(doctor):
             return jsonify({"message": "Médecin non trouvé"}), 404
 
-        documents = mongo.db.documents.find({"doctorId": str(doctor["_id"])})
-        result = []
-        for doc in documents:
-            patient = mongo.db.users.find_one({"_id": ObjectId(doc["patientId"])})
-            result.append({
-                "id": str(doc["_id"]),
-                "title": doc["title"],
-                "patientId": doc["patientId"],
-                "patientName": patient["name"] if patient else "Inconnu",
-                "fileId": doc["fileId"],
-                "consulted": doc["consulted"],
-                "annotations": doc.get("annotations", []),
-                "conversationId": doc.get("conversationId"),
-                "date": doc.get("date", "").strftime("%Y-%m-%d %H:%M") if doc.get("date") else ""
-            })
+        page = read_page_args()
+        if page is None:
+            return invalid_page_response()
+
+        query = {"doctorId": doctor["id"]}
+        projection = {
+            "title": 1, "patientId": 1, "fileId": 1, "thumbnailId": 1, "consulted": 1,
+            "annotations": 1, "conversationId": 1, "date": 1
+        }
 
-        return jsonify(result), 200
+        def serialize(documents):
+            patients = fetch_by_ids(mongo.db.users, {doc["patientId"] for doc in documents}, {"name": 1})
+            result = []
+            for doc in documents:
+                patient = patients.get(doc["patientId"])
+                result.append(document_row(doc, patient["name"] if patient else "Inconnu"))
+            return result
+
+        fmt = stream_format()
+        if fmt:
+            return stream_rows(fmt, mongo.db.documents, query, projection, page, serialize)
+
+        documents, page_headers = find_page(mongo.db.documents, query, projection, page)
+        return jsonify(serialize(documents)), 200, page_headers
 
     except Exception as e:
         logger.error(f"Error in documents_patients: {str(e)}")
@@ -1235,16 +2034,15 @@ def documents_patients():
 @jwt_required()
 def update_document_status(document_id):
     try:
-        current_user_email = get_jwt_identity()
-        doctor = mongo.db.medecins.find_one({"email": current_user_email})
-        if not doctor:
+        doctor = current_principal()
+        if not is_doctor(doctor):
             return jsonify({"message": "Médecin non trouvé"}), 404
 
         document = mongo.db.documents.find_one({"_id": ObjectId(document_id)})
         if not document:
             return jsonify({"message": "Document non trouvé"}), 404
 
-        if document["doctorId"] != str(doctor["_id"]):
+        if document["doctorId"] != doctor["id"]:
             return jsonify({"message": "Accès refusé"}), 403
 
         data = request.get_json()
@@ -1264,11 +2062,11 @@ def update_document_status(document_id):
                 notification = {
                     "userId": str(document["patientId"]),
                     "titre": "Document consulté",
-                    "message": f"Votre document '{document['title']}' a été consulté par {doctor['nom']}.",
+                    "message": f"Votre document '{document['title']}' a été consulté par {doctor['name']}.",
                     "date": datetime.utcnow(),
                     "read": False
                 }
-                mongo.db.notifications.insert_one(notification)
+                notification_dispatcher.enqueue(notification)
 
         return jsonify({"message": "Statut du document mis à jour"}), 200
 
@@ -1281,16 +2079,15 @@ def update_document_status(document_id):
 @jwt_required()
 def annotate_document(document_id):
     try:
-        current_user_email = get_jwt_identity()
-        doctor = mongo.db.medecins.find_one({"email": current_user_email})
-        if not doctor:
+        doctor = current_principal()
+        if not is_doctor(doctor):
             return jsonify({"message": "Médecin non trouvé"}), 404
 
         document = mongo.db.documents.find_one({"_id": ObjectId(document_id)})
         if not document:
             return jsonify({"message": "Document non trouvé"}), 404
 
-        if document["doctorId"] != str(doctor["_id"]):
+        if document["doctorId"] != doctor["id"]:
             return jsonify({"message": "Accès refusé"}), 403
 
         data = request.get_json()
@@ -1300,8 +2097,8 @@ def annotate_document(document_id):
 
         annotation_data = {
             "text": annotation,
-            "doctorId": str(doctor["_id"]),
-            "doctorName": doctor["nom"],
+            "doctorId": doctor["id"],
+            "doctorName": doctor["name"],
             "date": datetime.utcnow()
         }
 
@@ -1316,11 +2113,11 @@ def annotate_document(document_id):
             notification = {
                 "userId": str(document["patientId"]),
                 "titre": "Document annoté",
-                "message": f"Votre document '{document['title']}' a été annoté par {doctor['nom']}: {annotation}",
+                "message": f"Votre document '{document['title']}' a été annoté par {doctor['name']}: {annotation}",
                 "date": datetime.utcnow(),
                 "read": False
             }
-            mongo.db.notifications.insert_one(notification)
+            notification_dispatcher.enqueue(notification)
 
         return jsonify({"message": "Annotation ajoutée avec succès"}), 200
 
@@ -1328,67 +2125,115 @@ def annotate_document(document_id):
         logger.error(f"Error in annotate_document: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
 
+# Stream a GridFS file chunk by chunk, with Range and conditional request support.
+# GridFS files are immutable, so the file id is a strong ETag.
+def send_gridfs_file(file, as_attachment=False, download_name=None, max_age=None):
+    response = send_file(
+        file,
+        mimetype=file.content_type or "application/octet-stream",
+        as_attachment=as_attachment,
+        download_name=download_name or file.filename or str(file._id),
+        etag=str(file._id),
+        last_modified=file.upload_date,
+        max_age=max_age,
+        conditional=False
+    )
+    response.content_length = file.length
+    try:
+        return response.make_conditional(request, accept_ranges=True, complete_length=file.length)
+    except RequestedRangeNotSatisfiable as e:
+        response.close()
+        return e.get_response()
+
+# Stored files are shared by identical uploads: find a documents or
+# consultations record of this user attaching the file
+def find_file_record(file_id, user_id):
+    owner = {"$or": [{"patientId": user_id}, {"doctorId": user_id}]}
+    document = mongo.db.documents.find_one({"fileId": file_id, **owner}, {"title": 1})
+    if document:
+        return document
+    return mongo.db.consultations.find_one({"documentIds": file_id, **owner}, {"_id": 1})
+
+def file_access_error(file_id):
+    if (mongo.db.documents.find_one({"fileId": file_id}, {"_id": 1})
+            or mongo.db.consultations.find_one({"documentIds": file_id}, {"_id": 1})):
+        return jsonify({"message": "Accès refusé"}), 403
+    return jsonify({"message": "Document non trouvé"}), 404
+
 # Download a document
 @app.route("/documents/<file_id>/download", methods=["GET"])
 @jwt_required()
 def download_document(file_id):
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
-        doctor = mongo.db.medecins.find_one({"email": current_user_email})
-
-        document = mongo.db.documents.find_one({"fileId": file_id})
-        if not document:
-            return jsonify({"message": "Document non trouvé"}), 404
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
 
-        if (user and document["patientId"] != str(user["_id"])) and (doctor and document.get("doctorId") != str(doctor["_id"])):
-            return jsonify({"message": "Accès refusé"}), 403
+        record = find_file_record(file_id, principal["id"])
+        if not record:
+            return file_access_error(file_id)
 
-        file = fs.get(ObjectId(file_id))
-        if not file:
+        try:
+            file = fs.get(ObjectId(file_id))
+        except NoFile:
             return jsonify({"message": "Fichier non trouvé"}), 404
 
-        return send_file(
-            BytesIO(file.read()),
-            mimetype=file.content_type,
-            as_attachment=True,
-            download_name=file.filename
-        )
+        return send_gridfs_file(file, as_attachment=True, download_name=record.get("title"))
 
     except Exception as e:
         logger.error(f"Error in download_document: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
 
+# Document preview; thumbnails never change for a given file
+@app.route("/documents/<file_id>/thumbnail", methods=["GET"])
+@jwt_required()
+def document_thumbnail(file_id):
+    try:
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+
+        if not ObjectId.is_valid(file_id):
+            return jsonify({"message": "Document non trouvé"}), 404
+        if not find_file_record(file_id, principal["id"]):
+            return file_access_error(file_id)
+
+        stored = mongo.db.fs.files.find_one({"_id": ObjectId(file_id)}, {"thumbnailId": 1})
+        try:
+            thumbnail = fs.get(stored["thumbnailId"])
+        except (TypeError, KeyError, NoFile):
+            return jsonify({"message": "Aperçu non disponible"}), 404
+
+        response = send_gridfs_file(thumbnail, max_age=app.config["THUMBNAIL_MAX_AGE"])
+        response.cache_control.public = None
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+        return response
+
+    except Exception as e:
+        logger.error(f"Error in document_thumbnail: {str(e)}")
+        return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
+
 # Create or get conversations
 @app.route("/messages/conversations", methods=["GET", "POST"])
 @jwt_required()
 def manage_conversations():
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
+        user = current_principal()
         if not user:
-            doctor = mongo.db.medecins.find_one({"email": current_user_email})
-            if not doctor:
-                return jsonify({"message": "Utilisateur non trouvé"}), 404
-            user_id = str(doctor["_id"])
-        else:
-            user_id = str(user["_id"])
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+        user_id = user["id"]
 
         if request.method == "GET":
-            conversations = mongo.db.conversations.find({
-                "$or": [{"patientId": user_id}, {"doctorId": user_id}]
-            })
-            result = []
-            for conv in conversations:
-                other_party = mongo.db.medecins.find_one({"_id": ObjectId(conv["doctorId"])}) if conv["patientId"] == user_id else mongo.db.users.find_one({"_id": ObjectId(conv["patientId"])})
-                result.append({
-                    "id": str(conv["_id"]),
-                    "patientId": conv["patientId"],
-                    "doctorId": conv["doctorId"],
-                    "otherPartyName": other_party["nom" if "nom" in other_party else "name"] if other_party else "Inconnu",
-                    "createdAt": conv.get("createdAt", "").strftime("%Y-%m-%d %H:%M") if conv.get("createdAt") else "",
-                    "lastMessageAt": conv.get("lastMessageAt", "").strftime("%Y-%m-%d %H:%M") if conv.get("lastMessageAt") else ""
-                })
+            # Inbox: one query, names, last message and unread counts are
+            # maintained on the conversation when messages are written
+            conversations = mongo.db.conversations.find(
+                {"$or": [{"patientId": user_id}, {"doctorId": user_id}]}
+            ).sort([("lastMessageAt", DESCENDING), ("_id", DESCENDING)])
+            result = [
+                conversation_row(conv, "patient" if conv["patientId"] == user_id else "doctor")
+                for conv in conversations
+            ]
             return jsonify(result), 200
 
         elif request.method == "POST":
@@ -1429,22 +2274,181 @@ def manage_conversations():
         logger.error(f"Error in manage_conversations: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
 
+# Conversation participants never change, so sockets check membership from a cache
+conversation_cache = TTLCache(
+    maxsize=app.config["CONVERSATION_CACHE_SIZE"],
+    ttl=app.config["CONVERSATION_CACHE_TTL"]
+)
+
+def find_conversation(conversation_id):
+    conversation = conversation_cache.get(conversation_id)
+    if conversation is None and ObjectId.is_valid(conversation_id):
+        conversation = mongo.db.conversations.find_one(
+            {"_id": ObjectId(conversation_id)},
+            {"patientId": 1, "doctorId": 1}
+        )
+        if conversation:
+            conversation_cache.set(conversation_id, conversation)
+    return conversation
+
+def last_message_preview(message):
+    return {
+        "senderId": message["senderId"],
+        "senderName": message.get("senderName"),
+        "content": message["content"][:app.config["INBOX_SNIPPET_LENGTH"]],
+        "type": message.get("type", "text")
+    }
+
+MESSAGE_TYPES = ("text", "document")
+
+# Validation of a chat message's content and type, shared by the HTTP and socket
+# paths. Returns the error message, or None when the message is acceptable.
+def message_content_error(content, msg_type):
+    if msg_type not in MESSAGE_TYPES:
+        return "Type de message invalide"
+    if not content:
+        return "Contenu requis"
+    if not isinstance(content, str):
+        return "Contenu invalide"
+    if len(content) > app.config["MESSAGE_MAX_LENGTH"]:
+        return f"Message trop long (au plus {app.config['MESSAGE_MAX_LENGTH']} caractères)"
+    return None
+
+def message_event(message):
+    return message_row(message, message.get("senderName"))
+
+# Denormalized inbox fields (last message preview, the recipient's unread count)
+# and "new message" notifications, applied in bulk for the messages of the last
+# few hundred milliseconds
+def apply_conversation_activity(pending):
+    operations = []
+    notifications = []
+    for conversation_id, entry in pending.items():
+        # One malformed entry must not cost the rest of the batch its updates
+        try:
+            entry_operations, entry_notifications = conversation_activity_writes(entry)
+        except Exception as e:
+            logger.error(f"Error applying activity of conversation {conversation_id}: {str(e)}")
+            continue
+        operations.extend(entry_operations)
+        notifications.extend(entry_notifications)
+    if operations:
+        try:
+            mongo.db.conversations.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            logger.error(f"Error updating conversations: {len(e.details.get('writeErrors', []))} write(s) failed")
+    for notification in notifications:
+        notification_dispatcher.enqueue(notification)
+
+def conversation_activity_writes(entry):
+    conversation, last = entry["conversation"], entry["last"]
+    unread = {}
+    notifications = []
+    for sender_id, sender in entry["senders"].items():
+        if sender_id == conversation["patientId"]:
+            recipient_id, recipient_role = conversation["doctorId"], "doctor"
+        else:
+            recipient_id, recipient_role = conversation["patientId"], "patient"
+        unread[f"{recipient_role}Unread"] = sender["count"]
+        if sender["count"] == 1:
+            text = f"Nouveau message de {sender['name']} dans votre conversation."
+        else:
+            text = f"{sender['count']} nouveaux messages de {sender['name']} dans votre conversation."
+        notifications.append({
+            "userId": recipient_id,
+            "titre": "Nouveau message",
+            "message": text,
+            "date": datetime.utcnow(),
+            "read": False
+        })
+    operations = [
+        UpdateOne({"_id": conversation["_id"]}, {"$inc": unread}),
+        # Workers flush independently: never move the preview back in time
+        UpdateOne(
+            {
+                "_id": conversation["_id"],
+                "$or": [{"lastMessageAt": None}, {"lastMessageAt": {"$lte": last["timestamp"]}}]
+            },
+            {"$set": {"lastMessageAt": last["timestamp"], "lastMessage": last_message_preview(last)}}
+        )
+    ]
+    return operations, notifications
+
+conversation_activity = ConversationActivity(
+    apply_conversation_activity,
+    interval=app.config["MESSAGE_ACTIVITY_INTERVAL"],
+    enabled=app.config["MESSAGE_ACTIVITY_ASYNC"]
+)
+atexit.register(conversation_activity.stop)
+
+# Persist a chat message; the message insert is the only write on the sending
+# path. Returns (message, created): a retried clientId returns the stored message.
+def store_message(conversation, principal, content, msg_type, client_id=None):
+    message = {
+        "conversationId": str(conversation["_id"]),
+        "senderId": principal["id"],
+        "senderName": principal["name"],
+        "content": content,
+        "type": msg_type,
+        "timestamp": datetime.utcnow()
+    }
+    if client_id:
+        message["clientId"] = client_id
+    try:
+        mongo.db.messages.insert_one(message)
+    except DuplicateKeyError:
+        existing = mongo.db.messages.find_one({"senderId": principal["id"], "clientId": client_id})
+        if existing is None:
+            raise
+        return existing, False
+    conversation_activity.record(conversation, message)
+    return message, True
+
+# Fill the inbox preview of conversations created before it was maintained
+def backfill_last_messages():
+    latest = mongo.db.messages.aggregate([
+        {"$sort": {"conversationId": 1, "_id": -1}},
+        {"$group": {"_id": "$conversationId", "message": {"$first": "$$ROOT"}}}
+    ], allowDiskUse=True)
+    operations = [
+        UpdateOne(
+            {"_id": ObjectId(row["_id"]), "lastMessage": {"$exists": False}},
+            {"$set": {
+                "lastMessageAt": row["message"].get("timestamp"),
+                "lastMessage": last_message_preview(row["message"])
+            }}
+        )
+        for row in latest if ObjectId.is_valid(row["_id"])
+    ]
+    if operations:
+        mongo.db.conversations.bulk_write(operations, ordered=False)
+    return len(operations)
+
+# ?since= accepts a message id, or an ISO 8601 date / epoch milliseconds. Dates
+# map to an _id bound with one second resolution, so clients dedupe by id.
+def parse_since(value):
+    if ObjectId.is_valid(value):
+        return ObjectId(value)
+    try:
+        if value.isdigit():
+            moment = datetime.utcfromtimestamp(int(value) / 1000)
+        else:
+            moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            if moment.tzinfo:
+                moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    except (ValueError, OverflowError, OSError):
+        return None
+    return ObjectId.from_datetime(moment.replace(tzinfo=timezone.utc))
+
 # Manage messages in a conversation
 @app.route("/messages/<conversation_id>", methods=["GET", "POST"])
 @jwt_required()
 def manage_messages(conversation_id):
     try:
-        current_user_email = get_jwt_identity()
-        user = mongo.db.users.find_one({"email": current_user_email})
-        if not user:
-            doctor = mongo.db.medecins.find_one({"email": current_user_email})
-            if not doctor:
-                return jsonify({"message": "Utilisateur non trouvé"}), 404
-            user_id = str(doctor["_id"])
-            user_name = doctor["nom"]
-        else:
-            user_id = str(user["_id"])
-            user_name = user["name"]
+        principal = current_principal()
+        if not principal:
+            return jsonify({"message": "Utilisateur non trouvé"}), 404
+        user_id = principal["id"]
 
         conversation = mongo.db.conversations.find_one({"_id": ObjectId(conversation_id)})
         if not conversation:
@@ -1454,75 +2458,154 @@ def manage_messages(conversation_id):
             return jsonify({"message": "Accès refusé"}), 403
 
         if request.method == "GET":
-            messages = mongo.db.messages.find({"conversationId": conversation_id})
-            result = []
-            for msg in messages:
-                sender = mongo.db.users.find_one({"_id": ObjectId(msg["senderId"])}) if msg["senderId"] == conversation["patientId"] else mongo.db.medecins.find_one({"_id": ObjectId(msg["senderId"])})
-                result.append({
-                    "id": str(msg["_id"]),
-                    "conversationId": msg["conversationId"],
-                    "senderId": msg["senderId"],
-                    "senderName": sender["name" if "name" in sender else "nom"] if sender else "Inconnu",
-                    "content": msg["content"],
-                    "type": msg["type"],
-                    "timestamp": msg.get("timestamp", "").strftime("%Y-%m-%d %H:%M") if msg.get("timestamp") else ""
-                })
-            return jsonify(result), 200
+            page = read_page_args()
+            if page is None:
+                return invalid_page_response()
+
+            # Incremental sync: ?since=<messageId|timestamp> returns the newer messages
+            since = request.args.get("since")
+            if since:
+                if page["after"] or page["before"]:
+                    return invalid_page_response()
+                page["after"] = parse_since(since)
+                if page["after"] is None:
+                    return jsonify({"message": "Paramètre 'since' invalide (identifiant de message ou date)"}), 400
+
+            messages, page_headers = find_page(
+                mongo.db.messages,
+                {"conversationId": conversation_id},
+                {"conversationId": 1, "senderId": 1, "senderName": 1, "content": 1, "type": 1, "timestamp": 1},
+                page
+            )
+            # Chat history is displayed oldest first
+            messages.reverse()
+
+            # Opening the conversation reads it
+            unread_field = "patientUnread" if user_id == conversation["patientId"] else "doctorUnread"
+            if conversation.get(unread_field):
+                mongo.db.conversations.update_one({"_id": conversation["_id"]}, {"$set": {unread_field: 0}})
+
+            # Messages written before senderName was stored fall back to the conversation's names
+            sender_names = {
+                conversation["patientId"]: conversation.get("patientName"),
+                conversation["doctorId"]: conversation.get("doctorName")
+            }
+            result = [
+                message_row(msg, msg.get("senderName") or sender_names.get(msg["senderId"]) or "Inconnu")
+                for msg in messages
+            ]
+            return jsonify(result), 200, page_headers
 
         elif request.method == "POST":
             data = request.get_json()
             content = data.get("content")
+            client_id = data.get("clientId")
             msg_type = data.get("type", "text")
-            if not content:
-                return jsonify({"message": "Contenu requis"}), 400
-
-            message = {
-                "conversationId": conversation_id,
-                "senderId": user_id,
-                "content": content,
-                "type": msg_type,
-                "timestamp": datetime.utcnow()
-            }
-            result = mongo.db.messages.insert_one(message)
-
-            mongo.db.conversations.update_one(
-                {"_id": ObjectId(conversation_id)},
-                {"$set": {"lastMessageAt": datetime.utcnow()}}
-            )
-
-            # Emit WebSocket event
-            socketio.emit('new_message', {
-                "id": str(result.inserted_id),
-                "conversationId": conversation_id,
-                "senderId": user_id,
-                "senderName": user_name,
-                "content": content,
-                "type": msg_type,
-                "timestamp": message["timestamp"].strftime("%Y-%m-%d %H:%M")
-            }, room=conversation_id)
+            content_error = message_content_error(content, msg_type)
+            if content_error:
+                return jsonify({"message": content_error}), 400
+            if client_id is not None and not isinstance(client_id, str):
+                return jsonify({"message": "clientId invalide"}), 400
 
-            recipient_id = conversation["doctorId"] if user_id == conversation["patientId"] else conversation["patientId"]
-            recipient = mongo.db.medecins.find_one({"_id": ObjectId(recipient_id)}) if user_id == conversation["patientId"] else mongo.db.users.find_one({"_id": ObjectId(recipient_id)})
-            if recipient:
-                notification = {
-                    "userId": recipient_id,
-                    "titre": "Nouveau message",
-                    "message": f"Nouveau message de {user_name} dans votre conversation.",
-                    "date": datetime.utcnow(),
-                    "read": False
-                }
-                mongo.db.notifications.insert_one(notification)
+            message, created = store_message(conversation, principal, content, msg_type, client_id)
+            if created:
+                socketio.emit('new_message', message_event(message), room=conversation_id)
 
             return jsonify({
                 "message": "Message envoyé",
-                "id": str(result.inserted_id)
+                "id": str(message["_id"])
             }), 201
 
     except Exception as e:
         logger.error(f"Error in manage_messages: {str(e)}")
         return jsonify({"message": f"Erreur serveur : {str(e)}"}), 500
 
+# Index management
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Create the indexes declared in config.INDEXES."""
+    ensure_indexes(mongo.db)
+
+@app.cli.command("rebuild-occupancy")
+def rebuild_occupancy_command():
+    """Recompute the per-day occupancy counters from rendezvous."""
+    rebuild_occupancy()
+
+@app.cli.command("rebuild-unread-counters")
+def rebuild_unread_counters_command():
+    """Recompute the unread notification counters from notifications."""
+    rebuild_unread_counters()
+
+@app.cli.command("archive-notifications")
+def archive_notifications_command():
+    """Archive read notifications past retention and each user's excess notifications."""
+    click.echo(f"{run_notification_archive() or 0} notification(s) archived")
+
+@app.cli.command("collect-files")
+def collect_files_command():
+    """Reconcile stored file reference counts and delete unreferenced files."""
+    click.echo(f"{run_storage_gc() or 0} file(s) deleted")
+
+@app.cli.command("build-thumbnails")
+def build_thumbnails_command():
+    """Build the thumbnails missing from stored PDF, JPEG and PNG files."""
+    built = sum(1 for file_id in thumbnail_worker.missing() if thumbnail_worker.build(file_id))
+    click.echo(f"{built} thumbnail(s) built")
+
+@app.cli.command("run-scheduler")
+def run_scheduler_command():
+    """Run the periodic jobs in this process until SIGINT/SIGTERM."""
+    if app.config["ENSURE_INDEXES_ON_STARTUP"]:
+        ensure_indexes(mongo.db)
+    warn_unslotted_bookings()
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+    scheduler.start()
+    logger.info("Scheduler started")
+    while not stopping.wait(1):
+        pass
+    # Let running jobs finish, then flush queued notifications
+    scheduler.shutdown()
+    notification_dispatcher.stop()
+    logger.info("Scheduler stopped")
+
+@app.cli.command("backfill-inbox")
+def backfill_inbox_command():
+    """Fill the last-message preview of conversations that predate it."""
+    click.echo(f"{backfill_last_messages()} conversation(s) updated")
+
+@app.cli.command("backfill-read-at")
+def backfill_read_at_command():
+    """Set readAt on notifications read before it was recorded."""
+    click.echo(f"{backfill_read_at(mongo.db)} notification(s) updated")
+
+@app.cli.command("backfill-booking-slots")
+def backfill_booking_slots_command():
+    """Store the slot of appointments that predate it, flagging double bookings."""
+    ensure_indexes(mongo.db)
+    filled, conflicts = backfill_booking_slots()
+    click.echo(f"{filled} appointment(s) updated")
+    for rdv_id in conflicts:
+        click.echo(f"Double booking, flagged slotConflict: {rdv_id}")
+    # Superseded by the unique index on slot
+    if "doctorId_1_date_1_heure_1" in mongo.db.rendezvous.index_information():
+        mongo.db.rendezvous.drop_index("doctorId_1_date_1_heure_1")
+        click.echo("Dropped index doctorId_1_date_1_heure_1")
+
+@app.cli.command("verify-indexes")
+def verify_indexes_command():
+    """Fail if any query shape used by the app falls back to a collection scan."""
+    failures = verify_indexes(mongo.db)
+    if failures:
+        raise click.ClickException(f"{len(failures)} query shape(s) use COLLSCAN")
+    click.echo("All query shapes use an index")
+
 if __name__ == "__main__":
+    if app.config["ENSURE_INDEXES_ON_STARTUP"]:
+        ensure_indexes(mongo.db)
+    warn_unslotted_bookings()
+    scheduler.start()
     try:
         socketio.run(app, debug=True, port=5000)
     finally:
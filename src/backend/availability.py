@@ -0,0 +1,110 @@
+from datetime import date, timedelta
+
+from cache import TTLCache
+
+WEEKDAYS = ["lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi", "dimanche"]
+
+# Opening hours used for doctors who have not declared any disponibilites
+DEFAULT_HOURS = [("08:00", "12:00"), ("13:00", "18:00")]
+
+SLOT_MINUTES = 30
+SLOT_GAP_MINUTES = 5
+
+
+def _to_minutes(hhmm):
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def _to_hhmm(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+class DayTemplate:
+    """Bookable slots of one weekday; slot i is bit i of a day bitmap."""
+
+    def __init__(self, hours):
+        self.slots = []
+        for start, end in hours:
+            current, end_minutes = _to_minutes(start), _to_minutes(end)
+            while current < end_minutes:
+                self.slots.append((_to_hhmm(current), _to_hhmm(current + SLOT_MINUTES)))
+                current += SLOT_MINUTES + SLOT_GAP_MINUTES
+        self.index = {start: bit for bit, (start, _) in enumerate(self.slots)}
+        self.full_mask = (1 << len(self.slots)) - 1
+
+    def bit(self, heure):
+        position = self.index.get(heure)
+        return 0 if position is None else 1 << position
+
+    def render(self, booked_mask):
+        return [
+            {"start": start, "end": end, "available": not booked_mask >> bit & 1}
+            for bit, (start, end) in enumerate(self.slots)
+        ]
+
+
+class AvailabilityEngine:
+    """Compiles a doctor's weekly disponibilites into per-weekday slot templates
+    and answers multi-day availability queries with booking bitmaps."""
+
+    def __init__(self, cache_size=1024, cache_ttl=600):
+        self._templates = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    @staticmethod
+    def _fingerprint(disponibilites):
+        return tuple(sorted(
+            (jour.lower(), details["start"], details["end"])
+            for jour, details in (disponibilites or {}).items()
+            if isinstance(details, dict)
+        ))
+
+    def weekly_template(self, doctor_id, disponibilites):
+        fingerprint = self._fingerprint(disponibilites)
+        cached = self._templates.get(doctor_id)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+
+        if fingerprint:
+            hours = {jour: (start, end) for jour, start, end in fingerprint}
+            week = [DayTemplate([hours[day]] if day in hours else []) for day in WEEKDAYS]
+        else:
+            default = DayTemplate(DEFAULT_HOURS)
+            week = [default] * 7
+        self._templates.set(doctor_id, (fingerprint, week))
+        return week
+
+    def days(self, doctor_id, disponibilites, booked, start_date, end_date):
+        """Slots for every day in [start_date, end_date].
+
+        `booked` is an iterable of {"date": "YYYY-MM-DD", "heure": "HH:MM"}.
+        """
+        week = self.weekly_template(doctor_id, disponibilites)
+
+        booked_masks = {}
+        for rdv in booked:
+            day = _parse_day(rdv["date"])
+            if day is None:
+                continue
+            booked_masks[rdv["date"]] = booked_masks.get(rdv["date"], 0) | week[day.weekday()].bit(rdv["heure"])
+
+        result = []
+        current = start_date
+        while current <= end_date:
+            date_str = current.strftime("%Y-%m-%d")
+            template = week[current.weekday()]
+            booked_mask = booked_masks.get(date_str, 0)
+            result.append({
+                "date": date_str,
+                "availableSlots": bin(template.full_mask & ~booked_mask).count("1"),
+                "slots": template.render(booked_mask)
+            })
+            current += timedelta(days=1)
+        return result
+
+
+def _parse_day(date_str):
+    try:
+        return date.fromisoformat(date_str)
+    except (TypeError, ValueError):
+        return None
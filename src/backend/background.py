@@ -0,0 +1,37 @@
+import os
+import threading
+
+
+class PerProcess:
+    """A resource created on first use, and again in each forked process.
+
+    fork() copies an object but not its threads: a gunicorn worker forked
+    after a background thread or pool was started inherits a dead one. `get()`
+    returns the resource of the current process, calling `create()` the first
+    time it is needed there.
+    """
+
+    def __init__(self, create):
+        self.create = create
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._value is not None and self._pid == os.getpid():
+            return self._value
+        with self._lock:
+            if self._value is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._value = self.create()
+            return self._value
+
+    def current(self):
+        """The resource created in this process, or None."""
+        return self._value if self._pid == os.getpid() else None
+
+
+def start_daemon(target, name):
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,87 @@
+"""Concurrent booking stress benchmark.
+
+Many threads book the same few slots of one doctor through the real
+/rendezvous endpoint. At the end every slot must hold at most one
+appointment; throughput and the 201/409 split are reported.
+
+    MONGO_URI=mongodb://localhost:27017/bench_booking \
+        python benchmarks/booking_stress.py --threads 64 --requests 5000 --slots 4
+
+The target database is dropped first, so its name must start with "bench".
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/bench_booking")
+
+from app import app, mongo  # noqa: E402
+from availability import DEFAULT_HOURS, DayTemplate  # noqa: E402
+from indexes import ensure_indexes  # noqa: E402
+
+
+def register(client, name, role):
+    response = client.post("/register", json={
+        "name": name,
+        "email": f"{name}@bench.local",
+        "password": "bench",
+        "role": role
+    })
+    return response.get_json()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--slots", type=int, default=4)
+    parser.add_argument("--patients", type=int, default=50)
+    args = parser.parse_args()
+
+    if not mongo.db.name.startswith("bench"):
+        sys.exit(f"Refusing to drop database {mongo.db.name!r}")
+    mongo.cx.drop_database(mongo.db.name)
+    ensure_indexes(mongo.db)
+
+    client = app.test_client()
+    doctor_id = register(client, "doctor", "medecin")["user_id"]
+    tokens = [register(client, f"patient{i}", "patient")["token"] for i in range(args.patients)]
+
+    date = (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
+    # Distinct slot starts of the default template (the doctor has no disponibilites)
+    slots = [start for start, _ in DayTemplate(DEFAULT_HOURS).slots[:args.slots]]
+
+    def book(i):
+        response = app.test_client().post(
+            "/rendezvous",
+            json={"date": date, "heure": slots[i % len(slots)], "doctorId": doctor_id},
+            headers={"Authorization": f"Bearer {tokens[i % len(tokens)]}"}
+        )
+        return response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        statuses = Counter(pool.map(book, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    double_booked = list(mongo.db.rendezvous.aggregate([
+        {"$group": {"_id": {"doctorId": "$doctorId", "date": "$date", "slot": "$slot"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]))
+
+    print(f"requests:       {args.requests} on {len(slots)} slots, {args.threads} threads")
+    print(f"elapsed:        {elapsed:.2f}s ({args.requests / elapsed:.0f} req/s)")
+    print(f"statuses:       {dict(statuses)}")
+    print(f"double booked:  {len(double_booked)}")
+
+    if double_booked or statuses[201] != len(slots):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""JSON response serialization micro-benchmark.
+
+Builds the response body of a list endpoint from --rows synthetic Mongo
+documents, the way the endpoints did before (per-row str(ObjectId) and
+strftime, flask_pymongo's BSONProvider) and the way they do now (shared row
+serializers, FastJSONProvider), and reports the CPU time per response.
+
+    python benchmarks/json_serialization.py --rows 10000 --repeat 20
+
+Needs no database.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+from flask import Flask  # noqa: E402
+from flask_pymongo.helpers import BSONProvider  # noqa: E402
+
+from serialization import FastJSONProvider, document_row, message_row, orjson  # noqa: E402
+
+
+def make_documents(count):
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "_id": ObjectId(),
+            "title": f"Compte rendu {i}",
+            "patientId": str(ObjectId()),
+            "patientName": "Patient Exemple",
+            "doctorId": str(ObjectId()),
+            "fileId": str(ObjectId()),
+            "thumbnailId": str(ObjectId()),
+            "consulted": i % 3 == 0,
+            "annotations": [],
+            "conversationId": None,
+            "date": start + timedelta(minutes=i)
+        }
+        for i in range(count)
+    ]
+
+
+def make_messages(count):
+    start = datetime(2024, 1, 1)
+    conversation_id = str(ObjectId())
+    senders = [str(ObjectId()), str(ObjectId())]
+    return [
+        {
+            "_id": ObjectId(),
+            "conversationId": conversation_id,
+            "senderId": senders[i % 2],
+            "senderName": "Dr Exemple" if i % 2 else "Patient Exemple",
+            "content": "Bonjour docteur, " * random.randint(1, 8),
+            "type": "text",
+            "timestamp": start + timedelta(seconds=30 * i)
+        }
+        for i in range(count)
+    ]
+
+
+# The row builders as they were written inline in the endpoints
+def legacy_document_row(doc):
+    return {
+        "id": str(doc["_id"]),
+        "title": doc["title"],
+        "patientId": doc["patientId"],
+        "patientName": doc["patientName"],
+        "doctorId": doc.get("doctorId"),
+        "fileId": doc["fileId"],
+        "hasThumbnail": "thumbnailId" in doc,
+        "consulted": doc["consulted"],
+        "annotations": doc.get("annotations", []),
+        "conversationId": doc.get("conversationId"),
+        "date": doc.get("date", "").strftime("%Y-%m-%d %H:%M") if doc.get("date") else ""
+    }
+
+
+def legacy_message_row(msg):
+    return {
+        "id": str(msg["_id"]),
+        "conversationId": msg["conversationId"],
+        "senderId": msg["senderId"],
+        "senderName": msg.get("senderName") or "Inconnu",
+        "content": msg["content"],
+        "type": msg["type"],
+        "timestamp": msg.get("timestamp", "").strftime("%Y-%m-%d %H:%M") if msg.get("timestamp") else ""
+    }
+
+
+def cpu_per_response(app, build, repeat):
+    samples = []
+    with app.app_context():
+        for _ in range(repeat):
+            started = time.process_time()
+            response = app.json.response(build())
+            response.get_data()
+            samples.append(time.process_time() - started)
+    return statistics.median(samples), len(response.get_data())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    if orjson is None:
+        sys.exit("orjson is not installed: FastJSONProvider would use the standard library encoder")
+
+    before = Flask("before")
+    before.json = BSONProvider(before)
+    after = Flask("after")
+    after.json = FastJSONProvider(after)
+
+    documents = make_documents(args.rows)
+    messages = make_messages(args.rows)
+    cases = [
+        ("documents", lambda: [legacy_document_row(doc) for doc in documents],
+         lambda: [document_row(doc, doc["patientName"], doctorId=doc.get("doctorId")) for doc in documents]),
+        ("messages", lambda: [legacy_message_row(msg) for msg in messages],
+         lambda: [message_row(msg, msg.get("senderName") or "Inconnu") for msg in messages]),
+    ]
+
+    print(f"{args.rows} rows, median of {args.repeat} responses")
+    for name, legacy, current in cases:
+        old_cpu, old_size = cpu_per_response(before, legacy, args.repeat)
+        new_cpu, new_size = cpu_per_response(after, current, args.repeat)
+        print(f"{name:10}  before {old_cpu * 1000:7.1f} ms ({old_size / 1024:.0f} KiB)  "
+              f"after {new_cpu * 1000:7.1f} ms ({new_size / 1024:.0f} KiB)  "
+              f"{old_cpu / new_cpu:.1f}x less CPU")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Socket.IO cross-process fan-out benchmark.
+
+Starts --workers server processes sharing the Mongo message queue, connects
+--clients Socket.IO clients spread over them, all in one conversation room,
+then emits --events events from a separate write-only publisher. The
+clients authenticate as the conversation's patient or doctor, registered
+through the API, as join_conversation requires. Every client
+must receive every event; delivery latency percentiles and fan-out
+throughput (deliveries per second) are reported.
+
+    python benchmarks/socketio_fanout.py --workers 4 --clients 400 --events 500 \\
+        --mongo-uri mongodb://localhost:27017/bench_socketio
+
+Needs the python-socketio client extras (requests, websocket-client). The
+target database is dropped first, so its name must start with "bench".
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+import socketio  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+
+from pubsub import MongoManager  # noqa: E402
+
+
+def serve(port, mongo_uri):
+    os.environ["MONGO_URI"] = mongo_uri
+    os.environ["SOCKETIO_MESSAGE_QUEUE"] = mongo_uri
+    from app import app, socketio as server
+    server.run(app, port=port, log_output=False, allow_unsafe_werkzeug=True)
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client = socketio.Client()
+        try:
+            client.connect(f"http://127.0.0.1:{port}", wait_timeout=2)
+            client.disconnect()
+            return
+        except socketio.exceptions.ConnectionError:
+            time.sleep(0.5)
+    sys.exit(f"Worker on port {port} did not start")
+
+
+def register(url, name, role):
+    response = requests.post(f"{url}/register", json={
+        "name": name,
+        "email": f"{name}@bench.local",
+        "password": "bench",
+        "role": role,
+        "specialite": "Bench"
+    })
+    response.raise_for_status()
+    return response.json()
+
+
+def create_conversation(url):
+    """Register a patient and a doctor; returns the conversation id and the
+    access tokens of its two members."""
+    patient = register(url, "patient", "patient")
+    doctor = register(url, "doctor", "medecin")
+    response = requests.post(
+        f"{url}/messages/conversations",
+        json={"doctorId": doctor["user_id"]},
+        headers={"Authorization": f"Bearer {patient['token']}"}
+    )
+    response.raise_for_status()
+    return response.json()["id"], [patient["token"], doctor["token"]]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=400)
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200, help="events per second")
+    parser.add_argument("--base-port", type=int, default=5100)
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/bench_socketio")
+    args = parser.parse_args()
+
+    mongo = MongoClient(args.mongo_uri)
+    db = mongo.get_default_database()
+    if not db.name.startswith("bench"):
+        sys.exit(f"Refusing to drop database {db.name!r}")
+    mongo.drop_database(db.name)
+
+    ports = [args.base_port + i for i in range(args.workers)]
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=serve, args=(port, args.mongo_uri), daemon=True) for port in ports]
+    for worker in workers:
+        worker.start()
+    for port in ports:
+        wait_for(port)
+
+    room, tokens = create_conversation(f"http://127.0.0.1:{ports[0]}")
+
+    latencies = []
+    received = [0] * args.clients
+    lock = threading.Lock()
+    clients = []
+    for i in range(args.clients):
+        client = socketio.Client()
+
+        @client.on("new_message")
+        def on_message(data, i=i):
+            latency = time.time() - data["sentAt"]
+            with lock:
+                latencies.append(latency)
+                received[i] += 1
+
+        client.connect(
+            f"http://127.0.0.1:{ports[i % len(ports)]}",
+            transports=["websocket"],
+            auth={"token": tokens[i % len(tokens)]}
+        )
+        ack = client.call("join_conversation", {"conversationId": room})
+        if not ack.get("ok"):
+            sys.exit(f"Client {i} could not join the conversation: {ack}")
+        clients.append(client)
+    time.sleep(1)
+
+    publisher = MongoManager(args.mongo_uri, write_only=True)
+    started = time.perf_counter()
+    for seq in range(args.events):
+        publisher.emit("new_message", {"seq": seq, "sentAt": time.time()}, room=room, namespace="/")
+        time.sleep(max(0.0, started + (seq + 1) / args.rate - time.perf_counter()))
+
+    expected = args.events * args.clients
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline and len(latencies) < expected:
+        time.sleep(0.1)
+    elapsed = time.perf_counter() - started
+
+    for client in clients:
+        client.disconnect()
+    for worker in workers:
+        worker.terminate()
+
+    print(f"workers:        {args.workers}, clients: {args.clients}, events: {args.events} at {args.rate:.0f}/s")
+    print(f"delivered:      {len(latencies)} / {expected}")
+    print(f"throughput:     {len(latencies) / elapsed:.0f} deliveries/s")
+    if latencies:
+        print(f"latency ms:     p50 {percentile(latencies, 0.5) * 1000:.1f}  "
+              f"p95 {percentile(latencies, 0.95) * 1000:.1f}  "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f}  "
+              f"max {max(latencies) * 1000:.1f}  "
+              f"mean {statistics.mean(latencies) * 1000:.1f}")
+
+    if len(latencies) != expected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
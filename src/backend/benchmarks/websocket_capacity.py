@@ -0,0 +1,132 @@
+"""Concurrent websocket capacity benchmark of the web role.
+
+Registers one doctor and --users patients with a conversation each, opens
+--connections Socket.IO websocket clients authenticated as those patients
+against a running server (--concurrency handshakes at a time), keeps them
+all open, then has every client send --rounds acknowledged
+join_conversation calls for its own conversation. Reports connect rate,
+failures and acknowledgement round-trip percentiles under full load.
+
+    gunicorn -c gunicorn.conf.py wsgi:app &
+    python benchmarks/websocket_capacity.py --url http://127.0.0.1:5000 --connections 5000
+
+Needs the asyncio client extras of python-socketio (aiohttp) and enough
+file descriptors on both sides (ulimit -n). Each connect writes the
+socket's presence document; join_conversation reads the conversation once
+per worker and then from its cache. Users are named after a random run id,
+so the server's database is not cleared.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import aiohttp
+import socketio
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def register(session, url, name, role):
+    async with session.post(f"{url}/register", json={
+        "name": name,
+        "email": f"{name}@bench.local",
+        "password": "bench",
+        "role": role,
+        "specialite": "Bench"
+    }) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def create_users(args):
+    """Returns [(access token, conversation id)], one per patient."""
+    run_id = uuid.uuid4().hex[:8]
+    async with aiohttp.ClientSession() as session:
+        doctor = await register(session, args.url, f"doctor-{run_id}", "medecin")
+
+        async def patient(i):
+            user = await register(session, args.url, f"patient-{run_id}-{i}", "patient")
+            async with session.post(
+                f"{args.url}/messages/conversations",
+                json={"doctorId": doctor["user_id"]},
+                headers={"Authorization": f"Bearer {user['token']}"}
+            ) as response:
+                response.raise_for_status()
+                return user["token"], (await response.json())["id"]
+
+        return await asyncio.gather(*(patient(i) for i in range(args.users)))
+
+
+async def run(args):
+    users = await create_users(args)
+    clients, failures = [], 0
+    gate = asyncio.Semaphore(args.concurrency)
+
+    async def connect(i):
+        nonlocal failures
+        client = socketio.AsyncClient(reconnection=False)
+        async with gate:
+            try:
+                await client.connect(
+                    args.url,
+                    transports=["websocket"],
+                    auth={"token": users[i % len(users)][0]},
+                    wait_timeout=30
+                )
+                clients.append((client, users[i % len(users)][1]))
+            except Exception:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(i) for i in range(args.connections)))
+    connect_elapsed = time.perf_counter() - started
+    print(f"connected:      {len(clients)} / {args.connections} in {connect_elapsed:.1f}s "
+          f"({len(clients) / connect_elapsed:.0f}/s), {failures} failed")
+
+    latencies, timeouts, rejected = [], 0, 0
+
+    async def ping(client, conversation_id):
+        nonlocal timeouts, rejected
+        for _ in range(args.rounds):
+            sent = time.perf_counter()
+            try:
+                ack = await client.call("join_conversation", {"conversationId": conversation_id}, timeout=30)
+            except socketio.exceptions.TimeoutError:
+                timeouts += 1
+                continue
+            if not ack.get("ok"):
+                rejected += 1
+                continue
+            latencies.append(time.perf_counter() - sent)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(ping(client, conversation_id) for client, conversation_id in clients))
+    elapsed = time.perf_counter() - started
+    if latencies:
+        print(f"round trips:    {len(latencies)} in {elapsed:.1f}s ({len(latencies) / elapsed:.0f}/s), "
+              f"{timeouts} timed out, {rejected} rejected")
+        print(f"ack ms:         p50 {percentile(latencies, 0.5) * 1000:.1f}  "
+              f"p95 {percentile(latencies, 0.95) * 1000:.1f}  "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f}  "
+              f"mean {statistics.mean(latencies) * 1000:.1f}")
+
+    await asyncio.gather(*(client.disconnect() for client, _ in clients))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--users", type=int, default=100)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[1] if entry else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class VersionedSnapshot:
+    """Caches one value built from shared data, tagged with the data's version.
+
+    `load_version` reads the current version from the shared store (re-read
+    at most every `recheck_seconds`), `build` recomputes the value. Writers
+    bump the shared version and call `invalidate()` locally.
+
+    One caller at a time checks the version and rebuilds; meanwhile the
+    others are served the previous value, and only wait when there is none.
+    """
+
+    def __init__(self, load_version, build, recheck_seconds=5):
+        self.load_version = load_version
+        self.build = build
+        self.recheck_seconds = recheck_seconds
+        self._version = None
+        self._value = None
+        self._built = False
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._version is not None and time.monotonic() - self._checked_at < self.recheck_seconds:
+                return self._value
+            stale, built = self._value, self._built
+        if not self._refresh_lock.acquire(blocking=not built):
+            return stale
+        try:
+            version = self.load_version()
+            with self._lock:
+                if self._version == version:
+                    self._checked_at = time.monotonic()
+                    return self._value
+            value = self.build()
+            with self._lock:
+                self._version, self._value, self._built = version, value, True
+                self._checked_at = time.monotonic()
+            return value
+        finally:
+            self._refresh_lock.release()
+
+    def invalidate(self):
+        """Make the next get() rebuild; the current value is served until then."""
+        with self._lock:
+            self._version = None
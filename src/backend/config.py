@@ -1,2 +1,177 @@
+import os
+
+
 class Config:
-    MONGO_URI = "mongodb://localhost:27017/mobile"
+    MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/mobile")
+
+    # Socket.IO fan-out between worker processes: a mongodb:// URL relays events
+    # through a capped collection, redis:// or amqp:// use Flask-SocketIO's own
+    # managers. Unset, events only reach clients of the emitting process.
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+    SOCKETIO_CHANNEL = "flask-socketio"
+    # "threading" for the development server; wsgi.py switches to "gevent"
+    SOCKETIO_ASYNC_MODE = os.environ.get("SOCKETIO_ASYNC_MODE", "threading")
+
+    # Principal (authenticated user) cache
+    PRINCIPAL_CACHE_SIZE = 10000
+    PRINCIPAL_CACHE_TTL = 300
+
+    # Expose the number of Mongo queries per request as an X-Query-Count header
+    QUERY_COUNT_HEADER = False
+
+    # Keyset pagination of list endpoints
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 500
+    # Documents fetched per cursor batch when a list is streamed (NDJSON or ?stream=1)
+    STREAM_BATCH_SIZE = 500
+
+    # Doctor availability engine
+    AVAILABILITY_CACHE_SIZE = 1024
+    AVAILABILITY_CACHE_TTL = 600
+    AVAILABILITY_MAX_DAYS = 62
+
+    # How often a worker checks whether its cached /doctors payload is stale
+    DOCTORS_CACHE_RECHECK_SECONDS = 5
+    # Shorter doctor searches match most of the directory: they are refused
+    SEARCH_MIN_QUERY_LENGTH = 2
+
+    # Notification write-behind queue (NOTIFICATIONS_ASYNC = False writes inline)
+    NOTIFICATIONS_ASYNC = True
+    NOTIFICATION_BATCH_SIZE = 200
+    NOTIFICATION_FLUSH_INTERVAL = 0.25
+    NOTIFICATION_QUEUE_SIZE = 10000
+    NOTIFICATION_ENQUEUE_TIMEOUT = 1.0
+    NOTIFICATION_WRITE_RETRIES = 3
+    NOTIFICATION_RETRY_BACKOFF = 0.5
+
+    # Notification retention: read notifications are archived NOTIFICATION_ARCHIVE_DAYS
+    # after being read and users keep at most NOTIFICATION_MAX_PER_USER in the hot
+    # collection. The TTL index drops read notifications NOTIFICATION_READ_TTL_DAYS
+    # after being read in case the nightly archive job falls behind.
+    NOTIFICATION_ARCHIVE_DAYS = 30
+    NOTIFICATION_MAX_PER_USER = 200
+    NOTIFICATION_READ_TTL_DAYS = 90
+
+    # Upload limits in bytes. Flask rejects requests over MAX_CONTENT_LENGTH
+    # before reading the body; a file over MAX_UPLOAD_FILE_SIZE fails while the
+    # multipart body is parsed, without spooling the rest of it.
+    MAX_CONTENT_LENGTH = 50 * 1024 * 1024
+    MAX_UPLOAD_FILE_SIZE = 20 * 1024 * 1024
+    # Stored files referenced within this delay are skipped by the storage GC
+    STORAGE_GC_GRACE_MINUTES = 60
+
+    # Background thumbnails of uploaded documents (longest side in pixels).
+    # Needs Pillow, plus PyMuPDF for PDFs; served with a one year max-age.
+    THUMBNAIL_SIZE = 256
+    THUMBNAIL_WORKERS = 2
+    THUMBNAIL_QUEUE_SIZE = 500
+    THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+
+    # Length of the last-message preview shown in the conversation inbox
+    INBOX_SNIPPET_LENGTH = 100
+    # Longest chat message accepted, in characters
+    MESSAGE_MAX_LENGTH = 5000
+
+    # Conversation previews, unread counters and "new message" notifications are
+    # applied in the background, coalesced over MESSAGE_ACTIVITY_INTERVAL seconds
+    # (MESSAGE_ACTIVITY_ASYNC = False applies them inline)
+    MESSAGE_ACTIVITY_ASYNC = True
+    MESSAGE_ACTIVITY_INTERVAL = 0.5
+    CONVERSATION_CACHE_SIZE = 10000
+    CONVERSATION_CACHE_TTL = 3600
+
+    # Presence and typing indicators. Clients emit `heartbeat` every
+    # PRESENCE_HEARTBEAT_SECONDS; sockets silent for PRESENCE_TTL_SECONDS count as
+    # offline. Typing stops TYPING_TIMEOUT_SECONDS after the last `typing` event.
+    # Presence and typing broadcasts are coalesced per room over
+    # SOCKET_BROADCAST_INTERVAL seconds, and each socket may send
+    # SOCKET_EVENT_RATE of these events per second (bursts of SOCKET_EVENT_BURST).
+    PRESENCE_TTL_SECONDS = 60
+    PRESENCE_HEARTBEAT_SECONDS = 20
+    PRESENCE_WATCH_LIMIT = 100
+    TYPING_TIMEOUT_SECONDS = 6
+    SOCKET_BROADCASTS_ASYNC = True
+    SOCKET_BROADCAST_INTERVAL = 0.5
+    SOCKET_EVENT_RATE = 5
+    SOCKET_EVENT_BURST = 10
+
+    # Appointment reminder job period; the leader lease lasts two periods
+    REMINDER_INTERVAL_MINUTES = 15
+
+    # Create the indexes declared in INDEXES when the server starts
+    ENSURE_INDEXES_ON_STARTUP = True
+
+
+# Index registry: collection -> list of (keys, options). Applied by
+# `flask ensure-indexes` and checked by `flask verify-indexes`.
+INDEXES = {
+    "users": [
+        ([("email", 1)], {"unique": True}),
+    ],
+    "medecins": [
+        # Doctors added through /add_doctor have no email
+        ([("email", 1)], {"unique": True, "partialFilterExpression": {"email": {"$type": "string"}}}),
+    ],
+    "rendezvous": [
+        # One appointment per doctor and slot, enforced by the storage layer.
+        # `slot` is the canonical slot start; appointments booked before it
+        # existed get it from `flask backfill-booking-slots`.
+        ([("doctorId", 1), ("date", 1), ("slot", 1)], {"unique": True, "partialFilterExpression": {"slot": {"$exists": True}}}),
+        ([("doctorId", 1), ("date", 1)], {}),
+        # Appointments still without a slot (startup check and backfill): their
+        # null keys are the only ones in range once the backfill has run
+        ([("slot", 1), ("slotConflict", 1)], {}),
+        ([("patientId", 1), ("_id", -1)], {}),
+        ([("doctorId", 1), ("_id", -1)], {}),
+        ([("status", 1), ("date", 1)], {}),
+    ],
+    "occupancy": [
+        ([("doctorId", 1), ("date", 1)], {"unique": True}),
+    ],
+    "notifications": [
+        ([("userId", 1), ("_id", -1)], {}),
+        ([("userId", 1), ("read", 1)], {}),
+        # Idempotency key of generated notifications (appointment reminders)
+        ([("dedupKey", 1)], {"unique": True, "partialFilterExpression": {"dedupKey": {"$exists": True}}}),
+        # Retention: archive job and TTL expiry of read notifications
+        ([("readAt", 1)], {
+            "expireAfterSeconds": Config.NOTIFICATION_READ_TTL_DAYS * 24 * 3600,
+            "partialFilterExpression": {"read": True}
+        }),
+    ],
+    "notification_archive": [
+        ([("userId", 1), ("month", -1)], {}),
+    ],
+    # Content hash of uploaded files, for deduplication
+    "fs.files": [
+        ([("sha256", 1)], {"unique": True, "partialFilterExpression": {"sha256": {"$exists": True}}}),
+    ],
+    "conversations": [
+        ([("patientId", 1), ("doctorId", 1)], {}),
+        # Inbox, newest conversation first
+        ([("patientId", 1), ("lastMessageAt", -1), ("_id", -1)], {}),
+        ([("doctorId", 1), ("lastMessageAt", -1), ("_id", -1)], {}),
+    ],
+    "messages": [
+        ([("conversationId", 1), ("_id", -1)], {}),
+        # Client-generated ids make message retries idempotent
+        ([("senderId", 1), ("clientId", 1)], {"unique": True, "partialFilterExpression": {"clientId": {"$exists": True}}}),
+    ],
+    # One document per connected socket; the TTL only collects what the
+    # presence sweep missed
+    "presence": [
+        ([("userId", 1), ("seenAt", -1)], {}),
+        ([("seenAt", 1)], {"expireAfterSeconds": 24 * 3600}),
+    ],
+    "documents": [
+        ([("fileId", 1)], {}),
+        ([("patientId", 1), ("_id", -1)], {}),
+        ([("doctorId", 1), ("_id", -1)], {}),
+    ],
+    "consultations": [
+        ([("appointmentId", 1)], {}),
+        ([("documentIds", 1)], {}),
+        ([("patientId", 1), ("_id", -1)], {}),
+        ([("doctorId", 1), ("_id", -1)], {}),
+    ],
+}
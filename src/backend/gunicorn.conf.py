@@ -0,0 +1,32 @@
+"""gunicorn settings of the web role, overridable from the environment.
+
+Each worker is one process serving up to WEB_WORKER_CONNECTIONS concurrent
+connections (HTTP requests and websockets) on gevent greenlets. With more
+than one worker, set SOCKETIO_MESSAGE_QUEUE so Socket.IO rooms span all of
+them; clients then need the websocket transport, or sticky sessions at the
+load balancer for long-polling.
+"""
+import os
+
+bind = os.environ.get("WEB_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_WORKERS", 4))
+worker_class = "gevent"
+worker_connections = int(os.environ.get("WEB_WORKER_CONNECTIONS", 5000))
+# SIGTERM: stop accepting, give open requests this long, then close websockets
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+timeout = 60
+keepalive = 5
+backlog = 2048
+
+
+def on_starting(server):
+    if workers > 1 and not os.environ.get("SOCKETIO_MESSAGE_QUEUE"):
+        server.log.warning("WEB_WORKERS > 1 without SOCKETIO_MESSAGE_QUEUE: "
+                           "Socket.IO events will not cross workers")
+
+
+def worker_exit(server, worker):
+    # Apply the conversation updates and write the notifications still queued by this worker
+    from app import conversation_activity, notification_dispatcher
+    conversation_activity.stop()
+    notification_dispatcher.stop()
@@ -0,0 +1,117 @@
+import logging
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from config import INDEXES
+
+logger = logging.getLogger(__name__)
+
+_ID = ObjectId()
+
+# Query shapes issued by app.py: (collection, filter, sort). Values are
+# placeholders, only the shape matters to the planner. The unfiltered
+# /doctors listing is a deliberate full read and is not listed here.
+QUERY_SHAPES = [
+    ("users", {"email": "x"}, None),
+    ("users", {"_id": _ID}, None),
+    ("users", {"_id": {"$in": [_ID]}}, None),
+    ("medecins", {"email": "x"}, None),
+    ("medecins", {"_id": _ID}, None),
+    ("medecins", {"_id": {"$in": [_ID]}}, None),
+    ("rendezvous", {"slot": {"$exists": False}, "slotConflict": {"$exists": False}}, None),
+    ("rendezvous", {"slot": {"$exists": False}, "slotConflict": {"$exists": False}, "status": "confirmed"}, [("_id", 1)]),
+    ("rendezvous", {"slot": {"$exists": False}, "slotConflict": {"$exists": False}, "status": {"$ne": "confirmed"}}, [("_id", 1)]),
+    ("rendezvous", {"doctorId": "x", "date": "2000-01-01"}, None),
+    ("rendezvous", {"doctorId": "x", "date": {"$gte": "2000-01-01", "$lte": "2000-01-31"}}, None),
+    ("rendezvous", {"patientId": "x"}, [("_id", -1)]),
+    ("rendezvous", {"doctorId": "x"}, [("_id", -1)]),
+    ("rendezvous", {"patientId": "x", "_id": {"$lt": _ID}}, [("_id", -1)]),
+    ("rendezvous", {"status": "confirmed", "date": {"$gte": "2000-01-01", "$lte": "2000-01-02"}}, None),
+    ("rendezvous", {"_id": _ID, "doctorId": "x", "patientId": "x", "date": "2000-01-01", "status": "confirmed"}, None),
+    ("occupancy", {"doctorId": "x", "date": "2000-01-01"}, None),
+    ("occupancy", {"doctorId": "x", "date": {"$gte": "2000-01-01", "$lte": "2000-01-31"}}, None),
+    ("notifications", {"userId": "x"}, [("_id", -1)]),
+    ("notifications", {"userId": "x", "_id": {"$gt": _ID}}, [("_id", 1)]),
+    ("notifications", {"userId": "x", "read": False}, None),
+    ("notifications", {"_id": _ID, "userId": "x"}, None),
+    ("notifications", {"userId": "x", "read": False, "_id": {"$in": [_ID]}}, None),
+    ("unread_counters", {"_id": {"$in": ["x"]}}, None),
+    ("notifications", {"read": True, "readAt": {"$lt": datetime(2000, 1, 1)}}, None),
+    ("notification_archive", {"userId": "x"}, [("month", -1)]),
+    ("fs.files", {"sha256": "x"}, None),
+    ("conversations", {"$or": [{"patientId": "x"}, {"doctorId": "x"}]}, [("lastMessageAt", -1), ("_id", -1)]),
+    ("conversations", {"patientId": "x", "doctorId": "x"}, None),
+    ("conversations", {"_id": _ID}, None),
+    ("messages", {"conversationId": "x"}, [("_id", -1)]),
+    ("messages", {"senderId": "x", "clientId": "x"}, None),
+    ("presence", {"userId": "x", "seenAt": {"$gte": datetime(2000, 1, 1)}}, None),
+    ("presence", {"userId": {"$in": ["x"]}, "seenAt": {"$gte": datetime(2000, 1, 1)}}, None),
+    ("presence", {"seenAt": {"$lt": datetime(2000, 1, 1)}}, None),
+    ("conversations", {"patientId": "x", "doctorId": {"$in": ["x"]}}, None),
+    ("conversations", {"doctorId": "x", "patientId": {"$in": ["x"]}}, None),
+    ("documents", {"fileId": "x"}, None),
+    ("consultations", {"documentIds": "x", "$or": [{"patientId": "x"}, {"doctorId": "x"}]}, None),
+    ("documents", {"patientId": "x"}, [("_id", -1)]),
+    ("documents", {"doctorId": "x"}, [("_id", -1)]),
+    ("documents", {"_id": _ID}, None),
+    ("consultations", {"appointmentId": "x"}, None),
+    ("consultations", {"patientId": "x"}, [("_id", -1)]),
+    ("consultations", {"doctorId": "x"}, [("_id", -1)]),
+]
+
+
+# IndexOptionsConflict / IndexKeySpecsConflict
+_INDEX_CONFLICT_CODES = (85, 86)
+
+
+def _ensure_index(collection, model):
+    try:
+        collection.create_indexes([model])
+    except DuplicateKeyError:
+        logger.error(f"Cannot build unique index {model.document['name']} on {collection.name}: "
+                     "existing documents share its key, deduplicate them first")
+        raise
+    except OperationFailure as e:
+        if e.code not in _INDEX_CONFLICT_CODES:
+            raise
+        # The registry changed the options of an existing index: rebuild it
+        name = model.document["name"]
+        logger.warning(f"Rebuilding index {name} on {collection.name}")
+        collection.drop_index(name)
+        collection.create_indexes([model])
+
+
+def ensure_indexes(db):
+    """Create every index declared in config.INDEXES. Safe to run repeatedly."""
+    for collection, specs in INDEXES.items():
+        for keys, options in specs:
+            _ensure_index(db[collection], IndexModel(keys, **options))
+        logger.info(f"Indexes ensured on {collection}")
+
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+def verify_indexes(db):
+    """Explain every query shape and return the ones that fall back to COLLSCAN."""
+    failures = []
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _stages(plan):
+            failures.append((collection, query, sort))
+            logger.error(f"COLLSCAN on {collection}: filter={query} sort={sort}")
+    return failures
@@ -0,0 +1,68 @@
+import logging
+import threading
+
+from background import PerProcess, start_daemon
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationActivity:
+    """Coalesces the side effects of chat messages.
+
+    Storing a message is the only write on the sending path. `record()`
+    accumulates, per conversation, the newest message and the messages sent
+    by each party; a background thread hands everything gathered during
+    `interval` seconds to `flush(pending)` at once, so a burst of messages
+    costs one conversation update and one notification per recipient.
+    `pending` maps conversation ids to {"conversation", "last", "senders":
+    {sender_id: {"count", "name"}}}. `stop()` flushes what is left.
+    """
+
+    def __init__(self, flush, interval=0.5, enabled=True):
+        self.flush = flush
+        self.interval = interval
+        self.enabled = enabled
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = PerProcess(lambda: start_daemon(self._run, "conversation-activity"))
+
+    def record(self, conversation, message):
+        with self._lock:
+            entry = self._pending.setdefault(
+                str(conversation["_id"]),
+                {"conversation": conversation, "last": message, "senders": {}}
+            )
+            if message["_id"] >= entry["last"]["_id"]:
+                entry["last"] = message
+            sender = entry["senders"].setdefault(message["senderId"], {"count": 0, "name": message.get("senderName")})
+            sender["count"] += 1
+        if not self.enabled:
+            self._flush_pending()
+            return
+        self._thread.get()
+
+    def stop(self):
+        thread = self._thread.current()
+        if thread is None or not thread.is_alive():
+            self._flush_pending()
+            return
+        self._stopping = True
+        self._wakeup.set()
+        thread.join(10)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.interval)
+            self._flush_pending()
+
+    def _flush_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            self.flush(pending)
+        except Exception as e:
+            logger.error(f"Error flushing activity of {len(pending)} conversations: {str(e)}")
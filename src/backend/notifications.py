@@ -0,0 +1,214 @@
+import logging
+import queue
+import time
+from collections import Counter, defaultdict
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from background import PerProcess, start_daemon
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class NotificationDispatcher:
+    """Write-behind queue for notification documents.
+
+    Endpoints `enqueue()` fully built notification documents; a background
+    thread writes them with insert_many in batches of at most `batch_size`,
+    flushing at least every `flush interval` seconds. When the queue is full,
+    `enqueue()` waits up to `enqueue_timeout` seconds and then writes the
+    document itself, so producers slow down to the database's pace instead of
+    dropping notifications. A failed write is retried `retries` times, after
+    `retry_backoff` seconds and twice as long each time. `stop()` drains the
+    queue.
+
+    Callables registered with `on_insert()` receive each batch of inserted
+    documents from the writer thread.
+    """
+
+    def __init__(self, get_collection, batch_size=200, flush_interval=0.25,
+                 max_queue=10000, enqueue_timeout=1.0, retries=3, retry_backoff=0.5, enabled=True):
+        self.get_collection = get_collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.enabled = enabled
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._listeners = []
+        self._thread = PerProcess(lambda: start_daemon(self._run, "notification-dispatcher"))
+
+    def on_insert(self, listener):
+        self._listeners.append(listener)
+        return listener
+
+    def enqueue(self, notification):
+        if not self.enabled:
+            self._write([notification])
+            return
+        self._thread.get()
+        try:
+            self._queue.put(notification, timeout=self.enqueue_timeout)
+        except queue.Full:
+            logger.warning("Notification queue full, writing synchronously")
+            self._write([notification])
+
+    def stop(self, timeout=10):
+        thread = self._thread.current()
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+
+        # Drain whatever was queued before the stop request
+        remaining = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.batch_size):
+            self._write(remaining[start:start + self.batch_size])
+
+    def publish(self, inserted):
+        """Hand documents that were inserted elsewhere to the listeners."""
+        for listener in self._listeners:
+            try:
+                listener(inserted)
+            except Exception as e:
+                logger.error(f"Error in notification listener: {str(e)}")
+
+    def _write(self, batch):
+        # While the writer thread backs off, the queue fills up and producers
+        # fall back to writing themselves
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            try:
+                inserted = insert_notifications(self.get_collection(), batch)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Error writing {len(batch)} notifications, giving up: {str(e)}")
+                    return
+                logger.warning(f"Error writing {len(batch)} notifications, retrying in {delay}s: {str(e)}")
+                time.sleep(delay)
+                delay *= 2
+        if inserted:
+            self.publish(inserted)
+
+
+def insert_notifications(collection, notifications):
+    """insert_many that skips duplicate idempotency keys; returns the inserted documents."""
+    try:
+        collection.insert_many(notifications, ordered=False)
+        return notifications
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        # Duplicate keys were already delivered, except duplicate _ids: those
+        # documents were written by an earlier attempt that failed part way
+        failed = {error["index"] for error in errors if error.get("keyPattern") != {"_id": 1}}
+        return [doc for i, doc in enumerate(notifications) if i not in failed]
+
+
+def backfill_read_at(db):
+    """Give notifications read before readAt was recorded their date as readAt,
+    so that archiving and the read TTL index see them. Returns the count updated."""
+    result = db.notifications.update_many(
+        {"read": True, "readAt": {"$exists": False}},
+        [{"$set": {"readAt": {"$ifNull": ["$date", "$$NOW"]}}}]
+    )
+    return result.modified_count
+
+
+# Fields kept for each archived notification
+ARCHIVED_FIELDS = ("_id", "titre", "message", "date", "read")
+
+
+def archive_notifications(db, read_before, max_per_user, batch_size=1000):
+    """Move old notifications out of the hot collection.
+
+    Notifications read before `read_before` and everything beyond each user's
+    newest `max_per_user` are pushed into one `notification_archive` document
+    per user and month, then deleted. Returns (archived count, Counter of
+    archived unread notifications per user).
+    """
+    projection = {field: 1 for field in ARCHIVED_FIELDS + ("userId",)}
+    archived, unread = 0, Counter()
+
+    while True:
+        batch = list(db.notifications.find({"read": True, "readAt": {"$lt": read_before}}, projection).limit(batch_size))
+        if not batch:
+            break
+        archived += _archive_batch(db, batch, unread)
+
+    crowded = db.notifications.aggregate([
+        {"$group": {"_id": "$userId", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": max_per_user}}}
+    ])
+    for user in crowded:
+        while True:
+            batch = list(
+                db.notifications.find({"userId": user["_id"]}, projection)
+                .sort("_id", -1).skip(max_per_user).limit(batch_size)
+            )
+            if not batch:
+                break
+            archived += _archive_batch(db, batch, unread)
+
+    if archived:
+        logger.info(f"Archived {archived} notifications")
+    return archived, unread
+
+
+def _archive_batch(db, notifications, unread):
+    buckets = defaultdict(list)
+    for n in notifications:
+        month = (n.get("date") or n["_id"].generation_time).strftime("%Y-%m")
+        buckets[(n["userId"], month)].append({field: n.get(field) for field in ARCHIVED_FIELDS})
+        if not n.get("read"):
+            unread[n["userId"]] += 1
+
+    db.notification_archive.bulk_write([
+        UpdateOne(
+            {"_id": f"{user_id}:{month}"},
+            {
+                "$setOnInsert": {"userId": user_id, "month": month},
+                "$push": {"items": {"$each": items}},
+                "$inc": {"count": len(items)}
+            },
+            upsert=True
+        )
+        for (user_id, month), items in buckets.items()
+    ], ordered=False)
+    db.notifications.delete_many({"_id": {"$in": [n["_id"] for n in notifications]}})
+    return len(notifications)
@@ -0,0 +1,251 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from background import PerProcess, start_daemon
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket per key: `rate` events per second, bursts of up to `burst`."""
+
+    def __init__(self, rate=5, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            return allowed
+
+    def forget(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+
+class Broadcaster:
+    """Coalesces Socket.IO broadcasts per room.
+
+    `publish(event, room, key, payload)` replaces any pending payload with the
+    same (event, room, key); a background thread hands what is pending to
+    `emit(event, payload, room, skip_sid)` every `interval` seconds, so a room
+    receives at most one event per key and interval however often the state
+    behind it changes. Callables registered with `every_tick()` run on the
+    same thread before each flush.
+    """
+
+    def __init__(self, emit, interval=0.5, enabled=True):
+        self.emit = emit
+        self.interval = interval
+        self.enabled = enabled
+        self._pending = {}
+        self._tick_callbacks = []
+        self._lock = threading.Lock()
+        self._thread = PerProcess(lambda: start_daemon(self._run, "socket-broadcaster"))
+
+    def every_tick(self, callback):
+        self._tick_callbacks.append(callback)
+        return callback
+
+    def publish(self, event, room, key, payload, skip_sid=None):
+        if not self.enabled:
+            self._emit(event, room, payload, skip_sid)
+            return
+        with self._lock:
+            self._pending[(event, room, key)] = (payload, skip_sid)
+        self._thread.get()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            for callback in self._tick_callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Error in broadcaster tick: {str(e)}")
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for (event, room, _), (payload, skip_sid) in pending.items():
+                self._emit(event, room, payload, skip_sid)
+
+    def _emit(self, event, room, payload, skip_sid):
+        try:
+            self.emit(event, payload, room, skip_sid)
+        except Exception as e:
+            logger.error(f"Error broadcasting {event} to {room}: {str(e)}")
+
+
+class TypingTracker:
+    """Who is typing in which conversation.
+
+    Clients repeat `typing: true` while the user types; the state ends on
+    `typing: false` or `timeout` seconds after the last refresh. `update()`
+    and `expire()` only report actual state changes, which are what gets
+    broadcast.
+    """
+
+    def __init__(self, timeout=6):
+        self.timeout = timeout
+        self._typing = {}
+        self._lock = threading.Lock()
+
+    def update(self, room, user_id, typing):
+        """Record a typing event. Returns True when the state changed."""
+        key = (room, user_id)
+        with self._lock:
+            was_typing = key in self._typing
+            if typing:
+                self._typing[key] = time.monotonic() + self.timeout
+            else:
+                self._typing.pop(key, None)
+        return was_typing != bool(typing)
+
+    def expire(self):
+        """Drop stale states; returns the (room, user_id) pairs that stopped typing."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, expires_at in self._typing.items() if expires_at < now]
+            for key in expired:
+                del self._typing[key]
+        return expired
+
+    def clear_user(self, user_id):
+        """Stop every typing state of a user; returns the rooms concerned."""
+        with self._lock:
+            keys = [key for key in self._typing if key[1] == user_id]
+            for key in keys:
+                del self._typing[key]
+        return [room for room, _ in keys]
+
+
+class PresenceRegistry:
+    """Which users are online, across every worker.
+
+    Each worker keeps its authenticated sockets in memory (user -> sids, and
+    when each sid was last heard from) and mirrors them in a shared
+    collection, one {_id: sid, userId, seenAt} document per socket. Every
+    `heartbeat` seconds a background thread refreshes seenAt of its live
+    sockets with one update_many, drops sockets silent for more than `ttl`
+    seconds and removes documents left behind by dead workers. A user is
+    online while any of their sockets has a fresh document.
+
+    `on_change(user_id, online)` is called when a user's first socket
+    connects and when their last one goes away, whichever worker held it.
+    """
+
+    def __init__(self, get_collection, on_change, ttl=60, heartbeat=20):
+        self.get_collection = get_collection
+        self.on_change = on_change
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self._users = {}
+        self._sockets = {}
+        self._lock = threading.Lock()
+        self._thread = PerProcess(lambda: start_daemon(self._run, "presence"))
+
+    def connect(self, sid, user_id):
+        with self._lock:
+            already_here = bool(self._users.get(user_id))
+            self._users.setdefault(user_id, set()).add(sid)
+            self._sockets[sid] = (user_id, time.monotonic())
+        self._thread.get()
+
+        collection = self.get_collection()
+        now = datetime.utcnow()
+        online_elsewhere = already_here or collection.find_one(
+            {"userId": user_id, "seenAt": {"$gte": now - timedelta(seconds=self.ttl)}},
+            {"_id": 1}
+        )
+        collection.replace_one({"_id": sid}, {"userId": user_id, "seenAt": now}, upsert=True)
+        if not online_elsewhere:
+            self.on_change(user_id, True)
+
+    def touch(self, sid):
+        """Record activity of a socket. False when it is not registered (never
+        authenticated, or expired after staying silent too long)."""
+        with self._lock:
+            if sid not in self._sockets:
+                return False
+            self._sockets[sid] = (self._sockets[sid][0], time.monotonic())
+            return True
+
+    def disconnect(self, sid):
+        """Forget a socket. Returns its user id when it was the user's last
+        socket on this worker, None otherwise."""
+        with self._lock:
+            user_id = self._forget(sid)
+            last_here = user_id is not None and not self._users.get(user_id)
+        if user_id is None:
+            return None
+        self.get_collection().delete_one({"_id": sid})
+        if not last_here:
+            return None
+        self._announce_if_offline(user_id)
+        return user_id
+
+    def online(self, user_ids):
+        """The subset of `user_ids` that is online."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        return set(self.get_collection().distinct(
+            "userId", {"userId": {"$in": list(user_ids)}, "seenAt": {"$gte": cutoff}}
+        ))
+
+    def _forget(self, sid):
+        entry = self._sockets.pop(sid, None)
+        if entry is None:
+            return None
+        sids = self._users.get(entry[0], set())
+        sids.discard(sid)
+        if not sids:
+            self._users.pop(entry[0], None)
+        return entry[0]
+
+    def _announce_if_offline(self, user_id):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        if not self.get_collection().find_one({"userId": user_id, "seenAt": {"$gte": cutoff}}, {"_id": 1}):
+            self.on_change(user_id, False)
+
+    def _run(self):
+        while True:
+            time.sleep(self.heartbeat)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing presence: {str(e)}")
+
+    def refresh(self):
+        """Heartbeat of this worker's sockets, and expiry of stale ones."""
+        deadline = time.monotonic() - self.ttl
+        with self._lock:
+            silent = [sid for sid, (_, seen) in self._sockets.items() if seen < deadline]
+            users = {self._forget(sid) for sid in silent}
+            gone = [user_id for user_id in users if not self._users.get(user_id)]
+            live = list(self._sockets)
+
+        collection = self.get_collection()
+        now = datetime.utcnow()
+        if silent:
+            collection.delete_many({"_id": {"$in": silent}})
+        if live:
+            collection.update_many({"_id": {"$in": live}}, {"$set": {"seenAt": now}})
+        for user_id in gone:
+            self._announce_if_offline(user_id)
+
+        # Sockets of workers that died without disconnecting them. Whoever
+        # deletes a document reports the user, so each change is announced once.
+        cutoff = now - timedelta(seconds=self.ttl)
+        orphaned = set()
+        for stale in collection.find({"seenAt": {"$lt": cutoff}}, {"userId": 1}).limit(1000):
+            if collection.delete_one({"_id": stale["_id"], "seenAt": {"$lt": cutoff}}).deleted_count:
+                orphaned.add(stale["userId"])
+        for user_id in orphaned:
+            if not collection.find_one({"userId": user_id, "seenAt": {"$gte": cutoff}}, {"_id": 1}):
+                self.on_change(user_id, False)
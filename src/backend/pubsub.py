@@ -0,0 +1,91 @@
+import logging
+import os
+import time
+
+import socketio
+from pymongo import CursorType, MongoClient
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class MongoManager(socketio.PubSubManager):
+    """Socket.IO client manager that relays events between processes and
+    hosts through a capped MongoDB collection.
+
+    Every server appends the events it emits to the collection and tails it
+    with an awaitable tailable cursor, so rooms span all workers with no
+    other infrastructure than the application database. Old events are
+    overwritten once the collection reaches `size` bytes.
+    """
+    name = "mongo"
+
+    def __init__(self, url, channel="flask-socketio", collection="socketio_events",
+                 size=16 * 1024 * 1024, write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.url = url
+        self.collection_name = collection
+        self.size = size
+        self._collection = None
+        self._pid = None
+
+    def _events(self):
+        # One client per process: connections must not be shared across fork()
+        if self._collection is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            db = MongoClient(self.url).get_default_database()
+            try:
+                db.create_collection(self.collection_name, capped=True, size=self.size)
+                # A tailable cursor on an empty collection dies immediately
+                db[self.collection_name].insert_one({"channel": None})
+            except CollectionInvalid:
+                pass
+            self._collection = db[self.collection_name]
+        return self._collection
+
+    def _publish(self, data):
+        for retries_left in range(1, -1, -1):
+            try:
+                return self._events().insert_one({"channel": self.channel, "message": self.json.dumps(data)})
+            except PyMongoError as e:
+                if not retries_left:
+                    self._get_logger().error(f"Cannot publish to mongo, giving up: {str(e)}")
+
+    def _listen(self):
+        # Natural order is insertion order, unlike ObjectIds minted by
+        # different hosts, so the cursor resumes by skipping up to the last
+        # event seen rather than by filtering on _id
+        resume_after = None
+        while True:
+            try:
+                events = self._events()
+                if resume_after is None or not events.find_one({"_id": resume_after}, {"_id": 1}):
+                    # First start, or too far behind: do not replay history
+                    resume_after = events.find_one({}, {"_id": 1}, sort=[("$natural", -1)])["_id"]
+                cursor = events.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+                skipping = True
+                while cursor.alive:
+                    for event in cursor:
+                        if skipping:
+                            skipping = event["_id"] != resume_after
+                            continue
+                        resume_after = event["_id"]
+                        if event.get("channel") == self.channel:
+                            yield event["message"]
+            except PyMongoError as e:
+                self._get_logger().error(f"Mongo pub/sub cursor failed, reconnecting: {str(e)}")
+            time.sleep(0.5)
+
+
+def message_queue_options(url, channel):
+    """SocketIO() keyword arguments for the configured inter-process queue.
+
+    mongodb:// URLs use MongoManager; any other URL (redis://, amqp://,
+    kafka://, zmq+tcp://) goes to Flask-SocketIO's built-in managers. Without
+    a URL, events only reach clients connected to the emitting process.
+    """
+    if not url:
+        return {}
+    if url.startswith(("mongodb://", "mongodb+srv://")):
+        return {"client_manager": MongoManager(url, channel=channel)}
+    return {"message_queue": url, "channel": channel}
@@ -0,0 +1,85 @@
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+from notifications import insert_notifications
+
+logger = logging.getLogger(__name__)
+
+# Identifies this process as a lease holder
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+REMINDER_TITLE = "Rappel de rendez-vous"
+REMINDER_HORIZON = timedelta(hours=24)
+
+
+def acquire_lease(db, name, ttl_seconds, owner=OWNER_ID):
+    """Take or renew the named lease. Returns False while another process holds it."""
+    now = datetime.utcnow()
+    try:
+        db.locks.find_one_and_update(
+            {"_id": name, "$or": [{"owner": owner}, {"expiresAt": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expiresAt": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The lease document exists and belongs to a live owner
+        return False
+
+
+def reminder_key(rdv):
+    # A rescheduled appointment is reminded again for its new date and time
+    return f"reminder:{rdv['_id']}:{rdv['date']}:{rdv['heure']}"
+
+
+def reminder_message(rdv, rdv_datetime, now):
+    day = "aujourd'hui" if rdv_datetime.date() == now.date() else "demain"
+    return f"Rappel : votre rendez-vous avec {rdv['doctorName']} le {rdv['date']} à {rdv['heure']} est {day}."
+
+
+def send_appointment_reminders(db, now=None):
+    """Remind patients of every confirmed appointment in the next 24 hours.
+
+    Each reminder carries a unique dedupKey, so re-running (or catching up
+    after downtime) never reminds the same appointment slot twice. Returns
+    the reminders actually inserted.
+    """
+    now = now or datetime.now()
+    horizon = now + REMINDER_HORIZON
+
+    appointments = db.rendezvous.find(
+        {
+            "status": "confirmed",
+            "date": {"$gte": now.strftime("%Y-%m-%d"), "$lte": horizon.strftime("%Y-%m-%d")}
+        },
+        {"patientId": 1, "doctorName": 1, "date": 1, "heure": 1}
+    )
+
+    notifications = []
+    for rdv in appointments:
+        try:
+            rdv_datetime = datetime.strptime(f"{rdv['date']} {rdv['heure']}", "%Y-%m-%d %H:%M")
+        except (KeyError, ValueError):
+            continue
+        if now <= rdv_datetime <= horizon:
+            notifications.append({
+                "userId": rdv["patientId"],
+                "titre": REMINDER_TITLE,
+                "message": reminder_message(rdv, rdv_datetime, now),
+                "date": datetime.utcnow(),
+                "read": False,
+                "dedupKey": reminder_key(rdv)
+            })
+
+    if not notifications:
+        return []
+
+    sent = insert_notifications(db.notifications, notifications)
+    if sent:
+        logger.info(f"Sent {len(sent)} appointment reminders")
+    return sent
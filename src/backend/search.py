@@ -0,0 +1,160 @@
+import bisect
+import heapq
+import re
+import unicodedata
+from collections import defaultdict
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+# Score of a query token matching a name / specialty token
+EXACT_NAME, PREFIX_NAME = 4.0, 3.0
+EXACT_SPECIALTY, PREFIX_SPECIALTY = 2.0, 1.5
+# Fuzzy matches score their trigram similarity times this weight
+FUZZY_WEIGHT = 1.0
+FUZZY_THRESHOLD = 0.45
+# Trigrams score one dropped or swapped letter of a short word low ("hlene" /
+# "helene" 0.44, "matrin" / "martin" 0.27), so a candidate within this many
+# edits (insertion, deletion, substitution or transposition) of the query
+# token also matches, scoring as if it were a similarity of 1 - edits / length.
+# (minimum token length, edits allowed), longest first
+MAX_EDITS = ((8, 2), (4, 1))
+
+
+def fold(text):
+    """Lowercase and strip accents: "Hélène Çelik" -> "helene celik"."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return _NON_ALNUM.sub(" ", stripped.lower()).strip()
+
+
+def tokenize(text):
+    return fold(text).split()
+
+
+def _max_edits(token):
+    for min_length, edits in MAX_EDITS:
+        if len(token) >= min_length:
+            return edits
+    return 0
+
+
+def edit_distance(a, b, limit):
+    """Optimal string alignment distance between `a` and `b` (a transposition
+    counts as one edit), or limit + 1 when it exceeds `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return current[-1]
+
+
+def _trigrams(token):
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _Field:
+    """Inverted index of one text field: token -> doctor ids, plus a sorted
+    vocabulary for prefix lookups and a trigram index for typo tolerance."""
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.trigrams = defaultdict(set)
+        self.vocabulary = []
+
+    def add(self, doc_id, text):
+        for token in tokenize(text):
+            self.postings[token].add(doc_id)
+
+    def freeze(self):
+        self.vocabulary = sorted(self.postings)
+        for token in self.vocabulary:
+            for trigram in _trigrams(token):
+                self.trigrams[trigram].add(token)
+
+    def match(self, token, exact_score, prefix_score, scores):
+        ids = self.postings.get(token)
+        if ids:
+            for doc_id in ids:
+                scores[doc_id] = max(scores.get(doc_id, 0), exact_score)
+
+        start = bisect.bisect_left(self.vocabulary, token)
+        for candidate in self.vocabulary[start:]:
+            if not candidate.startswith(token):
+                break
+            if candidate == token:
+                continue
+            for doc_id in self.postings[candidate]:
+                scores[doc_id] = max(scores.get(doc_id, 0), prefix_score)
+
+    def fuzzy(self, token, scores):
+        query = _trigrams(token)
+        shared = defaultdict(int)
+        for trigram in query:
+            for candidate in self.trigrams.get(trigram, ()):
+                shared[candidate] += 1
+        max_edits = _max_edits(token)
+        for candidate, count in shared.items():
+            similarity = count / len(query | _trigrams(candidate))
+            if similarity < FUZZY_THRESHOLD:
+                edits = edit_distance(token, candidate, max_edits)
+                if edits > max_edits:
+                    continue
+                similarity = 1 - edits / max(len(token), len(candidate))
+            for doc_id in self.postings[candidate]:
+                scores[doc_id] = max(scores.get(doc_id, 0), FUZZY_WEIGHT * similarity)
+
+
+class DoctorSearchIndex:
+    """In-memory accent- and case-insensitive search over doctor name and
+    specialty with prefix matching, trigram typo tolerance and ranking."""
+
+    def __init__(self, doctors):
+        self.names = {}
+        self._name = _Field()
+        self._specialty = _Field()
+        for doc in doctors:
+            doc_id = str(doc["_id"])
+            self.names[doc_id] = fold(doc.get("nom"))
+            self._name.add(doc_id, doc.get("nom"))
+            self._specialty.add(doc_id, doc.get("specialite"))
+        self._name.freeze()
+        self._specialty.freeze()
+
+    def search(self, query, limit=None):
+        """Return ([(doctor_id, score)] best first, total matches).
+
+        Every query token must match. Only the best `limit` results are
+        ranked when a limit is given.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return [], 0
+
+        totals = None
+        for token in tokens:
+            scores = {}
+            self._name.match(token, EXACT_NAME, PREFIX_NAME, scores)
+            self._specialty.match(token, EXACT_SPECIALTY, PREFIX_SPECIALTY, scores)
+            if not scores and len(token) >= 3:
+                self._name.fuzzy(token, scores)
+                self._specialty.fuzzy(token, scores)
+            if totals is None:
+                totals = scores
+            else:
+                totals = {doc_id: totals[doc_id] + score for doc_id, score in scores.items() if doc_id in totals}
+            if not totals:
+                return [], 0
+
+        rank = lambda item: (-item[1], self.names[item[0]])
+        if limit is None:
+            return sorted(totals.items(), key=rank), len(totals)
+        return heapq.nsmallest(limit, totals.items(), key=rank), len(totals)
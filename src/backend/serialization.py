@@ -0,0 +1,172 @@
+import json
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+# orjson is optional: without it responses use the standard library encoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def format_datetime(value):
+    """API form of a stored datetime (naive UTC): "YYYY-MM-DD HH:MM"."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(" ", "minutes")
+
+
+def encode_default(value):
+    """Encode the values JSON has no type for: ObjectIds as their hex string,
+    datetimes with format_datetime(), anything else as Flask does."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    return DefaultJSONProvider.default(value)
+
+
+if orjson is not None:
+    # Dates go through encode_default rather than orjson's RFC 3339 output
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider encoding with orjson.
+
+    Route code can return ObjectIds and datetimes as read from Mongo (see
+    encode_default). Output is UTF-8 rather than ASCII-escaped; `sort_keys`
+    and `compact` behave as in Flask. Falls back to the standard library
+    encoder when orjson is missing, for calls with json.dumps() keyword
+    arguments, and for values orjson refuses (integers beyond 64 bits).
+    """
+    default = staticmethod(encode_default)
+
+    def _options(self, indent=False):
+        options = _ORJSON_OPTIONS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        try:
+            body = orjson.dumps(obj, default=self.default, option=self._options(indent) | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+class SocketJSON:
+    """`json` module for python-socketio packets and the pub/sub queue, so
+    Socket.IO payloads are encoded like HTTP responses."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        if orjson is None:
+            return json.dumps(obj, default=encode_default, separators=(",", ":"))
+        return orjson.dumps(obj, default=encode_default, option=_ORJSON_OPTIONS).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        if orjson is None:
+            return json.loads(s)
+        return orjson.loads(s)
+
+
+# Row serializers shared by the endpoints. They return stored ObjectIds and
+# datetimes as they are and leave their encoding to the JSON provider.
+def appointment_row(rdv, **party):
+    """A rendezvous as listed to one side; `party` holds the other side's fields."""
+    return {
+        "_id": rdv["_id"],
+        **party,
+        "date": rdv["date"],
+        "heure": rdv["heure"],
+        "status": rdv["status"],
+        "createdAt": rdv.get("createdAt") or ""
+    }
+
+
+def consultation_row(c, **extra):
+    return {
+        **extra,
+        "date": c.get("date"),
+        "diagnostic": c.get("diagnostic", ""),
+        "prescription": c.get("prescription", ""),
+        "consultationType": c.get("consultationType", ""),
+        "documentIds": c.get("documentIds", [])
+    }
+
+
+def document_row(doc, patient_name, **extra):
+    return {
+        "id": doc["_id"],
+        "title": doc["title"],
+        "patientId": doc["patientId"],
+        "patientName": patient_name,
+        **extra,
+        "fileId": doc["fileId"],
+        "hasThumbnail": "thumbnailId" in doc,
+        "consulted": doc["consulted"],
+        "annotations": doc.get("annotations", []),
+        "conversationId": doc.get("conversationId"),
+        "date": doc.get("date") or ""
+    }
+
+
+def notification_row(n):
+    return {
+        "_id": n["_id"],
+        "titre": n["titre"],
+        "message": n["message"],
+        "date": n.get("date") or "",
+        "read": n.get("read", False)
+    }
+
+
+def message_row(msg, sender_name):
+    return {
+        "id": msg["_id"],
+        "conversationId": msg["conversationId"],
+        "senderId": msg["senderId"],
+        "senderName": sender_name,
+        "content": msg["content"],
+        "type": msg.get("type", "text"),
+        "timestamp": msg.get("timestamp") or ""
+    }
+
+
+def conversation_row(conv, role):
+    """An inbox entry as seen by the conversation's `role` ("patient" or "doctor")."""
+    other_party_name = conv.get("doctorName") if role == "patient" else conv.get("patientName")
+    return {
+        "id": conv["_id"],
+        "patientId": conv["patientId"],
+        "doctorId": conv["doctorId"],
+        "otherPartyName": other_party_name or "Inconnu",
+        "createdAt": conv.get("createdAt") or "",
+        "lastMessageAt": conv.get("lastMessageAt") or "",
+        "lastMessage": conv.get("lastMessage"),
+        "unreadCount": conv.get(f"{role}Unread", 0)
+    }
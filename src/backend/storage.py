@@ -0,0 +1,161 @@
+import hashlib
+import logging
+from collections import Counter
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+
+from bson.objectid import ObjectId
+from gridfs import GridFS
+from gridfs.errors import FileExists
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# Read uploads in GridFS-chunk-sized pieces
+READ_SIZE = 255 * 1024
+
+
+class FileTooLarge(Exception):
+    """An uploaded file exceeds the per-file size limit."""
+
+
+class LimitedUploadFile(SpooledTemporaryFile):
+    """Spool for one multipart upload, as werkzeug's default one (in memory up
+    to 500 KB, then on disk), that raises FileTooLarge as soon as more than
+    `limit` bytes are written, instead of spooling the rest of the body."""
+
+    def __init__(self, limit, filename=None):
+        super().__init__(max_size=500 * 1024, mode="rb+")
+        self.limit = limit
+        self.filename = filename
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise FileTooLarge(self.filename)
+        return super().write(data)
+
+
+class ContentStore:
+    """Content-addressed, reference-counted GridFS storage.
+
+    Uploads are hashed with SHA-256 while they stream into GridFS. When the
+    same content is already stored, the new copy is dropped and the existing
+    file gains a reference instead. `refs` on the fs.files document counts
+    the documents/consultations records pointing at the file; releasing the
+    last reference deletes it. `lastRefAt` marks the latest reference taken,
+    so garbage collection leaves files alone while their records may still
+    be in flight.
+    """
+
+    def __init__(self, get_db, max_file_size=None):
+        self.get_db = get_db
+        self.max_file_size = max_file_size
+
+    def put(self, stream, filename, content_type):
+        """Store `stream` and return the ObjectId of the file holding its content."""
+        db = self.get_db()
+        grid_in = GridFS(db).new_file(filename=filename, content_type=content_type)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            while True:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    break
+                size += len(data)
+                if self.max_file_size and size > self.max_file_size:
+                    raise FileTooLarge(filename)
+                digest.update(data)
+                grid_in.write(data)
+        except BaseException:
+            grid_in.abort()
+            raise
+
+        sha256 = digest.hexdigest()
+        for _ in range(2):
+            existing = self._add_reference(db, sha256)
+            if existing:
+                grid_in.abort()
+                return existing
+            grid_in.sha256 = sha256
+            grid_in.refs = 1
+            grid_in.lastRefAt = datetime.utcnow()
+            try:
+                grid_in.close()
+                return grid_in._id
+            except FileExists:
+                # The same content was stored concurrently; reference that copy
+                pass
+        grid_in.abort()
+        raise RuntimeError(f"Could not store {filename}")
+
+    def release(self, file_id):
+        """Drop one reference to a stored file, deleting it with the last one."""
+        db = self.get_db()
+        file_id = ObjectId(file_id)
+        stored = db.fs.files.find_one_and_update(
+            {"_id": file_id, "sha256": {"$exists": True}},
+            {"$inc": {"refs": -1}},
+            projection={"refs": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if stored and stored["refs"] <= 0:
+            self._delete_if_unreferenced(db, file_id)
+
+    def collect_garbage(self, grace):
+        """Reconcile reference counts with documents and consultations and
+        delete unreferenced files not referenced within `grace` (a timedelta).
+        Returns the number of deleted files."""
+        db = self.get_db()
+        cutoff = datetime.utcnow() - grace
+
+        references = Counter()
+        for row in db.documents.aggregate([
+            {"$group": {"_id": "$fileId", "refs": {"$sum": 1}}}
+        ]):
+            references[row["_id"]] += row["refs"]
+        for row in db.consultations.aggregate([
+            {"$unwind": "$documentIds"},
+            {"$group": {"_id": "$documentIds", "refs": {"$sum": 1}}}
+        ]):
+            references[row["_id"]] += row["refs"]
+
+        deleted = 0
+        for stored in db.fs.files.find({"sha256": {"$exists": True}, "lastRefAt": {"$lt": cutoff}}, {"refs": 1}):
+            actual = references.get(str(stored["_id"]), 0)
+            if actual != stored.get("refs"):
+                # Compare-and-set, skipping files released since they were read
+                updated = db.fs.files.update_one(
+                    {"_id": stored["_id"], "refs": stored.get("refs")},
+                    {"$set": {"refs": actual}}
+                )
+                if not updated.modified_count:
+                    continue
+            if actual == 0 and self._delete_if_unreferenced(db, stored["_id"]):
+                deleted += 1
+
+        if deleted:
+            logger.info(f"Deleted {deleted} unreferenced files")
+        return deleted
+
+    @staticmethod
+    def _add_reference(db, sha256):
+        stored = db.fs.files.find_one_and_update(
+            {"sha256": sha256},
+            {"$inc": {"refs": 1}, "$set": {"lastRefAt": datetime.utcnow()}},
+            projection={"_id": 1}
+        )
+        return stored["_id"] if stored else None
+
+    @staticmethod
+    def _delete_if_unreferenced(db, file_id):
+        # A concurrent upload of the same content may have taken a new reference
+        deleted = db.fs.files.find_one_and_delete({"_id": file_id, "refs": {"$lte": 0}}, projection={"thumbnailId": 1})
+        if not deleted:
+            return False
+        db.fs.chunks.delete_many({"files_id": file_id})
+        if deleted.get("thumbnailId"):
+            GridFS(db).delete(deleted["thumbnailId"])
+        return True
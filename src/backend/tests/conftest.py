@@ -0,0 +1,54 @@
+import os
+import sys
+
+import mongomock
+import mongomock.gridfs
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock.gridfs.enable_gridfs_integration()
+
+import app as appmod  # noqa: E402
+from config import INDEXES  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh in-memory database behind the app."""
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(appmod.mongo, "db", db)
+    return db
+
+
+@pytest.fixture
+def indexes(db):
+    """indexes(*collections) creates the INDEXES of these collections. mongomock
+    honours partialFilterExpression on writes, not when indexing existing
+    documents, so call it before inserting anything."""
+    def indexes(*collections):
+        for collection in collections:
+            for keys, options in INDEXES[collection]:
+                db[collection].create_index(keys, **options)
+    return indexes
+
+
+@pytest.fixture
+def client(db):
+    return appmod.app.test_client()
+
+
+@pytest.fixture
+def register():
+    """register(client, role, name) -> {"token", "user_id"} of a new account."""
+    def register(client, role, name):
+        response = client.post("/register", json={
+            "name": name,
+            "email": f"{name.replace(' ', '-')}@test.local",
+            "password": "secret",
+            "role": role,
+            "specialite": "Cardiologie"
+        })
+        assert response.status_code == 201, response.get_json()
+        return response.get_json()
+    return register
@@ -0,0 +1,196 @@
+"""Doctor availability: slot templates, booking bitmaps, booking validation
+and the one-appointment-per-slot guarantee."""
+from datetime import date, timedelta
+
+import pytest
+from bson.objectid import ObjectId
+
+import app as appmod
+from availability import DEFAULT_HOURS, AvailabilityEngine, DayTemplate
+
+MONDAY_AFTERNOON = {"Lundi": {"start": "14:00", "end": "16:00"}}
+
+
+def next_monday():
+    today = date.today()
+    return today + timedelta(days=7 + (-today.weekday()) % 7)
+
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def doctor(client, register, indexes):
+    indexes("rendezvous")
+    doctor = register(client, "medecin", "Dr Slot")
+    appmod.mongo.db.medecins.update_one(
+        {"_id": ObjectId(doctor["user_id"])},
+        {"$set": {"disponibilites": MONDAY_AFTERNOON}}
+    )
+    return doctor
+
+
+def book(client, token, doctor_id, day, heure):
+    return client.post("/rendezvous", json={
+        "date": day.isoformat() if isinstance(day, date) else day,
+        "heure": heure,
+        "doctorId": doctor_id
+    }, headers=auth(token))
+
+
+def test_day_template_numbers_slots_as_bits():
+    template = DayTemplate(DEFAULT_HOURS)
+
+    starts = [start for start, _ in template.slots]
+    assert starts[:4] == ["08:00", "08:35", "09:10", "09:45"]
+    assert starts[7] == "13:00"
+    assert template.slots[0] == ("08:00", "08:30")
+    assert template.full_mask == (1 << len(template.slots)) - 1
+
+    assert template.bit("08:00") == 1
+    assert template.bit("08:35") == 2
+    assert template.bit("08:30") == 0
+    assert template.bit("12:00") == 0
+
+    rendered = template.render(template.bit("08:00") | template.bit("09:10"))
+    assert [slot["available"] for slot in rendered[:4]] == [False, True, False, True]
+    assert all(slot["available"] for slot in rendered[4:])
+
+
+def test_weekly_template_follows_disponibilites():
+    engine = AvailabilityEngine()
+
+    default = engine.weekly_template("doc", None)
+    assert len(default) == 7
+    assert all(day.slots == DayTemplate(DEFAULT_HOURS).slots for day in default)
+
+    week = engine.weekly_template("doc", MONDAY_AFTERNOON)
+    assert [start for start, _ in week[0].slots] == ["14:00", "14:35", "15:10", "15:45"]
+    assert all(not day.slots for day in week[1:])
+    # Cached per doctor until the disponibilites change
+    assert engine.weekly_template("doc", {"lundi": {"start": "14:00", "end": "16:00"}}) is week
+
+
+def test_days_subtracts_bookings():
+    engine = AvailabilityEngine()
+    monday = next_monday()
+    booked = [
+        {"date": monday.isoformat(), "heure": "14:35"},
+        # Off the template or unparseable: ignored
+        {"date": monday.isoformat(), "heure": "14:05"},
+        {"date": "not-a-date", "heure": "14:00"},
+    ]
+
+    days = engine.days("doc", MONDAY_AFTERNOON, booked, monday, monday + timedelta(days=1))
+
+    assert [day["date"] for day in days] == [monday.isoformat(), (monday + timedelta(days=1)).isoformat()]
+    assert days[0]["availableSlots"] == 3
+    assert [slot["available"] for slot in days[0]["slots"]] == [True, False, True, True]
+    assert days[1] == {"date": days[1]["date"], "availableSlots": 0, "slots": []}
+
+
+def test_availability_range_endpoint(client, register, doctor):
+    patient = register(client, "patient", "Pat")
+    monday = next_monday()
+    assert book(client, patient["token"], doctor["user_id"], monday, "15:10").status_code == 201
+
+    response = client.get(
+        f"/doctor_availability/{doctor['user_id']}",
+        query_string={"from": monday.isoformat(), "to": (monday + timedelta(days=6)).isoformat()}
+    )
+
+    assert response.status_code == 200
+    days = response.get_json()["days"]
+    assert len(days) == 7
+    assert days[0]["availableSlots"] == 3
+    assert [slot["start"] for slot in days[0]["slots"] if not slot["available"]] == ["15:10"]
+    assert all(day["availableSlots"] == 0 for day in days[1:])
+
+    single = client.get(f"/doctor_availability/{doctor['user_id']}", query_string={"date": monday.isoformat()})
+    assert single.status_code == 200
+    assert single.get_json()["slots"] == days[0]["slots"]
+
+
+def test_availability_range_is_bounded(client, doctor):
+    monday = next_monday()
+    too_far = monday + timedelta(days=appmod.app.config["AVAILABILITY_MAX_DAYS"])
+    for query in ({"from": monday.isoformat(), "to": too_far.isoformat()},
+                  {"from": monday.isoformat(), "to": (monday - timedelta(days=1)).isoformat()}):
+        response = client.get(f"/doctor_availability/{doctor['user_id']}", query_string=query)
+        assert response.status_code == 400
+
+
+@pytest.mark.parametrize("day,heure,error", [
+    ("2020-01-06", "14:00", "La date/heure doit être dans le futur"),
+    ("lundi", "14:00", "Format de date/heure invalide"),
+    (None, "25:00", "Format de date/heure invalide"),
+    (None, "14:05", "Ce créneau n'est pas proposé par le médecin"),
+    (None, "16:20", "Ce créneau n'est pas proposé par le médecin"),
+    ("tuesday", "14:00", "Ce créneau n'est pas proposé par le médecin"),
+])
+def test_booking_must_start_on_an_offered_slot(client, register, doctor, day, heure, error):
+    patient = register(client, "patient", "Pat")
+    monday = next_monday()
+    day = {None: monday, "tuesday": monday + timedelta(days=1)}.get(day, day)
+
+    response = book(client, patient["token"], doctor["user_id"], day, heure)
+
+    assert response.status_code == 400
+    assert response.get_json()["message"] == error
+    assert appmod.mongo.db.rendezvous.count_documents({}) == 0
+
+
+def test_booking_is_stored_in_canonical_form(client, register, doctor):
+    patient = register(client, "patient", "Pat")
+    monday = next_monday()
+
+    response = book(client, patient["token"], doctor["user_id"], monday, "15:10")
+
+    assert response.status_code == 201
+    stored = appmod.mongo.db.rendezvous.find_one()
+    assert (stored["date"], stored["heure"], stored["slot"]) == (monday.isoformat(), "15:10", "15:10")
+
+
+def test_a_slot_is_booked_once(client, register, doctor):
+    first = register(client, "patient", "First")
+    second = register(client, "patient", "Second")
+    monday = next_monday()
+
+    assert book(client, first["token"], doctor["user_id"], monday, "14:00").status_code == 201
+    taken = book(client, second["token"], doctor["user_id"], monday, "14:00")
+    assert taken.status_code == 409
+    assert taken.get_json()["message"] == "Ce créneau horaire est déjà réservé"
+
+    other = book(client, second["token"], doctor["user_id"], monday, "14:35")
+    assert other.status_code == 201
+    rdv_id = other.get_json()["rendezvous"]["id"]
+    moved = client.put(f"/rendezvous/{rdv_id}", json={"date": monday.isoformat(), "heure": "14:00"},
+                       headers=auth(second["token"]))
+    assert moved.status_code == 409
+    assert appmod.mongo.db.rendezvous.find_one({"_id": ObjectId(rdv_id)})["slot"] == "14:35"
+
+
+def test_backfill_flags_legacy_double_bookings(db, indexes):
+    indexes("rendezvous")
+    legacy = [
+        {"doctorId": "doc", "date": "2030-01-07", "heure": "14:00", "status": "pending"},
+        {"doctorId": "doc", "date": "2030-01-07", "heure": "14:00", "status": "confirmed"},
+        {"doctorId": "doc", "date": "2030-01-07", "heure": "14:00", "status": "cancelled"},
+        {"doctorId": "doc", "date": "2030-01-07", "heure": "9:10", "status": "pending"},
+    ]
+    ids = db.rendezvous.insert_many(legacy).inserted_ids
+
+    filled, conflicts = appmod.backfill_booking_slots()
+
+    # The confirmed appointment keeps the slot even though it is not the oldest
+    assert (filled, conflicts) == (2, [ids[0], ids[2]])
+    stored = {rdv["_id"]: rdv for rdv in db.rendezvous.find()}
+    assert stored[ids[1]]["slot"] == "14:00"
+    assert stored[ids[3]]["slot"] == "09:10"
+    for conflict in (ids[0], ids[2]):
+        assert stored[conflict]["slotConflict"] is True
+        assert "slot" not in stored[conflict]
+
+    # Flagged appointments are left for manual resolution
+    assert appmod.backfill_booking_slots() == (0, [])
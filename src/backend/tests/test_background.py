@@ -0,0 +1,31 @@
+"""Per-process background resources and the write-behind queues built on them."""
+import mongomock
+
+import background
+from background import PerProcess
+from notifications import NotificationDispatcher
+
+
+def test_created_once_per_process(monkeypatch):
+    created = []
+    resource = PerProcess(lambda: created.append(object()) or created[-1])
+    assert resource.current() is None
+    first = resource.get()
+    assert resource.get() is first and resource.current() is first and len(created) == 1
+
+    # A forked worker gets its own
+    monkeypatch.setattr(background.os, "getpid", lambda: -1)
+    assert resource.current() is None
+    assert resource.get() is not first and len(created) == 2
+
+
+def test_dispatcher_thread_writes_and_stop_drains():
+    db = mongomock.MongoClient().db
+    dispatcher = NotificationDispatcher(lambda: db.notifications, flush_interval=0.01)
+    inserted = []
+    dispatcher.on_insert(inserted.extend)
+    for i in range(5):
+        dispatcher.enqueue({"userId": "u", "n": i})
+    dispatcher.stop()
+    assert db.notifications.count_documents({}) == 5
+    assert sorted(n["n"] for n in inserted) == list(range(5))
@@ -0,0 +1,81 @@
+"""Chat messages over HTTP and Socket.IO: validation and room membership."""
+import pytest
+
+import app as appmod
+
+
+@pytest.fixture
+def conversation(client, register):
+    patient = register(client, "patient", "Pat")
+    doctor = register(client, "medecin", "Dr Who")
+    response = client.post(
+        "/messages/conversations",
+        json={"doctorId": doctor["user_id"]},
+        headers={"Authorization": f"Bearer {patient['token']}"}
+    )
+    assert response.status_code == 201
+    return response.get_json()["id"], patient["token"], doctor["token"]
+
+
+def socket(client, token=None):
+    return appmod.socketio.test_client(
+        appmod.app, flask_test_client=client, auth={"token": token} if token else None
+    )
+
+
+INVALID = [
+    ({"content": None}, "Contenu requis"),
+    ({"content": 5}, "Contenu invalide"),
+    ({"content": ["x"]}, "Contenu invalide"),
+    ({"content": "x" * 5001}, "Message trop long"),
+    ({"content": "ok", "type": {"$gt": ""}}, "Type de message invalide"),
+    ({"content": "ok", "type": "image"}, "Type de message invalide"),
+    ({"content": "ok", "clientId": 3}, "clientId invalide"),
+]
+
+
+@pytest.mark.parametrize("body,error", INVALID)
+def test_http_rejects_invalid_messages(client, conversation, body, error):
+    conversation_id, patient_token, _ = conversation
+    response = client.post(f"/messages/{conversation_id}", json=body,
+                           headers={"Authorization": f"Bearer {patient_token}"})
+    assert response.status_code == 400
+    assert response.get_json()["message"].startswith(error)
+    assert appmod.mongo.db.messages.count_documents({}) == 0
+
+
+@pytest.mark.parametrize("body,error", INVALID)
+def test_socket_rejects_invalid_messages(client, conversation, body, error):
+    conversation_id, patient_token, _ = conversation
+    ack = socket(client, patient_token).emit("send_message", {"conversationId": conversation_id, **body}, callback=True)
+    assert ack["error"].startswith(error)
+    assert appmod.mongo.db.messages.count_documents({}) == 0
+
+
+@pytest.mark.parametrize("msg_type", ["text", "document"])
+def test_valid_message_is_stored(client, conversation, msg_type):
+    conversation_id, patient_token, _ = conversation
+    response = client.post(f"/messages/{conversation_id}", json={"content": "Bonjour", "type": msg_type},
+                           headers={"Authorization": f"Bearer {patient_token}"})
+    assert response.status_code == 201
+    assert appmod.mongo.db.messages.find_one()["type"] == msg_type
+
+
+def test_only_members_join_the_conversation_room(client, conversation, register):
+    conversation_id, patient_token, doctor_token = conversation
+    outsider = register(client, "patient", "Eve")
+    anonymous, intruder = socket(client), socket(client, outsider["token"])
+    member = socket(client, doctor_token)
+
+    assert anonymous.emit("join_conversation", {"conversationId": conversation_id}, callback=True) == \
+        {"error": "Authentification requise"}
+    assert intruder.emit("join_conversation", {"conversationId": conversation_id}, callback=True) == \
+        {"error": "Accès refusé"}
+    assert member.emit("join_conversation", {"conversationId": "missing"}, callback=True) == \
+        {"error": "Conversation non trouvée"}
+    assert member.emit("join_conversation", {"conversationId": conversation_id}, callback=True) == {"ok": True}
+
+    client.post(f"/messages/{conversation_id}", json={"content": "Bonjour"},
+                headers={"Authorization": f"Bearer {patient_token}"})
+    assert [event["name"] for event in member.get_received()] == ["new_message"]
+    assert intruder.get_received() == []
@@ -0,0 +1,110 @@
+"""Per-doctor, per-day appointment counters kept in step with the rendezvous
+routes, and their rebuild from the appointments themselves."""
+from datetime import date, timedelta
+
+import pytest
+
+import app as appmod
+
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def occupancy(doctor_id):
+    return {
+        day["date"]: (day["booked"], day["confirmed"])
+        for day in appmod.mongo.db.occupancy.find({"doctorId": doctor_id})
+    }
+
+
+@pytest.fixture
+def accounts(client, register, indexes):
+    indexes("rendezvous", "occupancy")
+    return register(client, "patient", "Pat"), register(client, "medecin", "Dr Count")
+
+
+def book(client, patient, doctor, day, heure):
+    response = client.post("/rendezvous", json={"date": day, "heure": heure, "doctorId": doctor["user_id"]},
+                           headers=auth(patient["token"]))
+    assert response.status_code == 201, response.get_json()
+    return response.get_json()["rendezvous"]["id"]
+
+
+def set_status(client, doctor, rdv_id, status):
+    response = client.put(f"/rendezvous/{rdv_id}/status", json={"status": status}, headers=auth(doctor["token"]))
+    assert response.status_code == 200
+
+
+def test_counters_follow_appointments(client, accounts):
+    patient, doctor = accounts
+    doctor_id = doctor["user_id"]
+    day1 = (date.today() + timedelta(days=2)).isoformat()
+    day2 = (date.today() + timedelta(days=3)).isoformat()
+
+    first = book(client, patient, doctor, day1, "08:00")
+    second = book(client, patient, doctor, day1, "08:35")
+    assert occupancy(doctor_id) == {day1: (2, 0)}
+
+    set_status(client, doctor, first, "confirmed")
+    set_status(client, doctor, first, "confirmed")
+    assert occupancy(doctor_id) == {day1: (2, 1)}
+    set_status(client, doctor, first, "pending")
+    assert occupancy(doctor_id) == {day1: (2, 0)}
+    set_status(client, doctor, first, "confirmed")
+
+    # Rescheduling moves both counters to the new day, a new time on the same day moves nothing
+    moved = client.put(f"/rendezvous/{first}", json={"date": day2, "heure": "09:10"}, headers=auth(patient["token"]))
+    assert moved.status_code == 200
+    assert occupancy(doctor_id) == {day1: (1, 0), day2: (1, 1)}
+    moved = client.put(f"/rendezvous/{first}", json={"date": day2, "heure": "09:45"}, headers=auth(patient["token"]))
+    assert moved.status_code == 200
+    assert occupancy(doctor_id) == {day1: (1, 0), day2: (1, 1)}
+
+    calendar = client.get(f"/doctor_calendar/{doctor_id}", query_string={"year": day2[:4], "month": int(day2[5:7])})
+    counted = {day["date"]: (day["booked"], day["confirmed"]) for day in calendar.get_json()["calendar"]}
+    assert counted[day2] == (1, 1)
+
+    assert client.delete(f"/rendezvous/{first}", headers=auth(doctor["token"])).status_code == 200
+    assert client.delete(f"/rendezvous/{second}", headers=auth(patient["token"])).status_code == 200
+    assert occupancy(doctor_id) == {day1: (0, 0), day2: (0, 0)}
+
+
+def test_refused_booking_is_not_counted(client, accounts):
+    patient, doctor = accounts
+    day = (date.today() + timedelta(days=2)).isoformat()
+    book(client, patient, doctor, day, "08:00")
+
+    taken = client.post("/rendezvous", json={"date": day, "heure": "08:00", "doctorId": doctor["user_id"]},
+                        headers=auth(patient["token"]))
+
+    assert taken.status_code == 409
+    assert occupancy(doctor["user_id"]) == {day: (1, 0)}
+
+
+def test_rebuild_recomputes_counters(db):
+    db.rendezvous.insert_many([
+        {"doctorId": "doc", "date": "2030-01-07", "heure": "08:00", "status": "confirmed"},
+        {"doctorId": "doc", "date": "2030-01-07", "heure": "08:35", "status": "pending"},
+        {"doctorId": "doc", "date": "2030-01-08", "heure": "08:00", "status": "cancelled"},
+        {"doctorId": "other", "date": "2030-01-07", "heure": "08:00", "status": "confirmed"},
+    ])
+    # Drifted counters, including a day that no longer has any appointment
+    db.occupancy.insert_many([
+        {"doctorId": "doc", "date": "2030-01-07", "booked": 7, "confirmed": -1},
+        {"doctorId": "doc", "date": "2030-01-09", "booked": 1, "confirmed": 0},
+    ])
+
+    appmod.rebuild_occupancy()
+
+    assert occupancy("doc") == {"2030-01-07": (2, 1), "2030-01-08": (1, 0)}
+    assert occupancy("other") == {"2030-01-07": (1, 1)}
+
+
+def test_rebuild_waits_for_the_lease(db):
+    db.rendezvous.insert_one({"doctorId": "doc", "date": "2030-01-07", "heure": "08:00", "status": "pending"})
+    assert appmod.acquire_lease(db, "rebuild_occupancy", 3600, owner="another-process")
+
+    appmod.rebuild_occupancy()
+
+    assert occupancy("doc") == {}
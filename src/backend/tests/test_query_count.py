@@ -0,0 +1,121 @@
+"""The list endpoints join referenced names in batches: the number of Mongo
+queries they issue must not grow with the number of rows listed.
+
+mongomock does not emit pymongo command events, so each collection call is
+counted through the app's QueryCounter instead.
+"""
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from bson.objectid import ObjectId
+
+import app as appmod
+
+COUNTED_METHODS = (
+    "find", "find_one", "aggregate", "distinct", "count_documents",
+    "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+    "delete_one", "delete_many", "find_one_and_update", "bulk_write",
+)
+
+ENDPOINTS = (
+    ("patient", "/rendezvous"),
+    ("doctor", "/doctor/rendezvous"),
+    ("doctor", "/documents_patients"),
+    ("patient", "/messages/conversations"),
+    ("patient", "/messages/{conversation_id}"),
+)
+
+
+@pytest.fixture
+def count_queries(monkeypatch):
+    counter = appmod.QueryCounter()
+    for name in COUNTED_METHODS:
+        method = getattr(mongomock.collection.Collection, name)
+
+        def counted(self, *args, _method=method, **kwargs):
+            counter.started(None)
+            return _method(self, *args, **kwargs)
+
+        monkeypatch.setattr(mongomock.collection.Collection, name, counted)
+
+
+@pytest.fixture
+def make_client(monkeypatch, count_queries, register):
+    monkeypatch.setitem(appmod.app.config, "QUERY_COUNT_HEADER", True)
+
+    def make_client(rows):
+        db = mongomock.MongoClient().db
+        monkeypatch.setattr(appmod.mongo, "db", db)
+        client = appmod.app.test_client()
+        patient = register(client, "patient", f"patient {rows}")
+        doctor = register(client, "medecin", f"medecin {rows}")
+        conversation_id = seed(db, patient["user_id"], doctor["user_id"], rows)
+        tokens = {"patient": patient["token"], "doctor": doctor["token"]}
+        return client, tokens, conversation_id
+
+    return make_client
+
+
+def seed(db, patient_id, doctor_id, rows):
+    """`rows` appointments, documents, conversations and messages, each
+    referring to a different doctor or patient."""
+    start = datetime.utcnow()
+    doctor_ids = [str(i) for i in db.medecins.insert_many(
+        [{"nom": f"Dr {i}", "specialite": "Cardiologie"} for i in range(rows)]
+    ).inserted_ids]
+    patient_ids = [str(i) for i in db.users.insert_many(
+        [{"name": f"Patient {i}", "role": "patient"} for i in range(rows)]
+    ).inserted_ids]
+
+    db.rendezvous.insert_many(
+        [
+            {"patientId": patient_id, "doctorId": other, "date": "2030-01-07", "heure": "09:00",
+             "status": "pending", "createdAt": start}
+            for other in doctor_ids
+        ] + [
+            {"patientId": other, "doctorId": doctor_id, "date": "2030-01-07", "heure": "09:00",
+             "status": "pending", "createdAt": start}
+            for other in patient_ids
+        ]
+    )
+    db.documents.insert_many([
+        {"title": f"Document {i}", "patientId": other, "doctorId": doctor_id, "fileId": str(ObjectId()),
+         "consulted": False, "date": start}
+        for i, other in enumerate(patient_ids)
+    ])
+    db.conversations.insert_many([
+        {"patientId": patient_id, "patientName": "patient", "doctorId": other, "doctorName": f"Dr {i}",
+         "createdAt": start, "lastMessageAt": start + timedelta(seconds=i)}
+        for i, other in enumerate(doctor_ids)
+    ])
+    conversation_id = str(db.conversations.insert_one(
+        {"patientId": patient_id, "patientName": "patient", "doctorId": doctor_id, "doctorName": "medecin",
+         "createdAt": start}
+    ).inserted_id)
+    # Messages written before senderName was stored fall back to the conversation's names
+    db.messages.insert_many([
+        {"conversationId": conversation_id, "senderId": (patient_id, doctor_id)[i % 2],
+         **({"senderName": "patient"} if i % 3 else {}),
+         "content": f"Message {i}", "type": "text", "timestamp": start + timedelta(seconds=i)}
+        for i in range(rows)
+    ])
+    return conversation_id
+
+
+def query_count(client, token, path):
+    response = client.get(path, headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200, response.get_json()
+    return len(response.get_json()), int(response.headers["X-Query-Count"])
+
+
+@pytest.mark.parametrize("role,path", ENDPOINTS)
+def test_query_count_does_not_grow_with_rows(make_client, role, path):
+    rows = 5
+    counts = []
+    for size in (rows, 10 * rows):
+        client, tokens, conversation_id = make_client(size)
+        listed, queries = query_count(client, tokens[role], path.format(conversation_id=conversation_id))
+        assert listed >= size
+        counts.append(queries)
+    assert counts[0] == counts[1]
@@ -0,0 +1,79 @@
+"""Appointment reminders: the leader lease and reminder deduplication."""
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as appmod
+from reminders import acquire_lease, reminder_key, send_appointment_reminders
+
+NOW = datetime(2030, 1, 7, 9, 0)
+
+
+@pytest.fixture
+def reminders_db(db, indexes):
+    indexes("notifications")
+    return db
+
+
+def appointment(db, day, heure, status="confirmed"):
+    rdv = {"patientId": "pat", "doctorName": "Dr Rappel", "date": day, "heure": heure, "status": status}
+    db.rendezvous.insert_one(rdv)
+    return rdv
+
+
+def test_lease_is_exclusive_until_it_expires(db):
+    assert acquire_lease(db, "job", 60, owner="a")
+    assert not acquire_lease(db, "job", 60, owner="b")
+    # The holder renews it
+    assert acquire_lease(db, "job", 60, owner="a")
+    assert acquire_lease(db, "other job", 60, owner="b")
+
+    db.locks.update_one({"_id": "job"}, {"$set": {"expiresAt": datetime.utcnow() - timedelta(seconds=1)}})
+    assert acquire_lease(db, "job", 60, owner="b")
+    assert not acquire_lease(db, "job", 60, owner="a")
+
+
+def test_reminds_confirmed_appointments_of_the_next_day_once(reminders_db):
+    db = reminders_db
+    today = appointment(db, "2030-01-07", "14:00")
+    tomorrow = appointment(db, "2030-01-08", "08:00")
+    appointment(db, "2030-01-07", "08:00")  # already past
+    appointment(db, "2030-01-08", "10:00")  # beyond 24 hours
+    appointment(db, "2030-01-07", "15:10", status="pending")
+
+    sent = send_appointment_reminders(db, now=NOW)
+
+    assert sorted(reminder["dedupKey"] for reminder in sent) == sorted([reminder_key(today), reminder_key(tomorrow)])
+    messages = {reminder["dedupKey"]: reminder["message"] for reminder in sent}
+    assert messages[reminder_key(today)].endswith("est aujourd'hui.")
+    assert messages[reminder_key(tomorrow)].endswith("est demain.")
+
+    # Later runs within the same window send nothing new
+    assert send_appointment_reminders(db, now=NOW) == []
+    assert send_appointment_reminders(db, now=NOW + timedelta(minutes=15)) == []
+    assert db.notifications.count_documents({}) == 2
+
+
+def test_rescheduled_appointment_is_reminded_again(reminders_db):
+    db = reminders_db
+    rdv = appointment(db, "2030-01-07", "14:00")
+    assert len(send_appointment_reminders(db, now=NOW)) == 1
+
+    db.rendezvous.update_one({"_id": rdv["_id"]}, {"$set": {"heure": "15:10"}})
+    sent = send_appointment_reminders(db, now=NOW)
+
+    assert [reminder["dedupKey"] for reminder in sent] == [f"reminder:{rdv['_id']}:2030-01-07:15:10"]
+    assert db.notifications.count_documents({}) == 2
+
+
+def test_only_the_lease_holder_sends_reminders(reminders_db):
+    soon = datetime.now() + timedelta(hours=2)
+    appointment(reminders_db, soon.strftime("%Y-%m-%d"), soon.strftime("%H:%M"))
+    assert acquire_lease(reminders_db, "appointment_reminders", 60, owner="another-process")
+
+    appmod.run_appointment_reminders()
+    assert reminders_db.notifications.count_documents({}) == 0
+
+    reminders_db.locks.delete_one({"_id": "appointment_reminders"})
+    appmod.run_appointment_reminders()
+    assert reminders_db.notifications.count_documents({}) == 1
@@ -0,0 +1,83 @@
+"""In-memory doctor search: folding, prefixes, ranking and typo tolerance."""
+import pytest
+
+from search import DoctorSearchIndex, edit_distance, fold
+
+DOCTORS = [
+    {"_id": "helene", "nom": "Hélène Çelik", "specialite": "Cardiologie"},
+    {"_id": "martin", "nom": "Paul Martin", "specialite": "Dermatologie"},
+    {"_id": "martine", "nom": "Martine Roux", "specialite": "Cardiologie"},
+    {"_id": "dupont", "nom": "Marc Dupont", "specialite": "Pédiatrie"},
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return DoctorSearchIndex(DOCTORS)
+
+
+def ids(result):
+    return [doctor_id for doctor_id, _ in result[0]]
+
+
+def test_fold_strips_case_and_accents():
+    assert fold("Hélène  Çelik-Ünal") == "helene celik unal"
+
+
+@pytest.mark.parametrize("query,expected", [
+    ("helene", ["helene"]),
+    ("HÉLÈNE", ["helene"]),
+    ("derma", ["martin"]),
+    ("marc dupont", ["dupont"]),
+])
+def test_exact_and_prefix_matches(index, query, expected):
+    assert ids(index.search(query)) == expected
+
+
+def test_name_outranks_specialty_and_exact_outranks_prefix(index):
+    # "martin" is Paul Martin's exact name, a prefix of Martine
+    assert ids(index.search("martin")) == ["martin", "martine"]
+    assert ids(index.search("cardio")) == ["helene", "martine"]
+
+
+def test_every_token_must_match(index):
+    assert index.search("martin pediatrie") == ([], 0)
+
+
+@pytest.mark.parametrize("query,expected", [
+    ("hlene", "helene"),         # dropped letter
+    ("heelne", "helene"),        # swapped letters
+    ("matrin", "martin"),        # swapped letters
+    ("dupnt", "dupont"),         # dropped letter
+    ("cardilogie", "helene"),
+])
+def test_typos_still_match(index, query, expected):
+    assert ids(index.search(query))[0] == expected
+
+
+def test_unrelated_query_matches_nothing(index):
+    assert index.search("zzzz") == ([], 0)
+    # Too short for typo tolerance
+    assert index.search("xu") == ([], 0)
+
+
+def test_limit_keeps_the_best_results(index):
+    results, total = index.search("cardiologie", limit=1)
+    assert total == 2 and len(results) == 1
+
+
+@pytest.mark.parametrize("a,b,limit,distance", [
+    ("martin", "martin", 1, 0),
+    ("hlene", "helene", 1, 1),
+    ("matrin", "martin", 1, 1),
+    ("dupont", "dupond", 1, 1),
+    ("abcdef", "badcfe", 2, 3),
+    ("short", "muchlonger", 2, 3),
+])
+def test_edit_distance_is_bounded(a, b, limit, distance):
+    assert edit_distance(a, b, limit) == distance
+
+
+def test_search_endpoint_refuses_one_letter_queries(client):
+    response = client.get("/search_doctors", query_string={"q": " é "})
+    assert response.status_code == 400
@@ -0,0 +1,106 @@
+"""Content-addressed GridFS storage: per-file upload limit, deduplication,
+reference counting and garbage collection."""
+import io
+from datetime import datetime, timedelta
+
+import pytest
+from gridfs import GridFS
+
+import app as appmod
+from storage import ContentStore, LimitedUploadFile
+
+
+@pytest.fixture
+def store(db, indexes):
+    indexes("fs.files")
+    return ContentStore(lambda: db)
+
+
+def stored_refs(db, file_id):
+    stored = db.fs.files.find_one({"_id": file_id}, {"refs": 1})
+    return stored["refs"] if stored else None
+
+
+def test_oversized_upload_fails_while_parsing(client, register, monkeypatch):
+    monkeypatch.setitem(appmod.app.config, "MAX_UPLOAD_FILE_SIZE", 64 * 1024)
+    spooled = []
+
+    class RecordingUploadFile(LimitedUploadFile):
+        def write(self, data):
+            spooled.append(len(data))
+            return super().write(data)
+
+    monkeypatch.setattr(appmod, "LimitedUploadFile", RecordingUploadFile)
+    patient = register(client, "patient", "Uploader")
+
+    response = client.post(
+        "/documents",
+        data={"document": (io.BytesIO(b"x" * (4 * 1024 * 1024)), "scan.pdf", "application/pdf")},
+        headers={"Authorization": f"Bearer {patient['token']}"}
+    )
+
+    assert response.status_code == 413
+    assert "par fichier" in response.get_json()["message"]
+    # Parsing stopped at the limit instead of spooling the 4 MB body
+    assert sum(spooled) < 256 * 1024
+    assert appmod.mongo.db.documents.count_documents({}) == 0
+
+
+def test_upload_within_limit_is_stored(client, register):
+    patient = register(client, "patient", "Uploader")
+    response = client.post(
+        "/documents",
+        data={"document": (io.BytesIO(b"%PDF-1.4 small"), "scan.pdf", "application/pdf")},
+        headers={"Authorization": f"Bearer {patient['token']}"}
+    )
+    assert response.status_code == 201, response.get_json()
+
+
+def test_identical_content_is_stored_once(db, store):
+    first = store.put(io.BytesIO(b"same scan"), "a.pdf", "application/pdf")
+    second = store.put(io.BytesIO(b"same scan"), "b.pdf", "application/pdf")
+    other = store.put(io.BytesIO(b"another scan"), "c.pdf", "application/pdf")
+
+    assert first == second != other
+    assert stored_refs(db, first) == 2
+    assert stored_refs(db, other) == 1
+    assert db.fs.files.count_documents({}) == 2
+    # The dropped copy left no chunks behind
+    assert set(db.fs.chunks.distinct("files_id")) == {first, other}
+    assert GridFS(db).get(first).read() == b"same scan"
+
+
+def test_last_release_deletes_the_file_and_its_thumbnail(db, store):
+    file_id = store.put(io.BytesIO(b"same scan"), "a.pdf", "application/pdf")
+    store.put(io.BytesIO(b"same scan"), "b.pdf", "application/pdf")
+    thumbnail_id = GridFS(db).put(b"jpeg", filename="thumb.jpg")
+    db.fs.files.update_one({"_id": file_id}, {"$set": {"thumbnailId": thumbnail_id}})
+
+    store.release(str(file_id))
+    assert stored_refs(db, file_id) == 1
+    assert GridFS(db).exists(file_id)
+
+    store.release(str(file_id))
+    assert not GridFS(db).exists(file_id)
+    assert not GridFS(db).exists(thumbnail_id)
+    assert db.fs.chunks.count_documents({}) == 0
+
+
+def test_garbage_collection_reconciles_references(db, store):
+    long_ago = datetime.utcnow() - timedelta(days=1)
+    drifted, unreferenced, in_consultation, recent = (
+        store.put(io.BytesIO(content), "scan.pdf", "application/pdf")
+        for content in (b"drifted", b"unreferenced", b"in consultation", b"recent")
+    )
+    db.fs.files.update_many({"_id": {"$ne": recent}}, {"$set": {"lastRefAt": long_ago}})
+    db.fs.files.update_one({"_id": drifted}, {"$set": {"refs": 3}})
+    db.documents.insert_one({"fileId": str(drifted)})
+    db.consultations.insert_one({"documentIds": [str(in_consultation), str(drifted)]})
+
+    assert store.collect_garbage(timedelta(hours=1)) == 1
+
+    assert stored_refs(db, unreferenced) is None
+    assert stored_refs(db, drifted) == 2
+    assert stored_refs(db, in_consultation) == 1
+    # Referenced within the grace period: its record may still be on its way
+    assert stored_refs(db, recent) == 1
@@ -0,0 +1,58 @@
+"""Streamed lists (NDJSON and chunked JSON) return the same rows, in the same
+order, as the paged endpoint for the same after/before/limit."""
+import json
+from datetime import datetime
+
+import pytest
+
+ROWS = 30
+
+
+@pytest.fixture
+def doctor(client, db, register):
+    doctor = register(client, "medecin", "Dr Stream")
+    ids = db.rendezvous.insert_many([
+        {"patientId": f"p{i}", "doctorId": doctor["user_id"], "date": "2030-01-07", "heure": "09:00",
+         "status": "pending", "createdAt": datetime(2030, 1, 1)}
+        for i in range(ROWS)
+    ]).inserted_ids
+    return {"Authorization": f"Bearer {doctor['token']}"}, [str(i) for i in ids]
+
+
+def paged(client, headers, **args):
+    response = client.get("/doctor/rendezvous", query_string=args, headers=headers)
+    assert response.status_code == 200
+    return [row["_id"] for row in response.get_json()]
+
+
+def streamed(client, headers, fmt, **args):
+    if fmt == "ndjson":
+        response = client.get("/doctor/rendezvous", query_string=args,
+                              headers={**headers, "Accept": "application/x-ndjson"})
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    else:
+        response = client.get("/doctor/rendezvous", query_string={**args, "stream": "1"}, headers=headers)
+        rows = json.loads(response.get_data(as_text=True))
+    assert response.status_code == 200
+    return [row["_id"] for row in rows]
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "array"])
+@pytest.mark.parametrize("args", [
+    lambda ids: {"limit": 7},
+    lambda ids: {"after": ids[5], "limit": 7},
+    lambda ids: {"after": ids[25], "limit": 7},
+    lambda ids: {"before": ids[20], "limit": 7},
+    lambda ids: {"before": ids[3], "limit": 7},
+], ids=["limit", "after", "after-near-newest", "before", "before-near-oldest"])
+def test_stream_matches_page(client, doctor, fmt, args):
+    headers, ids = doctor
+    args = args(ids)
+    expected = paged(client, headers, **args)
+    assert streamed(client, headers, fmt, **args) == expected
+
+
+def test_stream_without_limit_returns_every_bounded_row(client, doctor):
+    headers, ids = doctor
+    assert streamed(client, headers, "ndjson", after=ids[9]) == ids[10:][::-1]
+    assert streamed(client, headers, "ndjson") == ids[::-1]
@@ -0,0 +1,148 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from bson.objectid import ObjectId
+from gridfs import GridFS
+
+from background import PerProcess
+
+# Imaging libraries are optional: without them documents simply have no thumbnail
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+try:
+    from gevent import get_hub, monkey
+except ImportError:
+    monkey = None
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_TYPE = "image/jpeg"
+
+
+def render_thumbnail(file, content_type, size):
+    """JPEG bytes of an image, or of the first page of a PDF, fitting in size x size.
+    Returns None when the type is not supported or its library is missing."""
+    if content_type == "application/pdf":
+        if pymupdf is None or Image is None:
+            return None
+        with pymupdf.open(stream=file.read(), filetype="pdf") as pdf:
+            if not pdf.page_count:
+                return None
+            page = pdf.load_page(0)
+            zoom = size / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+            image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+    elif content_type in ("image/jpeg", "image/png"):
+        if Image is None:
+            return None
+        image = Image.open(file)
+        # Let the JPEG decoder downscale while decoding
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+    else:
+        return None
+
+    image.thumbnail((size, size))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    output = BytesIO()
+    image.save(output, "JPEG", quality=80, optimize=True)
+    return output.getvalue()
+
+
+def run_native(function, *args):
+    """Run CPU-bound work on a native thread when gevent has patched threading,
+    so rendering does not block the worker's event loop."""
+    if monkey is not None and monkey.is_module_patched("threading"):
+        return get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+
+class ThumbnailWorker:
+    """Background pool building thumbnails of stored files.
+
+    A thumbnail belongs to the stored content: it is saved in GridFS and its
+    id is recorded as `thumbnailId` on the original's fs.files document and
+    on every documents record of that file. Identical uploads therefore
+    share one thumbnail. Work beyond `max_pending` queued files is dropped
+    (`flask build-thumbnails` catches up).
+    """
+
+    def __init__(self, get_db, size=256, workers=2, max_pending=500):
+        self.get_db = get_db
+        self.size = size
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = PerProcess(lambda: ThreadPoolExecutor(self.workers, thread_name_prefix="thumbnails"))
+
+    def submit(self, file_id):
+        if not self._slots.acquire(blocking=False):
+            logger.warning(f"Thumbnail queue full, skipping file {file_id}")
+            return
+        try:
+            self._executor.get().submit(self._run, ObjectId(file_id))
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _run(self, file_id):
+        try:
+            self.build(file_id)
+        except Exception as e:
+            logger.error(f"Error building thumbnail of {file_id}: {str(e)}")
+        finally:
+            self._slots.release()
+
+    def build(self, file_id):
+        """Build (or reuse) the thumbnail of a stored file and link it. Returns its id."""
+        db = self.get_db()
+        fs = GridFS(db)
+        stored = db.fs.files.find_one({"_id": file_id}, {"contentType": 1, "thumbnailId": 1})
+        if not stored:
+            return None
+
+        thumbnail_id = stored.get("thumbnailId")
+        if not thumbnail_id:
+            source = BytesIO(fs.get(file_id).read())
+            data = run_native(render_thumbnail, source, stored.get("contentType"), self.size)
+            if data is None:
+                return None
+            thumbnail_id = fs.put(data, filename=f"{file_id}.jpg", content_type=THUMBNAIL_TYPE, thumbnailOf=file_id)
+            linked = db.fs.files.update_one(
+                {"_id": file_id, "thumbnailId": {"$exists": False}},
+                {"$set": {"thumbnailId": thumbnail_id}}
+            )
+            if not linked.modified_count:
+                # Built concurrently by another worker, or the file was deleted meanwhile
+                fs.delete(thumbnail_id)
+                stored = db.fs.files.find_one({"_id": file_id}, {"thumbnailId": 1})
+                thumbnail_id = stored.get("thumbnailId") if stored else None
+                if not thumbnail_id:
+                    return None
+
+        db.documents.update_many(
+            {"fileId": str(file_id), "thumbnailId": {"$exists": False}},
+            {"$set": {"thumbnailId": str(thumbnail_id)}}
+        )
+        return thumbnail_id
+
+    def missing(self):
+        """Ids of stored uploads that could have a thumbnail but have none."""
+        return [
+            stored["_id"] for stored in self.get_db().fs.files.find(
+                {
+                    "contentType": {"$in": ["application/pdf", "image/jpeg", "image/png"]},
+                    "thumbnailId": {"$exists": False},
+                    "thumbnailOf": {"$exists": False}
+                },
+                {"_id": 1}
+            )
+        ]
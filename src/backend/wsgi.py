@@ -0,0 +1,12 @@
+"""Entrypoint of the web role, served by gunicorn's gevent worker:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The scheduler runs as a separate role (`flask --app app run-scheduler`).
+"""
+import os
+
+# gunicorn has monkey-patched the worker for gevent before loading this module
+os.environ.setdefault("SOCKETIO_ASYNC_MODE", "gevent")
+
+from app import app  # noqa: E402,F401